@@ -1,5 +1,4 @@
 from config import Config
-from elasticsearch import Elasticsearch
 from flask import Flask, request, current_app
 from flask_babel import Babel, lazy_gettext as _l
 from flask_bootstrap import Bootstrap
@@ -63,10 +62,26 @@ def create_app(config_class=Config):
     # No elasticsearch Flask extension so have to do differently
     # Add as attribute to app so accessible anywhere current_app is
     # If environment variable isn't set then search will be disabled
-    app.elasticsearch = (Elasticsearch([app.config['ELASTICSEARCH_URL']])
+    # The client has timeouts, retries and a circuit breaker (see
+    # app/search/es.py)
+    from app.search.es import create_client
+    app.elasticsearch = (create_client(app)
                          if app.config['ELASTICSEARCH_URL'] else None)
     app.redis = Redis.from_url(app.config['REDIS_URL'])
     app.task_queue = rq.Queue('myblog-tasks', connection=app.redis)
+    # Search engine used (see app/search) and the queue for index changes
+    # when SEARCH_INDEX_MODE is 'thread'
+    from app.search import SearchIndexer, create_backend
+    app.search_backend = create_backend(app)
+    app.search_indexer = SearchIndexer(app)
+    # Rendered posts kept by this process (see app/fragments.py)
+    from app.cache import LRUCache
+    from app.fragments import render_posts
+    app.post_fragments = LRUCache(app.config['POST_FRAGMENT_CACHE_SIZE'])
+    app.add_template_global(render_posts)
+    # Logged in users kept by this process (see app/identity.py)
+    app.identity_cache = LRUCache(app.config['IDENTITY_CACHE_SIZE'],
+                                  app.config['IDENTITY_CACHE_LOCAL_TTL'])
 
     # Put import here to avoid circular dependencies
     # Also need to delay import until this point so we have app instance
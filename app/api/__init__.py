@@ -5,5 +5,5 @@ bp = Blueprint('api', __name__)
 
 
 # Import here to avoid circular dependencies
-from app.api import users, errors, tokens
+from app.api import users, errors, tokens, search
 
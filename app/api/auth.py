@@ -26,7 +26,15 @@ def basic_auth_error():
 @token_auth.verify_token
 def verify_token(token):
     # Since User.check_token is a static function, must fully qualify it
-    g.current_user = User.check_token(token) if token else None
+    # g.current_user = User.check_token(token) if token else None
+    # Signed tokens (JWTs - header.claims.signature) are checked without a
+    # database lookup, random ones (which never contain dots) are looked up
+    if not token:
+        g.current_user = None
+    elif token.count('.') == 2:
+        g.current_user = User.check_signed_token(token)
+    else:
+        g.current_user = User.check_token(token)
     return g.current_user is not None
 
 
@@ -0,0 +1,29 @@
+from flask import current_app, jsonify, request
+from hashlib import sha1
+
+
+# HTTP caching policies for API responses
+# Everything is behind authentication so shared caches mustn't keep it;
+# clients may reuse a collection page for a few seconds, a single resource
+# must be revalidated (cheap with its ETag) every time
+RESOURCE = 'private, no-cache'
+COLLECTION = 'private, max-age=10'
+# Changes and credentials aren't to be kept at all
+NO_STORE = 'no-store'
+
+
+def etag(*parts):
+    return sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+# A JSON response for build() tagged with etag - or an empty 304 (Not
+# Modified) response if the client already has that version, in which case
+# build() isn't called at all
+def conditional_json(etag, cache_control, build):
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
@@ -0,0 +1,17 @@
+from flask import jsonify, current_app
+from app.api import bp, caching
+from app.api.auth import token_auth
+
+
+# Health of the connection to Elasticsearch - request, retry and failure counts
+# and the circuit breaker state for this process
+@bp.route('/search/metrics', methods=['GET'])
+@token_auth.login_required
+def get_search_metrics():
+    if not current_app.elasticsearch:
+        response = jsonify({'state': 'disabled'})
+    else:
+        response = jsonify(current_app.elasticsearch.transport.metrics())
+    # Always current
+    response.headers['Cache-Control'] = caching.NO_STORE
+    return response
@@ -1,21 +1,34 @@
-from flask import jsonify, g
+from flask import jsonify, g, current_app
 from app import db
-from app.api import bp
+from app.api import bp, caching
 from app.api.auth import basic_auth, token_auth
+from app.api.errors import error_response
+import redis
 
 
 @bp.route('/tokens', methods=['POST'])
 @basic_auth.login_required
 def get_token():
-    token = g.current_user.get_token()
-    db.session.commit()
-    return jsonify({'token': token})
+    expires_in = current_app.config['API_TOKEN_EXPIRES']
+    if current_app.config['API_TOKEN_FORMAT'] == 'signed':
+        token = g.current_user.get_signed_token(expires_in)
+    else:
+        token = g.current_user.get_token(expires_in)
+        db.session.commit()
+    response = jsonify({'token': token})
+    # Credentials mustn't be kept by any cache
+    response.headers['Cache-Control'] = caching.NO_STORE
+    return response
 
 
 @bp.route('/tokens', methods=['DELETE'])
 @token_auth.login_required
 def revoke_token():
-    g.current_user.revoke_token()
+    # Revokes the user's random token and every signed token issued to them
+    try:
+        g.current_user.revoke_token()
+    except redis.exceptions.RedisError:
+        return error_response(503, 'unable to revoke tokens right now')
     db.session.commit()
     # No response content so return empty string and 204 status code
     # 204 is used for successful operation but no content
@@ -1,8 +1,9 @@
-from flask import jsonify, request, url_for, g, abort
-from app import db
+from flask import jsonify, request, url_for, g, abort, current_app
+from app import db, importer
 from app.models import User
-from app.api import bp
+from app.api import bp, caching
 from app.api.auth import token_auth
+from app.api.caching import conditional_json, etag
 from app.api.errors import bad_request
 
 
@@ -13,44 +14,104 @@ from app.api.errors import bad_request
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
-    return jsonify(User.query.get_or_404(id).to_dict())
+    # return jsonify(User.query.get_or_404(id).to_dict())
+    # Clients which already have this version of the user get a 304
+    user = User.query.get_or_404(id)
+    return conditional_json(etag(user.version()), caching.RESOURCE,
+                            user.to_dict)
 
 
-# Since this is a collection of users, must handle pagination
-@bp.route('/users', methods=['GET'])
-@token_auth.login_required
-def get_users():
+# Clients opt into keyset pagination with a cursor query parameter (empty for
+# the first page) and can ask for the total count with include_total=1
+def cursor_args():
+    return {'cursor': request.args.get('cursor'),
+            'include_total': request.args.get('include_total', 0, type=int) == 1}
+
+
+# Respond with the requested page of a collection of users
+# The page is tagged with its version (see User.collection_version) so a
+# client polling for changes gets a 304, without the page being represented
+# again, until there are some
+def users_page(query, endpoint, **kwargs):
     # Extract page and per_page from query string
     page = request.args.get('page', 1, type=int)
     # Limit per_page range from 10 to 100 - reasonable range to prevent
     # overtaxing server
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
-    return jsonify(data)
+    args = cursor_args()
+    resources = User.collection_page(query, page, per_page, **args)
+    return conditional_json(
+        etag(request.full_path, User.collection_version(resources)),
+        caching.COLLECTION,
+        lambda: User.collection_dict(resources, page, per_page, endpoint,
+                                     **args, **kwargs))
+
+
+# Since this is a collection of users, must handle pagination
+@bp.route('/users', methods=['GET'])
+@token_auth.login_required
+def get_users():
+    # data = User.to_collection_dict(User.query, page, per_page, 'api.get_users',
+    #                                **cursor_args())
+    # return jsonify(data)
+    # Several particular users at once (instead of a request for each)
+    if 'ids' in request.args or 'usernames' in request.args:
+        return users_batch()
+    return users_page(User.query, 'api.get_users')
+
+
+# Look up a comma separated list of up to API_BATCH_LIMIT ids (?ids=1,2,3) or
+# usernames (?usernames=john,susan) with one query
+# Returns {'items': {key: user or null, ...}} - keyed by the ids or usernames
+# asked for, with null for those which don't exist
+def users_batch():
+    if 'ids' in request.args and 'usernames' in request.args:
+        return bad_request('use either ids or usernames, not both')
+    field = 'ids' if 'ids' in request.args else 'usernames'
+    # Each key once
+    keys = list(dict.fromkeys(
+        key.strip() for key in request.args[field].split(',') if key.strip()))
+    if not keys:
+        return bad_request(f'{field} must list at least one user')
+    limit = current_app.config['API_BATCH_LIMIT']
+    if len(keys) > limit:
+        return bad_request(f'at most {limit} {field} can be looked up at once')
+    if field == 'ids':
+        try:
+            keys = [int(key) for key in keys]
+        except ValueError:
+            return bad_request('ids must be integers')
+        column = User.id
+    else:
+        column = User.username
+    users = User.query.filter(column.in_(keys)).all()
+    found = {getattr(user, column.key): user for user in users}
+    users = [found[key] for key in keys if key in found]
+
+    def build():
+        items = dict(zip([getattr(user, column.key) for user in users],
+                         User.to_collection_items(users)))
+        return {'items': {str(key): items.get(key) for key in keys},
+                '_meta': {'requested': len(keys), 'found': len(users)}}
+    return conditional_json(
+        etag(request.full_path, [user.version() for user in users]),
+        caching.COLLECTION, build)
 
 
 # The next two functions are similar to the above but add a keyword argument
-# to the invocation of to_collection_dict
+# for the URLs of the pages
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followers, page, per_page,
-                                   'api.get_followers', id=id)
-    return jsonify(data)
+    return users_page(user.followers, 'api.get_followers', id=id)
 
 
 @bp.route('/users/<int:id>/followed', methods=['GET'])
 @token_auth.login_required
 def get_followed(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followed, page, per_page,
-                                   'api.get_followed', id=id)
-    return jsonify(data)
+    return users_page(user.followed, 'api.get_followed', id=id)
 
 
 # No authentication required to allow creation of new users
@@ -71,6 +132,7 @@ def create_user():
     db.session.add(user)
     db.session.commit()
     response = jsonify(user.to_dict())
+    response.headers['Cache-Control'] = caching.NO_STORE
     # Normal status code for POST request which creates a resource vs. default
     # of 200
     response.status_code = 201
@@ -79,6 +141,43 @@ def create_user():
     return response
 
 
+# Create many users, and who they follow, at once - see app/importer.py
+# {'users': [{'username': ..., 'email': ..., 'password': ...}, ...],
+#  'follows': [{'follower': username, 'followed': username}, ...]}
+# Either list can be left out, follows are added after users so can refer to
+# users from the same request
+# Records which can't be imported are reported (by position in their list) and
+# don't stop the others
+@bp.route('/users/bulk', methods=['POST'])
+@token_auth.login_required
+def import_users():
+    data = request.get_json() or {}
+    users = data.get('users') or []
+    follows = data.get('follows') or []
+    if not isinstance(users, list) or not isinstance(follows, list):
+        return bad_request('users and follows must be lists')
+    limit = current_app.config['API_BULK_USER_LIMIT']
+    if len(users) > limit:
+        return bad_request(f'at most {limit} users can be imported at once')
+    limit = current_app.config['API_BULK_LIMIT']
+    if len(users) + len(follows) > limit:
+        return bad_request(f'at most {limit} users and follows can be '
+                           f'imported at once')
+    # Passwords are hashed here in the request rather than by a process pool
+    user_result = importer.import_users(enumerate(users, 1))
+    follow_result = importer.import_follows(enumerate(follows, 1))
+    elapsed = user_result['elapsed'] + follow_result['elapsed']
+    response = jsonify({
+        'users': {'created': user_result['created'],
+                  'errors': user_result['errors']},
+        'follows': {'created': follow_result['created'],
+                    'errors': follow_result['errors']},
+        '_meta': {'elapsed': elapsed,
+                  'rate': (len(users) + len(follows)) / max(elapsed, 0.001)}})
+    response.headers['Cache-Control'] = caching.NO_STORE
+    return response
+
+
 @bp.route('/users/<int:id>', methods=['PUT'])
 @token_auth.login_required
 def update_user(id):
@@ -99,5 +198,7 @@ def update_user(id):
     # Not a new user, password changes not allowed/supported here
     user.from_dict(data, new_user=False)
     db.session.commit()
-    return jsonify(user.to_dict())
+    response = jsonify(user.to_dict())
+    response.headers['Cache-Control'] = caching.NO_STORE
+    return response
 
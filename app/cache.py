@@ -0,0 +1,49 @@
+# In-process least recently used cache
+# Used in front of Redis for things every page asks for, so most lookups don't
+# leave the process.  Each process has its own so entries must either never
+# go stale (the key changes when the value would) or expire quickly.
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+    # ttl is in seconds, None for entries which never expire
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
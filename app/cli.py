@@ -1,5 +1,9 @@
-import os
+from app import db, identity, importer, last_seen, popups
+from app.models import SearchableMixin, User
 import click
+import json
+import os
+import time
 
 
 # Can't use current_app here because this is done at startup, not during
@@ -44,3 +48,201 @@ def register(app):
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
 
+
+
+    # Denormalized user counters (User.post_count, follower_count and
+    # followed_count):
+    @app.cli.group()
+    def counters():
+        """User counter maintenance commands."""
+        pass
+
+
+    @counters.command()
+    @click.option('--chunk-size', default=1000,
+                  help='Number of users to recount per query.')
+    def backfill(chunk_size):
+        """Recalculate every user's counters."""
+        fixed = _recount(chunk_size, repair=True, only_mismatched=False)
+        print(f'{fixed} users updated')
+
+
+    @counters.command()
+    @click.option('--repair', is_flag=True,
+                  help='Fix any counters which are wrong.')
+    @click.option('--chunk-size', default=1000,
+                  help='Number of users to check per query.')
+    def check(repair, chunk_size):
+        """Check user counters are consistent."""
+        wrong = _recount(chunk_size, repair=repair, only_mismatched=True)
+        if repair:
+            print(f'{wrong} users repaired')
+        else:
+            print(f'{wrong} users with inconsistent counters')
+
+
+    # Write out buffered last_seen values now rather than waiting for the next
+    # request to do it (e.g., run from cron or before a deploy)
+    @app.cli.command('flush-last-seen')
+    def flush_last_seen():
+        """Write buffered last seen times to the database."""
+        print(f'{last_seen.flush()} users updated')
+
+
+    # Bulk import of users and follows from NDJSON or CSV files (e.g., when
+    # moving a community over from another site) - see app/importer.py
+    @app.cli.group('import')
+    def import_():
+        """Bulk import commands."""
+        pass
+
+
+    # Report progress and throughput after each chunk
+    def _progress(start, what):
+        def progress(done):
+            rate = done / max(time.time() - start, 0.001)
+            print(f'{done} {what} read, {rate:.0f}/s')
+        return progress
+
+
+    def _report(result, what):
+        for error in result['errors']:
+            print(f'row {error["row"]}: {error["message"]}')
+        print(f'{result["created"]} {what} imported, {len(result["errors"])} '
+              f'rows skipped in {result["elapsed"]:.1f}s '
+              f'({result["rate"]:.0f} rows/s)')
+
+
+    @import_.command('users')
+    @click.argument('file', type=click.File(encoding='utf-8'))
+    @click.option('--format', 'format_', type=click.Choice(importer.FORMATS),
+                  default='ndjson', help='File format.')
+    @click.option('--chunk-size', default=1000,
+                  help='Number of users per INSERT.')
+    @click.option('--workers', default=os.cpu_count() or 1,
+                  help='Number of processes hashing passwords.')
+    def import_users(file, format_, chunk_size, workers):
+        """Import users (username, email, password, about_me)."""
+        result = importer.import_users(
+            importer.read_records(file, format_), chunk_size=chunk_size,
+            workers=workers, progress=_progress(time.time(), 'users'))
+        _report(result, 'users')
+
+
+    @import_.command('follows')
+    @click.argument('file', type=click.File(encoding='utf-8'))
+    @click.option('--format', 'format_', type=click.Choice(importer.FORMATS),
+                  default='ndjson', help='File format.')
+    @click.option('--chunk-size', default=1000,
+                  help='Number of follows per INSERT.')
+    def import_follows(file, format_, chunk_size):
+        """Import follows (follower and followed usernames)."""
+        result = importer.import_follows(
+            importer.read_records(file, format_), chunk_size=chunk_size,
+            progress=_progress(time.time(), 'follows'))
+        _report(result, 'follows')
+
+
+    # Full text search index maintenance:
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+
+    @search.command()
+    @click.option('--index', default='post',
+                  help='Index to rebuild (a searchable table name).')
+    @click.option('--chunk-size', default=500,
+                  help='Number of documents per bulk request.')
+    @click.option('--workers', default=4,
+                  help='Number of bulk requests sent in parallel.')
+    @click.option('--resume', is_flag=True,
+                  help='Carry on from the last checkpoint.')
+    @click.option('--checkpoint-file', default='reindex-{index}.json',
+                  help='Where progress is recorded for --resume.')
+    def reindex(index, chunk_size, workers, resume, checkpoint_file):
+        """Rebuild a search index into a new index and switch to it."""
+        if not app.search_backend:
+            raise click.ClickException('Search is disabled')
+        models = {cls.__tablename__: cls
+                  for cls in SearchableMixin.__subclasses__()}
+        if index not in models:
+            raise click.BadParameter(f'choose from {", ".join(models)}',
+                                     param_hint='--index')
+        checkpoint_file = checkpoint_file.format(index=index)
+        state = {'version': None, 'last_id': 0, 'done': 0}
+        if resume:
+            if not os.path.exists(checkpoint_file):
+                raise click.ClickException(f'no checkpoint in '
+                                           f'{checkpoint_file}')
+            with open(checkpoint_file) as f:
+                state = json.load(f)
+            print(f'Resuming {state["version"]} after id {state["last_id"]}')
+        start = time.time()
+        resumed = state['done']
+
+        # Record progress after each stored chunk and report throughput
+        def checkpoint(version, last_id, count):
+            state.update(version=version, last_id=last_id,
+                         done=state['done'] + count)
+            with open(checkpoint_file, 'w') as f:
+                json.dump(state, f)
+            rate = (state['done'] - resumed) / (time.time() - start)
+            print(f'{state["done"]} documents indexed (id {last_id}), '
+                  f'{rate:.0f}/s')
+
+        version = models[index].reindex(
+            chunk_size=chunk_size, start_after=state['last_id'],
+            workers=workers, version=state['version'], checkpoint=checkpoint)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        elapsed = time.time() - start
+        done = state['done'] - resumed
+        print(f'{index} now points at {version}: {done} documents in '
+              f'{elapsed:.1f}s ({done / max(elapsed, 0.001):.0f}/s)')
+
+
+# Counter columns checked and repaired by the counters commands
+COUNTERS = ['post_count', 'follower_count', 'followed_count',
+            'unread_message_count']
+
+
+# Walk users in id order, chunk_size at a time, comparing counters against
+# counts from the source tables
+# Bulk updates skip the session's flush hooks, so repaired users are dropped
+# from the identity and popup caches here
+def _recount(chunk_size, repair, only_mismatched):
+    changed = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(
+            User.id, User.username,
+            *[getattr(User, name) for name in COUNTERS]).filter(
+                User.id > last_id).order_by(User.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        ids = [row[0] for row in rows]
+        relationships = User.count_relationships(ids)
+        unread = User.count_unread_messages(ids)
+        updates = []
+        usernames = []
+        for id, username, *current in rows:
+            expected = relationships[id] + (unread[id],)
+            if only_mismatched and tuple(current) == expected:
+                continue
+            if only_mismatched:
+                print(f'user {id}: ({", ".join(COUNTERS)}) is '
+                      f'{tuple(current)}, should be {expected}')
+            update = dict(zip(COUNTERS, expected))
+            update['id'] = id
+            updates.append(update)
+            usernames.append(username)
+        if repair and updates:
+            db.session.bulk_update_mappings(User, updates)
+            db.session.commit()
+            identity.invalidate([update['id'] for update in updates])
+            popups.invalidate(usernames)
+        changed += len(updates)
+    return changed
@@ -0,0 +1,79 @@
+# Cache of rendered posts
+# Pages of posts render _post.html once per post on every view - translating
+# strings, building URLs and avatar links - though a post never changes once
+# written.  The HTML for each post is kept in Redis and, in front of that, in
+# a per process LRU cache.
+# A fragment depends on the post, the locale it was rendered for and its
+# author's username and avatar (email address), and all of these are part of
+# its key, along with a version from the template source and
+# POST_FRAGMENT_VERSION.  So when a user changes their username their posts
+# simply get new keys - stale fragments are never looked up again and age out
+# of both caches.
+# If Redis is unavailable posts are rendered (and only cached in process).
+from flask import Markup, current_app, g, render_template
+from hashlib import sha1
+import redis
+
+TEMPLATE = '_post.html'
+
+
+# Short hash of a template's source, so cached HTML is discarded when the
+# template changes
+def template_version(template):
+    app = current_app._get_current_object()
+    versions = getattr(app, 'template_versions', None)
+    if versions is None:
+        versions = app.template_versions = {}
+    if template not in versions:
+        source = app.jinja_env.loader.get_source(app.jinja_env, template)[0]
+        versions[template] = sha1(source.encode('utf-8')).hexdigest()[:12]
+    return versions[template]
+
+
+def _version():
+    return (current_app.config['POST_FRAGMENT_VERSION'] + '.' +
+            template_version(TEMPLATE))
+
+
+def _key(post, version):
+    author = post.author
+    return (f'post-html:{version}:{g.locale}:{post.id}:{author.username}:'
+            f'{author.avatar_digest()}')
+
+
+# Rendered HTML (as Markup) for each of posts, in order - a template global so
+# listings use {% for html in render_posts(posts) %}{{ html }}{% endfor %}
+def render_posts(posts):
+    local = current_app.post_fragments
+    version = _version()
+    keys = [_key(post, version) for post in posts]
+    html = [local.get(key) for key in keys]
+    missing = [i for i in range(len(keys)) if html[i] is None]
+    if missing:
+        try:
+            cached = current_app.redis.mget([keys[i] for i in missing])
+        except redis.exceptions.RedisError:
+            cached = [None] * len(missing)
+        rendered = {}
+        for i, value in zip(missing, cached):
+            if value is None:
+                value = render_template(TEMPLATE, post=posts[i])
+                rendered[keys[i]] = value
+            else:
+                value = value.decode('utf-8')
+            html[i] = Markup(value)
+            local.set(keys[i], html[i])
+        if rendered:
+            _store(rendered)
+    return html
+
+
+def _store(rendered):
+    ttl = current_app.config['POST_FRAGMENT_TTL']
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for key, value in rendered.items():
+            pipe.set(key, value, ex=ttl)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
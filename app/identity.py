@@ -0,0 +1,107 @@
+# Cache of logged in users for flask_login's user loader (models.load_user)
+# The loader runs on every request, before any view, so the columns needed to
+# rebuild the user are kept in Redis (shared by all workers) and, in front of
+# that, in a per process LRU cache - a cache hit costs no database queries.
+# Committed changes to a user replace their Redis entry with a short lived
+# tombstone and drop it from this process's cache (see models.User).  Entries
+# are only added where there's nothing (not over a tombstone), so a worker
+# which read the user before the change can't put the old columns back.
+# Other processes can't be reached so they only keep entries for
+# IDENTITY_CACHE_LOCAL_TTL seconds - that's how long they can lag behind a
+# change.
+# If Redis is unavailable users are loaded from the database (and only cached
+# in process).
+from datetime import datetime
+from flask import current_app
+import json
+import redis
+
+TOMBSTONE = b''
+# Seconds a tombstone blocks new entries - longer than it takes to load a
+# user from the database and cache them
+TOMBSTONE_TTL = 10
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _key(user_id):
+    return f'identity:{user_id}'
+
+
+# Datetimes are stored as {'datetime': '...'}
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'datetime': value.strftime(TIMESTAMP_FORMAT)}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        return datetime.strptime(value['datetime'], TIMESTAMP_FORMAT)
+    return value
+
+
+# Cached {column: value} for user_id or None
+def get(user_id):
+    local = current_app.identity_cache
+    columns = local.get(user_id)
+    if columns is not None:
+        return columns
+    try:
+        entry = current_app.redis.get(_key(user_id))
+    except redis.exceptions.RedisError:
+        return None
+    if not entry:
+        return None
+    columns = {name: _decode(value)
+               for name, value in json.loads(entry).items()}
+    local.set(user_id, columns)
+    return columns
+
+
+def store(user_id, columns):
+    current_app.identity_cache.set(user_id, columns)
+    entry = json.dumps({name: _encode(value)
+                        for name, value in columns.items()})
+    try:
+        current_app.redis.set(_key(user_id), entry, nx=True,
+                              ex=current_app.config['IDENTITY_CACHE_TTL'])
+    except redis.exceptions.RedisError:
+        pass
+
+
+# A user's last_seen has been recorded (see app/last_seen.py) - keep the
+# cached value current so other requests don't record it again
+def seen(user_id, last_seen):
+    local = current_app.identity_cache
+    columns = local.get(user_id)
+    if columns is not None:
+        local.set(user_id, dict(columns, last_seen=last_seen))
+    # Only an entry that's there (not a tombstone) is updated, keeping its
+    # expiry - if it changes in the meantime the update is dropped (WATCH)
+    key = _key(user_id)
+    try:
+        with current_app.redis.pipeline() as pipe:
+            pipe.watch(key)
+            entry = pipe.get(key)
+            ttl = pipe.pttl(key)
+            if not entry or ttl <= 0:
+                return
+            columns = json.loads(entry)
+            columns['last_seen'] = _encode(last_seen)
+            pipe.multi()
+            pipe.set(key, json.dumps(columns), px=ttl)
+            pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def invalidate(user_ids):
+    for user_id in user_ids:
+        current_app.identity_cache.delete(user_id)
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.set(_key(user_id), TOMBSTONE, ex=TOMBSTONE_TTL)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Unable to invalidate cached users')
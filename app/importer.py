@@ -0,0 +1,217 @@
+# Bulk import of users and who follows whom (flask import and
+# POST /api/users/bulk)
+# Creating users one at a time (api.create_user) costs two uniqueness queries
+# and a commit each, and User.follow() checks is_following for every edge,
+# which is far too slow for moving a whole community over.  Here records are
+# handled chunk_size at a time instead: uniqueness is checked with one IN
+# query per column for the whole chunk (and against a set of everything seen
+# earlier in the import), the rows go in with one executemany INSERT and
+# there's a commit per chunk.
+# Hashing passwords is deliberately slow and dominates importing users, so it
+# can be spread over a pool of processes.
+# Each record that can't be imported is reported as {'row': n, 'message': ...}
+# (rows count from 1) and the rest of the import carries on.
+from app import db, popups, timeline
+from app.models import User, followers
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import json
+import time
+from werkzeug.security import generate_password_hash
+
+FORMATS = ('ndjson', 'csv')
+FOLLOW_FIELDS = ('follower', 'followed')
+
+
+# Records from an NDJSON (one JSON object per line) or CSV (with a header
+# row) file - yields (row, record) so errors can point at the row
+def read_records(f, format):
+    if format == 'csv':
+        for row, record in enumerate(csv.DictReader(f), 1):
+            yield row, record
+        return
+    for row, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            yield row, json.loads(line)
+        except ValueError:
+            yield row, None
+
+
+# Split an iterable into lists of size items
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _error(row, message):
+    return {'row': row, 'message': message}
+
+
+# Returns a message if a user record can't be used as it is
+def _check_user(record):
+    if not isinstance(record, dict):
+        return 'not a valid record'
+    for field in ('username', 'email', 'password'):
+        if not record.get(field) or not isinstance(record[field], str):
+            return f'must include {field}'
+    if not isinstance(record.get('about_me') or '', str):
+        return 'about_me must be a string'
+    for field in ('username', 'email', 'about_me'):
+        limit = getattr(User, field).type.length
+        if len(record.get(field) or '') > limit:
+            return f'{field} must be at most {limit} characters'
+
+
+# Existing values of column out of values, with one query
+def _existing(column, values):
+    return {value for (value,) in db.session.query(column).filter(
+        column.in_(values))}
+
+
+# Import users from (row, record) pairs - records have username, email,
+# password and optionally about_me
+# workers > 1 hashes passwords in that many processes, progress (if given) is
+# called after each chunk with the number of records handled so far
+# Returns {'created': n, 'errors': [...], 'elapsed': seconds, 'rate': rows/s}
+def import_users(records, chunk_size=1000, workers=1, progress=None):
+    start = time.time()
+    created = handled = 0
+    errors = []
+    # Usernames and emails of earlier chunks - these are committed, so the
+    # IN queries would find them too, but this saves asking
+    seen_usernames = set()
+    seen_emails = set()
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        for chunk in _chunks(records, chunk_size):
+            handled += len(chunk)
+            valid = []
+            for row, record in chunk:
+                message = _check_user(record)
+                if message:
+                    errors.append(_error(row, message))
+                else:
+                    valid.append((row, record))
+            taken_usernames = seen_usernames | _existing(
+                User.username, {record['username'] for _, record in valid})
+            taken_emails = seen_emails | _existing(
+                User.email, {record['email'] for _, record in valid})
+            new = []
+            for row, record in valid:
+                if record['username'] in taken_usernames:
+                    errors.append(_error(row, 'username is already taken'))
+                elif record['email'] in taken_emails:
+                    errors.append(_error(row, 'email is already taken'))
+                else:
+                    taken_usernames.add(record['username'])
+                    taken_emails.add(record['email'])
+                    new.append(record)
+            seen_usernames.update(record['username'] for record in new)
+            seen_emails.update(record['email'] for record in new)
+            if new:
+                passwords = [record['password'] for record in new]
+                hashes = (pool.map(generate_password_hash, passwords,
+                                   chunksize=max(len(passwords) // workers, 1))
+                          if pool else map(generate_password_hash, passwords))
+                # Core insert - column defaults (last_seen, counters) still
+                # apply, but no objects are built or tracked by the session
+                db.session.execute(User.__table__.insert(), [
+                    {'username': record['username'], 'email': record['email'],
+                     'about_me': record.get('about_me') or None,
+                     'password_hash': hash}
+                    for record, hash in zip(new, hashes)])
+                db.session.commit()
+                created += len(new)
+            if progress:
+                progress(handled)
+    finally:
+        if pool:
+            pool.shutdown()
+    return _result(start, handled, errors, created=created)
+
+
+# Import follows from (row, record) pairs - records have the follower and
+# followed usernames
+# Users must already exist (import them first), edges which are already there
+# are skipped.  Follower and followed counters are updated for each chunk.
+# Returns {'created': n, 'errors': [...], 'elapsed': seconds, 'rate': rows/s}
+def import_follows(records, chunk_size=1000, progress=None):
+    start = time.time()
+    created = handled = 0
+    errors = []
+    for chunk in _chunks(records, chunk_size):
+        handled += len(chunk)
+        valid = []
+        for row, record in chunk:
+            if not isinstance(record, dict) or \
+                    not all(isinstance(record.get(field), str) and
+                            record[field] for field in FOLLOW_FIELDS):
+                errors.append(_error(row, 'must include follower and '
+                                          'followed'))
+            else:
+                valid.append((row, record))
+        usernames = {record[field] for _, record in valid
+                     for field in FOLLOW_FIELDS}
+        ids = dict(db.session.query(User.username, User.id).filter(
+            User.username.in_(usernames)))
+        edges = set()
+        for row, record in valid:
+            missing = [record[field] for field in FOLLOW_FIELDS
+                       if record[field] not in ids]
+            if missing:
+                errors.append(_error(row, f'no user {missing[0]}'))
+            elif record['follower'] == record['followed']:
+                errors.append(_error(row, 'users cannot follow themselves'))
+            else:
+                edges.add((ids[record['follower']], ids[record['followed']]))
+        if edges:
+            follower_ids = {follower for follower, _ in edges}
+            followed_ids = {followed for _, followed in edges}
+            existing = db.session.query(
+                followers.c.follower_id, followers.c.followed_id).filter(
+                    followers.c.follower_id.in_(follower_ids),
+                    followers.c.followed_id.in_(followed_ids))
+            for edge in existing:
+                edges.discard(tuple(edge))
+        if edges:
+            db.session.execute(followers.insert(), [
+                {'follower_id': follower, 'followed_id': followed}
+                for follower, followed in edges])
+            _add_counts(User.followed_count,
+                        Counter(follower for follower, _ in edges))
+            _add_counts(User.follower_count,
+                        Counter(followed for _, followed in edges))
+            db.session.commit()
+            created += len(edges)
+            # Followers' timelines are missing the posts of who they now
+            # follow, and popups show the counts and who follows whom
+            timeline.discard({follower for follower, _ in edges})
+            names = {id: username for username, id in ids.items()}
+            popups.invalidate({names[id] for edge in edges for id in edge})
+        if progress:
+            progress(handled)
+    return _result(start, handled, errors, created=created)
+
+
+# column = column + n for each {user_id: n} in counts, as one executemany
+def _add_counts(column, counts):
+    table = User.__table__
+    db.session.execute(
+        table.update().where(table.c.id == db.bindparam('user_id')).values(
+            {column.key: column + db.bindparam('n')}),
+        [{'user_id': id, 'n': n} for id, n in counts.items()])
+
+
+def _result(start, handled, errors, **counts):
+    elapsed = time.time() - start
+    return dict(counts, errors=errors, elapsed=elapsed,
+                rate=handled / max(elapsed, 0.001))
@@ -0,0 +1,159 @@
+# Write-behind buffer for User.last_seen
+# Rather than committing last_seen on every request (one write transaction per
+# page view, even for AJAX polls), requests record when each user was seen in
+# a buffer and the buffer is written to the user table in a single batched
+# UPDATE every LAST_SEEN_FLUSH_INTERVAL seconds.
+# The buffer lives in a Redis hash shared by every worker, or in a per process
+# dictionary ('memory' backend, also used whenever Redis is unavailable).
+# Only one worker flushes the Redis buffer per interval - whichever one gets
+# the flush lock first.
+from app import db, identity
+from app.cache import LRUCache
+from app.models import User
+from datetime import datetime, timedelta
+from flask import current_app
+import redis
+from sqlalchemy.orm.attributes import set_committed_value
+import threading
+import time
+
+BUFFER_KEY = 'last-seen'
+FLUSHING_KEY = 'last-seen:flushing'
+FLUSH_LOCK_KEY = 'last-seen:flush-lock'
+EPOCH = datetime(1970, 1, 1)
+
+# user id -> last_seen buffered by this process (the memory backend, or when
+# Redis is unavailable) which isn't in the database yet
+_recorded = {}
+# user id -> last_seen this process put in the Redis buffer, so it can show
+# them until they've been flushed.  Any worker may do the flushing, so this
+# process can't always tell when they have been - only the most recent
+# BUFFERED_SIZE are kept.
+BUFFERED_SIZE = 10000
+_buffered = LRUCache(BUFFERED_SIZE)
+_lock = threading.Lock()
+_next_flush = [0]
+
+
+# Call once per request for an authenticated user
+def record(user):
+    now = datetime.utcnow()
+    granularity = timedelta(
+        seconds=current_app.config['LAST_SEEN_GRANULARITY'])
+    if user.last_seen and now - user.last_seen < granularity:
+        return
+    # Show the new value for the rest of the request without making the user
+    # dirty (which would write it on the next commit)
+    set_committed_value(user, 'last_seen', now)
+    identity.seen(user.id, now)
+    if current_app.config['LAST_SEEN_BACKEND'] == 'redis':
+        try:
+            current_app.redis.hset(BUFFER_KEY, user.id,
+                                   (now - EPOCH).total_seconds())
+            _buffered.set(user.id, now)
+            _flush_redis()
+            return
+        except redis.exceptions.RedisError:
+            # Fall back to this process's buffer
+            pass
+    with _lock:
+        _recorded[user.id] = now
+    if not _next_flush[0]:
+        # First value recorded by this process
+        _next_flush[0] = time.time() + \
+            current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+    elif time.time() >= _next_flush[0]:
+        flush_memory()
+
+
+# Write values buffered by this process
+def flush_memory():
+    _next_flush[0] = time.time() + \
+        current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+    with _lock:
+        pending = dict(_recorded)
+    if not pending:
+        return 0
+    _write(pending)
+    with _lock:
+        for id, seen in pending.items():
+            # Could have been recorded again while we were writing
+            if _recorded.get(id) == seen:
+                del _recorded[id]
+    return len(pending)
+
+
+# Write values from the shared Redis buffer if it's our turn
+def _flush_redis(force=False):
+    interval = current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+    if not force and not current_app.redis.set(FLUSH_LOCK_KEY, 1, nx=True,
+                                               ex=interval):
+        return 0
+    # Move the buffer aside atomically so new values aren't lost while we're
+    # writing
+    try:
+        current_app.redis.rename(BUFFER_KEY, FLUSHING_KEY)
+    except redis.exceptions.ResponseError:
+        # Nothing buffered
+        return 0
+    pipe = current_app.redis.pipeline()
+    pipe.hgetall(FLUSHING_KEY)
+    pipe.delete(FLUSHING_KEY)
+    buffered = pipe.execute()[0]
+    pending = {int(id): EPOCH + timedelta(seconds=float(seen))
+               for id, seen in buffered.items()}
+    if pending:
+        _write(pending)
+    for id, seen in pending.items():
+        mine = _buffered.get(id)
+        # Could have been recorded again since it was buffered (seen is
+        # rounded to the microsecond on the way through Redis)
+        if mine is not None and mine - seen < timedelta(milliseconds=1):
+            _buffered.delete(id)
+    return len(pending)
+
+
+# Flush whichever buffer is in use - returns number of users written
+def flush():
+    if current_app.config['LAST_SEEN_BACKEND'] == 'redis':
+        try:
+            return _flush_redis(force=True)
+        except redis.exceptions.RedisError:
+            pass
+    return flush_memory()
+
+
+# One UPDATE statement executed for all pending users, on its own connection
+# so it's independent of the request's session
+def _write(pending):
+    table = User.__table__
+    statement = table.update().where(
+        table.c.id == db.bindparam('user_id')).values(
+            last_seen=db.bindparam('seen'))
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(statement, [
+                {'user_id': id, 'seen': seen} for id, seen in pending.items()])
+    except Exception:
+        # last_seen is informational - don't fail the request over it
+        current_app.logger.exception('Unable to write last_seen values')
+
+
+# Users loaded from the database show any newer value this process has
+# recorded but not yet written
+def _overlay(user, context):
+    seen = _recorded.get(user.id) or _buffered.get(user.id)
+    if seen is None:
+        return
+    if user.last_seen is None or seen > user.last_seen:
+        set_committed_value(user, 'last_seen', seen)
+    else:
+        # Database has caught up
+        with _lock:
+            if _recorded.get(user.id) == seen:
+                del _recorded[user.id]
+        if _buffered.get(user.id) == seen:
+            _buffered.delete(user.id)
+
+
+db.event.listen(User, 'load', _overlay)
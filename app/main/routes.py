@@ -1,22 +1,31 @@
-from app import db
+from app import db, last_seen, popups, timeline
 from app.main import bp
 from app.main.forms import EditProfileForm, PostForm, SearchForm, MessageForm
 from app.models import User, Post, Message, Notification
+from app.pagination import keyset_paginate
+from app.search import SearchPage, SearchUnavailable
 from app.translate import translate
 from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, \
+    Response, make_response
 from flask_babel import _, get_locale
 from flask_login import current_user, login_required
 from guess_language import guess_language
+import json
+import redis
+import time
 
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
+        # current_user.last_seen = datetime.utcnow()
         # Don't have to do db.session.add because current_user loads the
         # current user into the current database session
-        db.session.commit()
+        # db.session.commit()
+        # Rather than a commit on every request, buffer last_seen and write it
+        # out in batches
+        last_seen.record(current_user)
         # Instantiate search form before request so can search from any page
         # In this block because only want authenticated users to be able to
         # search
@@ -28,6 +37,19 @@ def before_request():
     g.locale = str(get_locale())
 
 
+# Listings opt into keyset (cursor) pagination by passing a cursor query
+# parameter - an empty cursor means the first page
+# Returns (items, next_url, prev_url)
+def keyset_page(query, columns, endpoint, **kwargs):
+    items = keyset_paginate(query, columns, request.args.get('cursor'),
+                            current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for(endpoint, cursor=items.next_cursor, **kwargs) \
+        if items.has_next else None
+    prev_url = url_for(endpoint, cursor=items.prev_cursor, **kwargs) \
+        if items.has_prev else None
+    return items.items, next_url, prev_url
+
+
 # Decorating a function with app.route routes URLs to a view function
 # Note that the app.route decorators should be first
 @bp.route('/', methods=['GET', 'POST'])
@@ -47,6 +69,8 @@ def index():
         post = Post(body=form.post.data, author=current_user, language=language)
         db.session.add(post)
         db.session.commit()
+        # Push the new post into followers' home timelines
+        timeline.push_post(post)
         flash(_('Your post is now live!'))
         # Redirect instead of render template because after post should always
         # redirect to prevent accidental form re-submission
@@ -62,6 +86,13 @@ def index():
                  'body': 'The dance competition was fantastic!'}
             ]
     '''
+    if 'cursor' in request.args:
+        posts, next_url, prev_url = keyset_page(
+            current_user.followed_posts(), [Post.timestamp, Post.id],
+            'main.index')
+        return render_template('index.html', title=_('Home'), form=form,
+                               posts=posts, next_url=next_url,
+                               prev_url=prev_url)
     # Check query parameter for which page to start at
     page = request.args.get('page', 1, type=int)
 
@@ -70,7 +101,10 @@ def index():
     # posts = current_user.followed_posts().all()
     # With pagination - page to render, how many posts/page, should we return 404
     # if go past the end? (False = return empty list)
-    posts = current_user.followed_posts().paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    # posts = current_user.followed_posts().paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    # Read from the materialized timeline (falls back to followed_posts())
+    posts = timeline.get_timeline(current_user, page,
+                                  current_app.config['POSTS_PER_PAGE'])
     # Passing a keyword parameter to url_for causes it to use it as a query
     # parameter for the generated URL if it's not consumed (e.g., used for
     # dynamic parameter)
@@ -90,12 +124,22 @@ def index():
 @bp.route('/explore')
 @login_required
 def explore():
+    if 'cursor' in request.args:
+        posts, next_url, prev_url = keyset_page(
+            Post.query.options(db.joinedload(Post.author)),
+            [Post.timestamp, Post.id], 'main.explore')
+        return render_template('index.html', title=_('Explore'), posts=posts,
+                               next_url=next_url, prev_url=prev_url)
     page = request.args.get('page', 1, type=int)
 
     # Add pagination
     # posts = Post.query.order_by(Post.timestamp.desc()).all()
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(page,
-            current_app.config['POSTS_PER_PAGE'], False)
+    # posts = Post.query.order_by(Post.timestamp.desc()).paginate(page,
+    #         current_app.config['POSTS_PER_PAGE'], False)
+    # Every user sees the same pages so read the newest from the explore
+    # timeline kept in Redis (falls back to the query above, loading each
+    # post's author with it)
+    posts = timeline.get_explore(page, current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
     prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
     # return render_template('index.html', title='Explore', posts=posts)
@@ -117,12 +161,20 @@ def user(username):
                 {'author': user, 'body': 'Test post #2'}
             ]
     '''
+    # All the posts are by user, which is already loaded, so post.author is
+    # found in the session without a query
+    if 'cursor' in request.args:
+        posts, next_url, prev_url = keyset_page(
+            user.posts, [Post.timestamp, Post.id], 'main.user',
+            username=user.username)
+        return render_template('user.html', user=user, posts=posts,
+                               next_url=next_url, prev_url=prev_url)
     page = request.args.get('page', 1, type=int)
     posts = user.posts.order_by(Post.timestamp.desc()).paginate(page,
             current_app.config['POSTS_PER_PAGE'], False)
-    next_url = (url_for('main.explore', username=user.username, page=posts.next_num)
+    next_url = (url_for('main.user', username=user.username, page=posts.next_num)
                 if posts.has_next else None)
-    prev_url = (url_for('main.explore', username=user.username, page=posts.prev_num)
+    prev_url = (url_for('main.user', username=user.username, page=posts.prev_num)
                 if posts.has_prev else None)
     return render_template('user.html', user=user, posts=posts.items,
                            next_url=next_url, prev_url=prev_url)
@@ -131,8 +183,24 @@ def user(username):
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    return render_template('user_popup.html', user=user)
+    # user = User.query.filter_by(username=username).first_or_404()
+    # return render_template('user_popup.html', user=user)
+    # Popups are fetched on every mouseover so they're cached (see
+    # app/popups.py) and browsers are sent an ETag to revalidate with
+    relationship = current_user.relationship(username)
+    entry = popups.get(username, relationship)
+    if entry is None:
+        user = User.query.filter_by(username=username).first_or_404()
+        entry = popups.store(username, relationship, render_template(
+            'user_popup.html', user=user, relationship=relationship))
+    response = make_response(entry['html'])
+    response.set_etag(entry['etag'])
+    response.last_modified = datetime.utcfromtimestamp(entry['modified'])
+    # Depends on who's asking, and has to be checked every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    # Turns into an empty 304 response if the browser's copy is current
+    return response.make_conditional(request)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -171,6 +239,7 @@ def follow(username):
         return redirect(url_for('main.user', username=username))
     current_user.follow(user)
     db.session.commit()
+    timeline.add_follow(current_user, user)
     flash(_('You are now following %(username)s!', username=username))
     return redirect(url_for('main.user', username=username))
 
@@ -187,6 +256,7 @@ def unfollow(username):
         return redirect(url_for('main.user', username=username))
     current_user.unfollow(user)
     db.session.commit()
+    timeline.remove_follow(current_user, user)
     flash(_('You are no longer following %(username)s.', username=username))
     return redirect(url_for('main.user', username=username))
 
@@ -211,13 +281,23 @@ def search():
     # submitted
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
-    page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page,
-                               current_app.config['POSTS_PER_PAGE'])
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
-        if total > page * current_app.config['POSTS_PER_PAGE'] else None
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
-        if page > 1 else None
+    # Pages continue from opaque cursors rather than page numbers so deep
+    # pages cost the same as the first
+    try:
+        results = Post.search_page(
+            g.search_form.q.data, request.args.get('cursor', ''),
+            current_app.config['POSTS_PER_PAGE'],
+            hydrate=current_app.config['SEARCH_HYDRATE'])
+    except SearchUnavailable:
+        flash(_('Search is unavailable right now, please try again later.'))
+        results = SearchPage([], 0, True, None, None)
+    posts = results.items
+    next_url = url_for('main.search', q=g.search_form.q.data,
+                       cursor=results.next_cursor) \
+        if results.next_cursor else None
+    prev_url = url_for('main.search', q=g.search_form.q.data,
+                       cursor=results.prev_cursor) \
+        if results.prev_cursor else None
     return render_template('search.html', title=_('Search'), posts=posts,
                            next_url=next_url, prev_url=prev_url)
 
@@ -231,6 +311,10 @@ def send_message(recipient):
         msg = Message(author=current_user, recipient=user,
                       body=form.message.data)
         db.session.add(msg)
+        # user.add_notification('unread_message_count', user.new_messages())
+        # Bump the recipient's counter, flushing to get its new value back
+        user.message_received()
+        db.session.flush()
         user.add_notification('unread_message_count', user.new_messages())
         db.session.commit()
         flash(_('Your message has been sent.'))
@@ -242,9 +326,15 @@ def send_message(recipient):
 @bp.route('/messages')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
+    current_user.messages_read()
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
+    if 'cursor' in request.args:
+        messages, next_url, prev_url = keyset_page(
+            current_user.messages_received, [Message.timestamp, Message.id],
+            'main.messages')
+        return render_template('messages.html', messages=messages,
+                               next_url=next_url, prev_url=prev_url)
     page = request.args.get('page', 1, type=int)
     messages = current_user.messages_received.order_by(
         Message.timestamp.desc()).paginate(
@@ -274,12 +364,103 @@ def export_posts():
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
-    notifications = current_user.notifications.filter(
-        Notification.timestamp > since).order_by(Notification.timestamp.asc())
+    # Long poll - if there's nothing new, wait up to this many seconds for a
+    # notification to be published before returning
+    # (only with NOTIFICATIONS_PUSH - a sync worker can't be tied up waiting)
+    wait = min(request.args.get('wait', 0, type=int),
+               current_app.config['NOTIFICATIONS_LONG_POLL_TIMEOUT'])
+    if not current_app.config['NOTIFICATIONS_PUSH']:
+        wait = 0
+    # Subscribe before checking the database so nothing published in between
+    # is missed
+    pubsub = _subscribe(current_user.id) if wait > 0 else None
+    notifications = [n.to_dict() for n in current_user.notifications.filter(
+        Notification.timestamp > since).order_by(Notification.timestamp.asc())]
+    if pubsub is not None:
+        if not notifications:
+            # Don't hold on to a database connection while waiting
+            db.session.close()
+            notifications = _wait_for_notifications(pubsub, wait)
+        pubsub.close()
     # Return in JSON format since for JavaScript
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications])
+    return jsonify(notifications)
+
+
+# Server-Sent Events stream of notifications, replacing polling
+# Each connection lasts NOTIFICATIONS_STREAM_TIMEOUT seconds, then the browser
+# reconnects (sending the last event id so nothing is missed)
+# Needs an async worker (e.g., gunicorn -k gevent) as each open page holds a
+# connection, so it's off unless NOTIFICATIONS_PUSH is set
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    if not current_app.config['NOTIFICATIONS_PUSH']:
+        # Client falls back to polling
+        return '', 503
+    since = max(request.args.get('since', 0.0, type=float),
+                request.headers.get('Last-Event-ID', 0.0, type=float))
+    pubsub = _subscribe(current_user.id)
+    if pubsub is None:
+        # No Redis - client falls back to polling
+        return '', 503
+    backlog = [n.to_dict() for n in current_user.notifications.filter(
+        Notification.timestamp > since).order_by(Notification.timestamp.asc())]
+    db.session.close()
+    timeout = current_app.config['NOTIFICATIONS_STREAM_TIMEOUT']
+    heartbeat = current_app.config['NOTIFICATIONS_HEARTBEAT']
+
+    def stream():
+        try:
+            # How long the browser waits before reconnecting (ms)
+            yield 'retry: 1000\n\n'
+            for data in backlog:
+                yield _event(data)
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                message = pubsub.get_message(
+                    ignore_subscribe_messages=True,
+                    timeout=max(min(heartbeat, deadline - time.time()), 0))
+                if message is None:
+                    # Comment line - keeps proxies from closing the connection
+                    yield ': keep-alive\n\n'
+                elif message['type'] == 'message':
+                    yield _event(json.loads(message['data']))
+        except redis.exceptions.RedisError:
+            pass
+        finally:
+            pubsub.close()
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             # Stop nginx buffering the stream
+                             'X-Accel-Buffering': 'no'})
+
+
+def _subscribe(user_id):
+    try:
+        pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(Notification.channel(user_id))
+    except redis.exceptions.RedisError:
+        return None
+    return pubsub
+
+
+def _wait_for_notifications(pubsub, timeout):
+    deadline = time.time() + timeout
+    notifications = []
+    try:
+        while not notifications and time.time() < deadline:
+            message = pubsub.get_message(
+                ignore_subscribe_messages=True,
+                timeout=max(deadline - time.time(), 0))
+            # Pick up anything published along with it, then return
+            while message is not None:
+                if message['type'] == 'message':
+                    notifications.append(json.loads(message['data']))
+                message = pubsub.get_message(ignore_subscribe_messages=True)
+    except redis.exceptions.RedisError:
+        pass
+    return notifications
+
 
+def _event(data):
+    return f'id: {data["timestamp"]}\ndata: {json.dumps(data)}\n\n'
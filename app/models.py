@@ -1,8 +1,10 @@
 # Database models (provided by SQLAlchemy)
 # These models represent data (rows) in database via classes
 
-from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app import db, identity, login, popups
+from app.pagination import keyset_paginate
+from app.search import (document, index_changes, query_index,
+                        query_index_after, reindex_documents)
 import base64
 from datetime import datetime, timedelta
 from flask import current_app, url_for
@@ -14,65 +16,185 @@ import os
 import redis
 import rq
 from secrets import token_urlsafe
+from sqlalchemy.orm import make_transient_to_detached
 from time import time
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
 class SearchableMixin(object):
+    # Relationships to load along with search results
+    __search_eager__ = []
+
     @classmethod
     # Wraps search.query_index and replaces list of IDs with objects
-    def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
+    # With hydrate the objects are built straight from the search documents
+    # (see from_document) without touching the database, falling back to
+    # loading them if any of the documents can't be used
+    def search(cls, expression, page, per_page, hydrate=False):
+        hits, total = query_index(cls.__tablename__, expression, page,
+                                  per_page, fields=cls.__searchable__,
+                                  sources=hydrate)
+        if total == 0 or not hits:
+            return cls.query.filter_by(id=0), total
+        return cls._load_hits(hits, hydrate), total
+
+    @classmethod
+    # Cursor based version of search (see search.query_index_after) -
+    # returns a SearchPage with the objects as its items
+    def search_page(cls, expression, cursor, per_page, hydrate=False):
+        page = query_index_after(cls.__tablename__, expression, cursor,
+                                 per_page, fields=cls.__searchable__,
+                                 sources=hydrate)
+        if page.items:
+            page.items = list(cls._load_hits(page.items, hydrate))
+        return page
+
+    @classmethod
+    def _load_hits(cls, hits, hydrate):
+        if hydrate:
+            results = [cls.from_document(id, source) for id, source in hits]
+            if None not in results:
+                return results
+            ids = [id for id, source in hits]
+        else:
+            ids = hits
         when = []
         for i in range(len(ids)):
             when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(
-            db.case(when, value=cls.id)), total
+        query = cls.query.filter(cls.id.in_(ids)).order_by(
+            db.case(when, value=cls.id))
+        for name in cls.__search_eager__:
+            query = query.options(db.joinedload(getattr(cls, name)))
+        return query
+
+    # Fields kept in the search document (under 'stored') for displaying
+    # results - they aren't searched
+    def stored_fields(self):
+        return {}
 
     @classmethod
-    # Save db updates (they're lost after commit)
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    # Stand-in for a row built from its search document, or None if the
+    # document doesn't hold what's needed (e.g., it was indexed before the
+    # stored fields were added)
+    def from_document(cls, id, source):
+        return None
+
+    @classmethod
+    # Record index changes as each flush writes them - the objects are still
+    # loaded at this point, whereas after commit they're expired and reading
+    # them would take a query per object
+    # Several flushes in one transaction coalesce into the latest document
+    # (or None for a removal) per (index, id)
+    def after_flush(cls, session, flush_context):
+        changes = session.info.setdefault('search_changes', {})
+        # Building documents can load related rows (e.g., a post's author);
+        # flushing again from in here isn't allowed
+        with session.no_autoflush:
+            for obj in list(session.new) + list(session.dirty):
+                if isinstance(obj, SearchableMixin):
+                    changes[(obj.__tablename__, obj.id)] = document(obj)
+            for obj in session.deleted:
+                if isinstance(obj, SearchableMixin):
+                    changes[(obj.__tablename__, obj.id)] = None
+            for obj in session.dirty:
+                # Posts store their author's username and avatar - refresh them
+                # when either changes
+                if isinstance(obj, User) and any(
+                        db.inspect(obj).attrs[name].history.has_changes()
+                        for name in ('username', 'email')):
+                    for post in obj.posts:
+                        changes[(post.__tablename__, post.id)] = document(post)
 
     @classmethod
-    # After db commit, update elasticsearch indices:
+    # After db commit, hand the changes over to be indexed in bulk
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        changes = session.info.pop('search_changes', None)
+        if changes:
+            index_changes(changes)
 
     @classmethod
-    # Allows adding all entries from model to elasticsearch index
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    # Rolled back changes never reach the index
+    def after_rollback(cls, session):
+        session.info.pop('search_changes', None)
+
+    @classmethod
+    # (id, document) for each row in id order, read chunk_size rows at a time
+    # rather than loaded into the session all at once; start_after skips rows
+    # already indexed when resuming
+    # Each chunk is a separate query continuing from the last id (rather than
+    # one long running yield_per query) so no cursor is left open between
+    # chunks - on SQLite that would hold a lock blocking the writes made by
+    # the database search backend
+    def documents(cls, chunk_size=500, start_after=0):
+        last_id = start_after
+        while True:
+            chunk = cls.query.filter(cls.id > last_id).order_by(
+                cls.id).limit(chunk_size).all()
+            if not chunk:
+                return
+            for obj in chunk:
+                yield obj.id, document(obj)
+            last_id = chunk[-1].id
+
+    @classmethod
+    # Rebuild the search index for this model - see search.reindex_documents
+    def reindex(cls, chunk_size=500, start_after=0, **kwargs):
+        return reindex_documents(
+            cls.__tablename__, cls.documents(chunk_size, start_after),
+            chunk_size=chunk_size, **kwargs)
 
 
-# Leverage SQLAlchemy events to keep elasticsearch index up to date
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+# Leverage SQLAlchemy events to keep the search index up to date
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
+
+
+# A URL for endpoint with '{}' where its id goes, for str.format - building
+# URLs with url_for is slow compared to filling in a template
+URL_PLACEHOLDER = 987654321
+
+
+def url_template(endpoint, **kwargs):
+    url = url_for(endpoint, id=URL_PLACEHOLDER, **kwargs)
+    return url.replace('{', '{{').replace('}', '}}').replace(
+        str(URL_PLACEHOLDER), '{}')
 
 
 class PaginatedAPIMixin(object):
-    @staticmethod
+    @classmethod
     # endpoint and **kwargs are for url_for to generate next and prev info
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
-        resources = query.paginate(page, per_page, False)
+    # Passing a cursor (an empty string for the first page) switches to keyset
+    # pagination on the resource id - no OFFSET scans and the total count is
+    # skipped unless include_total is set
+    def to_collection_dict(cls, query, page, per_page, endpoint, cursor=None,
+                           include_total=False, **kwargs):
+        resources = cls.collection_page(query, page, per_page, cursor,
+                                        include_total)
+        return cls.collection_dict(resources, page, per_page, endpoint,
+                                   cursor, include_total, **kwargs)
+
+    @classmethod
+    # to_collection_dict in two steps - get the page, then represent it - so
+    # the API can tell from collection_version whether the client already has
+    # it before doing the work of representing it
+    def collection_page(cls, query, page, per_page, cursor=None,
+                        include_total=False):
+        if cursor is not None:
+            return keyset_paginate(query, [cls.id], cursor, per_page,
+                                   descending=False,
+                                   include_total=include_total)
+        return query.paginate(page, per_page, False)
+
+    @classmethod
+    def collection_dict(cls, resources, page, per_page, endpoint, cursor=None,
+                        include_total=False, **kwargs):
+        if cursor is not None:
+            return cls._cursor_collection_dict(
+                resources, cursor, per_page, endpoint, include_total,
+                **kwargs)
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': cls.to_collection_items(resources.items),
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -89,6 +211,42 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    @classmethod
+    # Changes whenever the representation of a page from collection_page
+    # would (for the same request) - made from its items' versions, which are
+    # cheap to get
+    def collection_version(cls, resources):
+        return (resources.total, resources.has_next, resources.has_prev,
+                [item.version() for item in resources.items])
+
+    @classmethod
+    # Representations of a page of items - models can override this to do the
+    # work for the whole page at once, it must give the same result
+    def to_collection_items(cls, items):
+        return [item.to_dict() for item in items]
+
+    @classmethod
+    def _cursor_collection_dict(cls, resources, cursor, per_page, endpoint,
+                                include_total, **kwargs):
+        meta = {'per_page': per_page, 'cursor': cursor}
+        if include_total:
+            meta['total_items'] = resources.total
+        data = {
+            'items': cls.to_collection_items(resources.items),
+            '_meta': meta,
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page,
+                                **kwargs),
+                'next': url_for(endpoint, cursor=resources.next_cursor,
+                                per_page=per_page, **kwargs)
+                if resources.has_next else None,
+                'prev': url_for(endpoint, cursor=resources.prev_cursor,
+                                per_page=per_page, **kwargs)
+                if resources.has_prev else None
+            }
+        }
+        return data
+
 
 # Auxiliary table to facilitate many-to-many relationship between follower
 # users and followed users
@@ -97,8 +255,15 @@ followers = db.Table(
     # Table name
     'followers',
     # Foreign keys
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    # Together they're the primary key - a user can only follow another user
+    # once and lookups by follower_id (followed, followed_posts,
+    # is_following) use the primary key index
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    # Reverse index for lookups by followed_id (followers, post fan out)
+    db.Index('ix_followers_followed_id', 'followed_id', 'follower_id')
 )
 
 
@@ -128,6 +293,9 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
     # Column unique - only one active token per user
     token = db.Column(db.String(50), index=True, unique=True)
     token_expiration = db.Column(db.DateTime)
+    # Signed API tokens hold the generation they were issued in - revoking
+    # moves on to the next one, so every earlier token stops working
+    token_generation = db.Column(db.Integer, default=0, server_default='0')
     # Dynamic list of users followed by this user
     followed = db.relationship(
         # User here is the right-side or followed users by class User
@@ -150,9 +318,18 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
                                         foreign_keys='Message.recipient_id',
                                         backref='recipient', lazy='dynamic')
     last_message_read_time = db.Column(db.DateTime)
+    # Messages received since last_message_read_time - incremented when a
+    # message is sent and reset when the messages page is viewed
+    unread_message_count = db.Column(db.Integer, default=0, server_default='0')
     notifications = db.relationship('Notification', backref='user',
                                     lazy='dynamic')
     tasks = db.relationship('Task', backref='user', lazy='dynamic')
+    # Denormalized counters so serializing or rendering a user doesn't need
+    # COUNT queries - maintained by follow(), unfollow() and the Post insert
+    # and delete events below (flask counters check can repair them)
+    post_count = db.Column(db.Integer, default=0, server_default='0')
+    follower_count = db.Column(db.Integer, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, default=0, server_default='0')
 
     def __repr__(self):
         return f'<User {self.username}>'
@@ -164,19 +341,56 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         return check_password_hash(self.password_hash, password)
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
+        return self.avatar_url(self.avatar_digest(), size)
+
+    # Gravatar identifies users by a hash of their email address
+    # A page of posts asks for the author's avatar once per post so remember
+    # the hash (until the email address changes)
+    def avatar_digest(self):
+        email = self.email.lower()
+        cached = getattr(self, '_avatar_digest', None)
+        if cached is None or cached[0] != email:
+            cached = (email, md5(email.encode('utf-8')).hexdigest())
+            self._avatar_digest = cached
+        return cached[1]
+
+    @staticmethod
+    def avatar_url(digest, size):
         return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
 
+    # Counters are updated with SQL expressions (count = count + 1) so
+    # concurrent follows don't overwrite each other, and they're part of the
+    # same transaction as the followers row
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.followed_count = User.followed_count + 1
+            user.follower_count = User.follower_count + 1
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.followed_count = User.followed_count - 1
+            user.follower_count = User.follower_count - 1
 
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        # return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        # Primary key lookup - no join to user and no need to count
+        return db.session.query(db.exists().where(db.and_(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == user.id))).scalar()
+
+    # How this user relates to the user called username, as their popup shows
+    # it - 'self', 'following' or 'not-following' - without loading them
+    def relationship(self, username):
+        if username == self.username:
+            return 'self'
+        followed_id = db.session.query(User.id).filter(
+            User.username == username).as_scalar()
+        following = db.session.query(db.exists().where(db.and_(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == followed_id))).scalar()
+        return 'following' if following else 'not-following'
 
     def followed_posts(self):
         # Get list of followed user posts sorted by post timestamp
@@ -185,7 +399,10 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         followed =  Post.query.join(followers, (followers.c.followed_id == Post.user_id)
                                    ).filter(followers.c.follower_id == self.id)
         # Add users own posts
-        return followed.union(self.posts).order_by(Post.timestamp.desc())
+        # Pages of posts show each post's author so load them in the same
+        # query rather than one query per author
+        return followed.union(self.posts).order_by(
+            Post.timestamp.desc()).options(db.joinedload(Post.author))
 
     def get_reset_password_token(self, expires_in=600):
         # jwt.encode creates a bytes object so convert it to a string
@@ -203,16 +420,35 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         return User.query.get(id)
 
     def new_messages(self):
+        # Denormalized counter - only count if it's never been set
+        if self.unread_message_count is not None:
+            return self.unread_message_count
+        return self.count_new_messages()
+
+    def count_new_messages(self):
         last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
         return Message.query.filter_by(recipient=self).filter(
             Message.timestamp > last_read_time).count()
 
+    # Call when a message to this user is added to the session
+    def message_received(self):
+        self.unread_message_count = User.unread_message_count + 1
+
+    def messages_read(self):
+        self.last_message_read_time = datetime.utcnow()
+        self.unread_message_count = 0
+
     def add_notification(self, name, data):
         # If user already has message notification count pending, delete it
         # so we can replace it
         self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
+        # Set timestamp here rather than at insert so it can be published
+        n = Notification(name=name, payload_json=json.dumps(data), user=self,
+                         timestamp=time())
         db.session.add(n)
+        # Push to the user's notification stream once committed
+        db.session.info.setdefault('notifications', []).append(
+            (self.id, n.to_dict()))
         return n
 
     def launch_task(self, name, description, *args, **kwargs):
@@ -228,11 +464,59 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         # Prefer to leave commits to higher level functions allowing several
         # updates in a single transaction (if desired)
         db.session.add(task)
+        task.set_progress(0)
         return task
 
     def get_tasks_in_progress(self):
         return Task.query.filter_by(user=self, complete=False).all()
 
+    # Tasks in progress as a list of (task, progress) for the banner shown on
+    # every page
+    # Progress is kept in a per-user Redis hash, so when no tasks are running
+    # (almost every page view) this is one HGETALL and no database query, and
+    # otherwise one query for the task descriptions
+    # The hash is only trusted once it's been checked against the database
+    # (it then holds Task.TRACKED) - tasks launched before progress was kept
+    # there, or whose progress couldn't be recorded, would be missing from it
+    def get_tasks_progress(self):
+        key = Task.progress_key(self.id)
+        try:
+            progress = current_app.redis.hgetall(key)
+        except redis.exceptions.RedisError:
+            # Fall back to asking rq about each task
+            return [(task, task.get_progress())
+                    for task in self.get_tasks_in_progress()]
+        progress = {id.decode('utf-8'): int(value)
+                    for id, value in progress.items()}
+        if Task.TRACKED not in progress:
+            tasks = [(task, task.get_progress())
+                     for task in self.get_tasks_in_progress()]
+            try:
+                pipe = current_app.redis.pipeline()
+                for task, task_progress in tasks:
+                    if task_progress < 100:
+                        pipe.hset(key, task.id, task_progress)
+                pipe.hset(key, Task.TRACKED, 1)
+                pipe.expire(key, Task.PROGRESS_TTL)
+                pipe.execute()
+            except redis.exceptions.RedisError:
+                pass
+            return tasks
+        del progress[Task.TRACKED]
+        if not progress:
+            return []
+        tasks = self.get_tasks_in_progress()
+        stale = set(progress) - set(task.id for task in tasks)
+        if stale:
+            # Tasks which finished without clearing their progress
+            try:
+                current_app.redis.hdel(Task.progress_key(self.id), *stale)
+            except redis.exceptions.RedisError:
+                pass
+        # Tasks whose progress couldn't be recorded in the hash
+        return [(task, progress[task.id] if task.id in progress
+                 else task.get_progress()) for task in tasks]
+
     def get_task_in_progress(self, name):
         # As design decision won't allow multiple tasks of same name running
         # at same time for same user so can use .first()
@@ -248,10 +532,10 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
             'username': self.username,
             'last_seen': self.last_seen.isoformat() + 'Z',
             'about_me': self.about_me,
-            # Where necessary do a database query
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
+            # Counters are denormalized onto the user row
+            'post_count': self.post_count,
+            'follower_count': self.follower_count,
+            'followed_count': self.followed_count,
             '_links': {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
@@ -263,6 +547,39 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
             data['email'] = self.email
         return data
 
+    @classmethod
+    # to_dict for a page of users - the links are filled into URL templates
+    # built once for the page rather than built by url_for for every user
+    # (the counts are columns so there's nothing more to query)
+    def to_collection_items(cls, users):
+        user_url = url_template('api.get_user')
+        followers_url = url_template('api.get_followers')
+        followed_url = url_template('api.get_followed')
+        avatar_url = cls.avatar_url
+        return [{
+            'id': user.id,
+            'username': user.username,
+            'last_seen': user.last_seen.isoformat() + 'Z',
+            'about_me': user.about_me,
+            'post_count': user.post_count,
+            'follower_count': user.follower_count,
+            'followed_count': user.followed_count,
+            '_links': {
+                'self': user_url.format(user.id),
+                'followers': followers_url.format(user.id),
+                'followed': followed_url.format(user.id),
+                'avatar': avatar_url(user.avatar_digest(), 128)
+            }
+        } for user in users]
+
+    # Everything to_dict shows comes from these columns, so it changes when
+    # they do (the API's ETags are made from this rather than the
+    # representation itself)
+    def version(self):
+        return (self.id, self.username, self.email, self.about_me,
+                self.last_seen, self.post_count, self.follower_count,
+                self.followed_count)
+
     # Accept JSON input and convert to object
     def from_dict(self, data, new_user=False):
         # These three are the only fields allowed to be set
@@ -286,8 +603,130 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         db.session.add(self)
         return self.token
 
+    # Raises RedisError (revoking nothing) if Redis can't be reached, as
+    # signed tokens could go on being accepted with the cached generation
     def revoke_token(self):
+        # Until the new generation is published (once committed) the cached
+        # one is replaced by a tombstone, so checks go to the database
+        current_app.redis.set(
+            User.token_generation_key(self.id), User.TOKEN_TOMBSTONE,
+            ex=User.TOKEN_TOMBSTONE_TTL)
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        self.token_generation = User.token_generation + 1
+        # Tell the servers checking signed tokens once committed
+        db.session.info.setdefault('token_revocations', set()).add(self.id)
+
+    # Signed (JWT) alternative to get_token - checking one doesn't need the
+    # database (see check_signed_token) and nothing is stored, so there's no
+    # need to commit
+    def get_signed_token(self, expires_in=3600):
+        return jwt.encode(
+                {'api': self.id, 'gen': self.token_generation or 0,
+                 'exp': time() + expires_in},
+                current_app.config['SECRET_KEY'],
+                algorithm='HS256').decode('utf-8')
+
+    @staticmethod
+    def check_signed_token(token):
+        try:
+            claims = jwt.decode(token, current_app.config['SECRET_KEY'],
+                                algorithms=['HS256'])
+            id = int(claims['api'])
+        except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+            return None
+        # Revoked
+        if claims.get('gen') != User.current_token_generation(id):
+            return None
+        # Usually from the cache of logged in users, without a query
+        return load_user(id)
+
+    # Users' token generations are cached in Redis - the database has the
+    # final say so revocations survive Redis losing its data
+    TOKEN_TOMBSTONE = b''
+    # Seconds a revocation's tombstone lasts - longer than it takes to commit
+    # it, and to fall back on if publishing the new generation fails
+    TOKEN_TOMBSTONE_TTL = 60
+
+    @staticmethod
+    def token_generation_key(id):
+        return f'token-generation:{id}'
+
+    @staticmethod
+    def current_token_generation(id):
+        key = User.token_generation_key(id)
+        try:
+            generation = current_app.redis.get(key)
+            if generation:
+                return int(generation)
+        except redis.exceptions.RedisError:
+            pass
+        generation = db.session.query(User.token_generation).filter(
+            User.id == id).scalar()
+        if generation is None:
+            return None
+        try:
+            # Only where there's nothing - a revocation (which overwrites,
+            # leaving a tombstone until it's committed) may have happened
+            # since we read the database
+            current_app.redis.set(
+                key, generation, nx=True,
+                ex=current_app.config['API_TOKEN_GENERATION_TTL'])
+        except redis.exceptions.RedisError:
+            pass
+        return generation
+
+    # Columns cached for loading the logged in user on each request - what
+    # every page uses (others, e.g., password_hash, are loaded if needed)
+    IDENTITY_FIELDS = ('username', 'email', 'about_me', 'last_seen',
+                       'last_message_read_time', 'unread_message_count')
+
+    def identity(self):
+        return {name: getattr(self, name) for name in self.IDENTITY_FIELDS}
+
+    @classmethod
+    # The user with columns from identity(), added to the session without a
+    # query as if it had been loaded
+    def from_identity(cls, id, columns):
+        key = db.inspect(cls).identity_key_from_primary_key([id])
+        user = db.session.identity_map.get(key)
+        if user is not None:
+            return user
+        user = cls(id=id, **columns)
+        # Columns not set are loaded from the database if they're used
+        make_transient_to_detached(user)
+        db.session.add(user)
+        # Same as a load from the database, e.g., last_seen shows newer values
+        # not written yet (see app/last_seen.py)
+        state = db.inspect(user)
+        state.manager.dispatch.load(state, None)
+        return user
+
+    # Count posts, followers and followed users straight from the source tables
+    # with one grouped query per relationship - returns
+    # {user_id: (post_count, follower_count, followed_count)} for user_ids
+    @staticmethod
+    def count_relationships(user_ids):
+        def grouped(column):
+            return dict(db.session.query(column, db.func.count()).filter(
+                column.in_(user_ids)).group_by(column))
+        posts = grouped(Post.user_id)
+        follower_counts = grouped(followers.c.followed_id)
+        followed_counts = grouped(followers.c.follower_id)
+        return {id: (posts.get(id, 0), follower_counts.get(id, 0),
+                     followed_counts.get(id, 0)) for id in user_ids}
+
+    # Count unread messages for user_ids with one grouped query - returns
+    # {user_id: unread_message_count}
+    @staticmethod
+    def count_unread_messages(user_ids):
+        counts = dict(db.session.query(
+            Message.recipient_id, db.func.count()).join(
+                User, User.id == Message.recipient_id).filter(
+                    Message.recipient_id.in_(user_ids),
+                    Message.timestamp > db.func.coalesce(
+                        User.last_message_read_time,
+                        datetime(1900, 1, 1))).group_by(Message.recipient_id))
+        return {id: counts.get(id, 0) for id in user_ids}
 
     @staticmethod
     def check_token(token):
@@ -303,7 +742,16 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
 # This decorator identifies this as the user loader function
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    # return User.query.get(int(id))
+    # Rebuild the user from cached columns when we can (see app/identity.py)
+    id = int(id)
+    columns = identity.get(id)
+    if columns is not None:
+        return User.from_identity(id, columns)
+    user = User.query.get(id)
+    if user is not None:
+        identity.store(id, user.identity())
+    return user
 
 
 class Post(SearchableMixin, db.Model):
@@ -321,10 +769,83 @@ class Post(SearchableMixin, db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     # Identify and store language of the post to potentially offer translation
     language = db.Column(db.String(5))
+    # Search results show the author so load them together
+    __search_eager__ = ['author']
 
     def __repr__(self):
         return f'<Post {self.body}>'
 
+    # Everything _post.html needs, so search results can be rendered from the
+    # search documents alone
+    def stored_fields(self):
+        return {'timestamp': self.timestamp.strftime(TIMESTAMP_FORMAT),
+                'language': self.language,
+                'username': self.author.username,
+                'avatar_digest': self.author.avatar_digest()}
+
+    @classmethod
+    def from_document(cls, id, source):
+        stored = source.get('stored') if source else None
+        if not stored:
+            return None
+        return PostView(
+            id=id, body=source['body'],
+            timestamp=datetime.strptime(stored['timestamp'], TIMESTAMP_FORMAT),
+            language=stored['language'],
+            author=UserView(stored['username'], stored['avatar_digest']))
+
+
+# How post timestamps are written in search documents
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+# Read-only stand-ins for search results rendered from search documents -
+# they have just what _post.html uses
+class UserView(object):
+    def __init__(self, username, avatar_digest):
+        self.username = username
+        self.digest = avatar_digest
+
+    def avatar_digest(self):
+        return self.digest
+
+    def avatar(self, size):
+        return User.avatar_url(self.digest, size)
+
+
+class PostView(object):
+    def __init__(self, id, body, timestamp, language, author):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.language = language
+        self.author = author
+
+    def __repr__(self):
+        return f'<PostView {self.body}>'
+
+
+# Keep User.post_count up to date - these run inside the flush so the counter
+# changes commit (or roll back) along with the post itself
+def _change_post_count(connection, user_id, delta):
+    if user_id is None:
+        return
+    connection.execute(User.__table__.update().where(
+        User.__table__.c.id == user_id).values(
+            post_count=User.__table__.c.post_count + delta))
+
+
+def post_inserted(mapper, connection, post):
+    _change_post_count(connection, post.user_id, 1)
+
+
+def post_deleted(mapper, connection, post):
+    _change_post_count(connection, post.user_id, -1)
+
+
+db.event.listen(Post, 'after_insert', post_inserted)
+db.event.listen(Post, 'after_delete', post_deleted)
+
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -332,6 +853,9 @@ class Message(db.Model):
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    # Index for listing and counting a user's messages newest first
+    __table_args__ = (db.Index('ix_message_recipient_id_timestamp',
+                               'recipient_id', 'timestamp'),)
 
     def __repr__(self):
         return '<Message {}>'.format(self.body)
@@ -348,6 +872,133 @@ class Notification(db.Model):
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    def to_dict(self):
+        return {'name': self.name, 'data': self.get_data(),
+                'timestamp': self.timestamp}
+
+    # Redis pub/sub channel notifications for a user are published on
+    @staticmethod
+    def channel(user_id):
+        return f'notifications:{user_id}'
+
+
+# Publish notifications added by add_notification() once they're committed -
+# subscribers (see main.notification_stream) get them immediately rather than
+# on their next poll.  If Redis is down they're still picked up by polling.
+def publish_notifications(session):
+    pending = session.info.pop('notifications', None)
+    if not pending:
+        return
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id, data in pending:
+            pipe.publish(Notification.channel(user_id), json.dumps(data))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Unable to publish notifications')
+
+
+def discard_notifications(session):
+    session.info.pop('notifications', None)
+
+
+db.event.listen(db.session, 'after_commit', publish_notifications)
+db.event.listen(db.session, 'after_rollback', discard_notifications)
+
+
+# User popups (see app/popups.py) show these - cached popups are dropped once
+# a change to any of them is committed
+POPUP_FIELDS = ('username', 'email', 'about_me', 'follower_count',
+                'followed_count')
+
+
+# Before the flush - counters are set to SQL expressions which are expired
+# (losing their history) as soon as they're written
+def record_stale_popups(session, flush_context, instances):
+    stale = session.info.setdefault('stale_popups', set())
+    with session.no_autoflush:
+        for obj in session.dirty:
+            if not isinstance(obj, User):
+                continue
+            attrs = db.inspect(obj).attrs
+            if any(attrs[name].history.has_changes()
+                   for name in POPUP_FIELDS):
+                stale.add(obj.username)
+                # The popup under the old username too
+                stale.update(attrs.username.history.deleted)
+
+
+def invalidate_popups(session):
+    stale = session.info.pop('stale_popups', None)
+    if stale:
+        popups.invalidate(stale)
+
+
+def discard_stale_popups(session):
+    session.info.pop('stale_popups', None)
+
+
+db.event.listen(db.session, 'before_flush', record_stale_popups)
+db.event.listen(db.session, 'after_commit', invalidate_popups)
+db.event.listen(db.session, 'after_rollback', discard_stale_popups)
+
+
+# Cached logged in users (see app/identity.py) are dropped once a change to
+# them is committed - new passwords, tokens, profile edits and so on
+def record_changed_identities(session, flush_context, instances):
+    changed = session.info.setdefault('changed_identities', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User) and session.is_modified(
+                obj, include_collections=False):
+            changed.add(obj.id)
+
+
+def invalidate_identities(session):
+    changed = session.info.pop('changed_identities', None)
+    if changed:
+        identity.invalidate(changed)
+
+
+def discard_changed_identities(session):
+    session.info.pop('changed_identities', None)
+
+
+db.event.listen(db.session, 'before_flush', record_changed_identities)
+db.event.listen(db.session, 'after_commit', invalidate_identities)
+db.event.listen(db.session, 'after_rollback', discard_changed_identities)
+
+
+# Once a token revocation is committed, put the users' new token generations
+# in Redis - read on a connection of their own as the session can't be used
+# after its commit
+# If that fails the tombstones revoke_token left keep checks going to the
+# database until they expire, then the new generations are cached from there
+def publish_token_generations(session):
+    ids = session.info.pop('token_revocations', None)
+    if not ids:
+        return
+    table = User.__table__
+    try:
+        with db.engine.connect() as connection:
+            generations = connection.execute(db.select(
+                [table.c.id, table.c.token_generation]).where(
+                    table.c.id.in_(ids))).fetchall()
+        pipe = current_app.redis.pipeline(transaction=False)
+        for id, generation in generations:
+            pipe.set(User.token_generation_key(id), generation,
+                     ex=current_app.config['API_TOKEN_GENERATION_TTL'])
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Unable to publish token revocations')
+
+
+def discard_token_revocations(session):
+    session.info.pop('token_revocations', None)
+
+
+db.event.listen(db.session, 'after_commit', publish_token_generations)
+db.event.listen(db.session, 'after_rollback', discard_token_revocations)
+
 
 class Task(db.Model):
     # Rather than using database generated integer id, use string id
@@ -371,3 +1022,27 @@ class Task(db.Model):
         job = self.get_rq_job()
         return job.meta.get('progress', 0) if job is not None else 100
 
+    # Redis hash of task id -> progress for a user's unfinished tasks, plus
+    # TRACKED once it's been checked against the database - it's checked
+    # again after PROGRESS_TTL seconds, so a task whose progress couldn't be
+    # recorded isn't left out of the banner for longer than that
+    TRACKED = 'tracked'
+    PROGRESS_TTL = 600
+
+    @staticmethod
+    def progress_key(user_id):
+        return f'task-progress:{user_id}'
+
+    # Track progress in the user's progress hash - finished tasks are removed
+    # so an empty hash means nothing is running
+    def set_progress(self, progress):
+        key = Task.progress_key(self.user_id or self.user.id)
+        try:
+            if progress >= 100:
+                current_app.redis.hdel(key, self.id)
+            else:
+                current_app.redis.hset(key, self.id, progress)
+        except redis.exceptions.RedisError:
+            current_app.logger.warning('Unable to record progress of task %s',
+                                       self.id)
+
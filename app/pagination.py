@@ -0,0 +1,111 @@
+# Keyset (cursor) pagination
+# query.paginate() uses LIMIT/OFFSET - the database still has to walk past
+# every skipped row so deep pages get slower and slower, and every page also
+# runs a COUNT(*) to work out the total.  Keyset pagination instead remembers
+# the sort key of the last row on a page (e.g. (timestamp, id) for posts) and
+# asks for rows after it, which an index can jump to directly no matter how
+# deep the page is.
+# Cursors are opaque to clients - they're just the sort key and direction
+# JSON encoded and then base64 encoded.
+from app import db
+import base64
+from datetime import datetime
+import json
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.strftime(DATETIME_FORMAT)}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        return datetime.strptime(value['dt'], DATETIME_FORMAT)
+    return value
+
+
+def encode_cursor(direction, values):
+    data = json.dumps({'d': direction,
+                       'k': [_encode_value(v) for v in values]},
+                      separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('utf-8')
+
+
+# Returns (direction, key values) or None if cursor is missing or invalid
+# An invalid cursor is treated as "start from the first page" rather than an
+# error - cursors are meant to be opaque so there's nothing a client can do
+# to fix one
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        direction = data['d']
+        values = [_decode_value(v) for v in data['k']]
+    except (ValueError, TypeError, KeyError):
+        return None
+    if direction not in ('next', 'prev'):
+        return None
+    return direction, values
+
+
+# Build "row comes after key" filter for lexicographic order on columns:
+# (a, b) > (x, y)  ==>  a > x OR (a = x AND b > y)
+# Written out rather than using a row value comparison so it works on every
+# database
+def _after(columns, values, descending):
+    clauses = []
+    for i, column in enumerate(columns):
+        terms = [columns[j] == values[j] for j in range(i)]
+        terms.append(column < values[i] if descending else column > values[i])
+        clauses.append(db.and_(*terms))
+    return db.or_(*clauses)
+
+
+class KeysetPage(object):
+    def __init__(self, items, columns, has_next, has_prev, total=None):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        # Only set when explicitly requested - counting is what we're trying
+        # to avoid
+        self.total = total
+        keys = [[getattr(item, column.key) for column in columns]
+                for item in (items[0], items[-1])] if items else None
+        self.next_cursor = encode_cursor('next', keys[1]) \
+            if has_next and keys else None
+        self.prev_cursor = encode_cursor('prev', keys[0]) \
+            if has_prev and keys else None
+
+
+# Return a page of query ordered by columns
+# columns must uniquely identify a row - e.g., (Post.timestamp, Post.id)
+# Any existing ordering on query is replaced
+def keyset_paginate(query, columns, cursor, per_page, descending=True,
+                    include_total=False):
+    total = query.order_by(None).count() if include_total else None
+    decoded = decode_cursor(cursor)
+    direction, values = decoded if decoded else ('next', None)
+    if values is not None and len(values) != len(columns):
+        direction, values = 'next', None
+    # Walking backwards - flip the ordering, then reverse results afterwards
+    reverse = direction == 'prev'
+    ordered_desc = descending != reverse
+    if values is not None:
+        query = query.filter(_after(columns, values, ordered_desc))
+    query = query.order_by(None).order_by(
+        *[c.desc() if ordered_desc else c.asc() for c in columns])
+    # Get one extra row to find out if there's another page
+    items = query.limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if reverse:
+        items.reverse()
+        return KeysetPage(items, columns, has_next=True, has_prev=more,
+                          total=total)
+    return KeysetPage(items, columns, has_next=more,
+                      has_prev=values is not None, total=total)
+
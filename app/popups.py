@@ -0,0 +1,63 @@
+# Cache of rendered user popups
+# The popup shown when hovering over a username is fetched on every mouseover.
+# What it shows depends on the user, how the viewer relates to them (it's
+# them, they follow them or they don't) and the locale, so one rendering is
+# kept in Redis for each combination, along with its ETag and when it was
+# rendered - browsers revalidate with If-None-Match/If-Modified-Since and get
+# a 304 when nothing has changed.
+# Entries are deleted when a change to anything a popup shows is committed
+# (see models.User) and otherwise expire after POPUP_CACHE_TTL seconds, which
+# limits how out of date "last seen" gets.
+# If Redis is unavailable popups are rendered for every request (but still
+# get an ETag).
+from app.fragments import template_version
+from flask import current_app, g
+from hashlib import sha1
+import json
+import redis
+import time
+
+TEMPLATE = 'user_popup.html'
+RELATIONSHIPS = ('self', 'following', 'not-following')
+
+
+def _key(username, relationship, locale):
+    return (f'user-popup:{template_version(TEMPLATE)}:{username}:'
+            f'{relationship}:{locale}')
+
+
+# Cached entry - {'html': ..., 'etag': ..., 'modified': seconds since epoch} -
+# or None
+def get(username, relationship):
+    try:
+        entry = current_app.redis.get(_key(username, relationship, g.locale))
+    except redis.exceptions.RedisError:
+        return None
+    return json.loads(entry) if entry else None
+
+
+# Cache html rendered for username and relationship, returning its entry
+def store(username, relationship, html):
+    entry = {'html': html,
+             'etag': sha1(html.encode('utf-8')).hexdigest(),
+             'modified': int(time.time())}
+    try:
+        current_app.redis.set(_key(username, relationship, g.locale),
+                              json.dumps(entry),
+                              ex=current_app.config['POPUP_CACHE_TTL'])
+    except redis.exceptions.RedisError:
+        pass
+    return entry
+
+
+# Drop the popups of usernames, for every relationship and locale
+def invalidate(usernames):
+    keys = [_key(username, relationship, locale)
+            for username in usernames for relationship in RELATIONSHIPS
+            for locale in current_app.config['LANGUAGES']]
+    if not keys:
+        return
+    try:
+        current_app.redis.delete(*keys)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Unable to invalidate user popups')
@@ -1,38 +0,0 @@
-# This module abstracts away elasticsearch
-# If we decide to switch out the search engine in the future, only this module
-# should have to be changed
-from flask import current_app
-
-
-# Add model to the full text search index
-def add_to_index(index, model):
-    # If no instance then bail
-    if not current_app.elasticsearch:
-        return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, doc_type=index, id=model.id,
-                                    body=payload)
-
-
-# Remove model from the full text search index
-def remove_from_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
-
-
-# Query the full text search index
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
-        return [], 0
-    search = current_app.elasticsearch.search(
-        index=index, doc_type=index,
-        # multi match query supports searching across multiple fields
-        # fields="*" says look in all fields
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']
-
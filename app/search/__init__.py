@@ -0,0 +1,410 @@
+# This package abstracts away the search engine
+# The rest of the app only uses the functions here, which hand off to the
+# backend picked by SEARCH_BACKEND:
+#   'elasticsearch' - an Elasticsearch server (ELASTICSEARCH_URL)
+#   'database'      - full text search built into the app's database: SQLite
+#                     FTS5 or Postgres tsvector
+#   'memory'        - a pure Python inverted index held by each process
+#   'none'          - search disabled
+# Left unset it's elasticsearch if ELASTICSEARCH_URL is set, otherwise
+# database (or memory if the database can't do full text search)
+# Backends provide apply(changes), query(index, query, page, per_page, ...),
+# query_after(index, query, after, size, ...) and reindex(index, rows, ...) -
+# see ElasticsearchBackend
+from app.pagination import decode_cursor, encode_cursor
+import atexit
+from flask import current_app
+from hashlib import sha1
+from itertools import islice
+import json
+import re
+import redis
+import threading
+
+# What counts as a word for backends which tokenize text themselves
+WORDS = re.compile(r'\w+')
+
+
+# Raised by searches when the search engine can't answer right now
+class SearchUnavailable(Exception):
+    pass
+
+
+# Choose the backend for an app
+def create_backend(app):
+    from app.search.database import DatabaseBackend
+    from app.search.es import ElasticsearchBackend
+    from app.search.memory import MemoryBackend
+
+    name = app.config['SEARCH_BACKEND'] or (
+        'elasticsearch' if app.elasticsearch else 'database')
+    if name == 'none':
+        return None
+    if name == 'elasticsearch':
+        return ElasticsearchBackend(app.elasticsearch) \
+            if app.elasticsearch else None
+    if name == 'database':
+        dialect = DatabaseBackend.supported(
+            app.config['SQLALCHEMY_DATABASE_URI'])
+        if dialect:
+            return DatabaseBackend(dialect)
+        name = 'memory'
+    if name == 'memory':
+        return MemoryBackend()
+    raise ValueError(f'Unknown SEARCH_BACKEND {name!r}')
+
+
+# Add model to the full text search index
+# Like every write these go through apply_changes, so cached results for the
+# index are invalidated too
+def add_to_index(index, model):
+    apply_changes({(index, model.id): document(model)})
+
+
+# Remove model from the full text search index
+def remove_from_index(index, model):
+    apply_changes({(index, model.id): None})
+
+
+# Query the full text search index
+# Returns a page of matching ids, best match first, and the number of matches
+# fields limits which document fields are searched (all searchable fields if
+# not given); with sources each id comes paired with its document
+# Results come from the result cache (below) when they can
+def query_index(index, query, page, per_page, fields=None, sources=False):
+    backend = current_app.search_backend
+    if not backend:
+        return [], 0
+    # Per process indexes may differ between processes - don't share them
+    cache = None if backend.in_process else ResultCache(
+        index, query, page, per_page, fields, sources)
+    cached, total = cache.lookup() if cache else (None, None)
+    if cached is not None:
+        hits = [tuple(hit) for hit in cached]
+    else:
+        # A cached total from another page of the query saves counting again
+        hits, total = backend.query(index, query, page, per_page, fields,
+                                    sources, total)
+        if cache:
+            cache.store(hits, total)
+    if not sources:
+        hits = [id for id, source in hits]
+    return hits, total
+
+
+# A page of results from query_index_after
+# total stops counting at SEARCH_TRACK_TOTAL_HITS - total_exact says whether
+# it got there
+class SearchPage(object):
+    def __init__(self, items, total, total_exact, next_cursor, prev_cursor):
+        self.items = items
+        self.total = total
+        self.total_exact = total_exact
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+# Cursor based alternative to query_index for paging deep into results
+# Rather than skipping over earlier results (from/offset), which gets slower
+# the deeper the page and is refused by Elasticsearch past max_result_window,
+# each page continues from the (score, id) sort key of the last result on the
+# page before (search_after) so every page costs the same as the first.
+# cursor is '' (or None) for the first page, otherwise a next_cursor or
+# prev_cursor of an earlier SearchPage; items are ids or (id, document) pairs
+# like query_index
+def query_index_after(index, query, cursor, per_page, fields=None,
+                      sources=False):
+    backend = current_app.search_backend
+    if not backend:
+        return SearchPage([], 0, True, None, None)
+    direction, after = decode_cursor(cursor) or ('next', None)
+    reverse = direction == 'prev'
+    limit = current_app.config['SEARCH_TRACK_TOTAL_HITS']
+    cache = None if backend.in_process else ResultCache(
+        index, query, ['cursor', cursor or ''], per_page, fields, sources,
+        limit)
+    cached, total = cache.lookup() if cache else (None, None)
+    if cached is not None:
+        rows = [tuple(row) for row in cached]
+    else:
+        # One extra to tell whether there's another page
+        rows, total = backend.query_after(index, query, after, per_page + 1,
+                                          fields, sources, reverse, limit,
+                                          total)
+        if cache:
+            cache.store(rows, total)
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if reverse:
+        # Fetched walking backwards from the cursor
+        rows.reverse()
+    if reverse:
+        # Came back from the page after this one
+        has_next, has_prev = True, more
+    else:
+        has_next, has_prev = more, after is not None
+    items = [(id, source) if sources else id for id, source, key in rows]
+    return SearchPage(
+        items, total, total < limit,
+        encode_cursor('next', rows[-1][2]) if has_next and rows else None,
+        encode_cursor('prev', rows[0][2]) if has_prev and rows else None)
+
+
+# Search result cache
+# Pages of results are kept in Redis for SEARCH_CACHE_TTL seconds under the
+# current generation of their index - a counter bumped whenever the index
+# changes, which makes everything cached for the index unreachable at once
+# (it then just expires).  At most SEARCH_CACHE_SIZE pages are cached per
+# generation of an index.  The number of matches is cached for each query as
+# well, so paging through results doesn't count them every time.
+# Redis being unavailable just means no caching.
+_CACHE_LOOKUP_SCRIPT = '''
+local generation = redis.call('GET', KEYS[1]) or '0'
+local prefix = ARGV[1] .. ':' .. generation .. ':'
+return {generation, redis.call('GET', prefix .. ARGV[2]),
+        redis.call('GET', prefix .. ARGV[3])}
+'''
+
+# Only cache if the generation hasn't moved on, and there's room
+_CACHE_STORE_SCRIPT = '''
+if (redis.call('GET', KEYS[1]) or '0') ~= ARGV[1] then
+    return 0
+end
+local prefix = ARGV[2] .. ':' .. ARGV[1] .. ':'
+local count = redis.call('INCR', prefix .. 'count')
+if count == 1 then
+    redis.call('EXPIRE', prefix .. 'count', ARGV[5])
+end
+if count > tonumber(ARGV[6]) then
+    return 0
+end
+redis.call('SET', prefix .. ARGV[3], ARGV[4], 'EX', ARGV[5])
+redis.call('SET', prefix .. 'total:' .. ARGV[7], ARGV[8], 'EX', ARGV[5])
+return 1
+'''
+
+
+# page can be anything that identifies the page (e.g., a cursor); totals
+# counted only as far as total_limit are kept apart from exact ones
+class ResultCache(object):
+    def __init__(self, index, query, page, per_page, fields, sources,
+                 total_limit=None):
+        self.index = index
+        # Case and spacing don't change the results
+        normalized = ' '.join(query.lower().split())
+        self.query_key = _digest([normalized, fields, total_limit])
+        self.page_key = _digest([normalized, fields, page, per_page,
+                                 sources])
+        self.generation = None
+
+    @staticmethod
+    def generation_key(index):
+        return f'search-generation:{index}'
+
+    # Returns (cached results or None, cached total or None)
+    def lookup(self):
+        if not current_app.config['SEARCH_CACHE_SIZE']:
+            return None, None
+        try:
+            reply = current_app.redis.register_script(_CACHE_LOOKUP_SCRIPT)(
+                keys=[self.generation_key(self.index)],
+                args=[f'search-cache:{self.index}', self.page_key,
+                      'total:' + self.query_key])
+        except redis.exceptions.RedisError:
+            return None, None
+        self.generation = reply[0]
+        results = json.loads(reply[1]) if reply[1] else None
+        total = int(reply[2]) if reply[2] else None
+        return results, total
+
+    def store(self, results, total):
+        if self.generation is None:
+            return
+        try:
+            current_app.redis.register_script(_CACHE_STORE_SCRIPT)(
+                keys=[self.generation_key(self.index)],
+                args=[self.generation, f'search-cache:{self.index}',
+                      self.page_key, json.dumps(results),
+                      current_app.config['SEARCH_CACHE_TTL'],
+                      current_app.config['SEARCH_CACHE_SIZE'],
+                      self.query_key, total])
+        except redis.exceptions.RedisError:
+            pass
+
+    # Make everything cached for these indexes stale
+    @classmethod
+    def invalidate(cls, indexes):
+        try:
+            pipe = current_app.redis.pipeline()
+            for index in indexes:
+                pipe.incr(cls.generation_key(index))
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            pass
+
+
+def _digest(value):
+    return sha1(json.dumps(value).encode('utf-8')).hexdigest()
+
+
+# Document stored in the index for a model
+# Fields the model keeps for displaying results are under 'stored' and aren't
+# searched
+def document(model):
+    payload = {}
+    for field in model.__searchable__:
+        payload[field] = getattr(model, field)
+    stored = model.stored_fields()
+    if stored:
+        payload['stored'] = stored
+    return payload
+
+
+# Searchable text of a document, for backends which index plain text
+def document_text(payload):
+    return ' '.join(str(value) for field, value in payload.items()
+                    if field != 'stored' and value is not None)
+
+
+# (id, document) pairs for every row of an index's table in id order - for
+# backends which need to (re)build an index from scratch
+def documents(index, **kwargs):
+    # Delayed import - models depends on this package
+    from app.models import SearchableMixin
+    for cls in SearchableMixin.__subclasses__():
+        if cls.__tablename__ == index:
+            return cls.documents(**kwargs)
+    raise ValueError(f'No searchable model for index {index!r}')
+
+
+# The index changes made by commits are applied in batches rather than with
+# one round trip per object inside the committing request
+# Changes are {(index, id): document} dictionaries - a document of None means
+# remove from the index - so repeated changes to the same object coalesce and
+# only its final state is sent
+# SEARCH_INDEX_MODE picks how they're applied:
+#   'sync'   - applied straight away, in the committing request (tests)
+#   'thread' - queued for a background thread in this process
+#   'rq'     - queued as a job for the rq worker
+# Backends which live in this process (memory) are always updated straight
+# away - they're cheap to update and a worker can't reach them
+def index_changes(changes):
+    backend = current_app.search_backend
+    if not backend or not changes:
+        return
+    mode = current_app.config['SEARCH_INDEX_MODE']
+    if backend.in_process:
+        mode = 'sync'
+    if mode == 'thread':
+        current_app.search_indexer.submit(changes)
+        return
+    if mode == 'rq':
+        try:
+            # rq job arguments need to be serializable - no tuple keys
+            current_app.task_queue.enqueue(
+                'app.tasks.index_documents',
+                [[index, id, document]
+                 for (index, id), document in changes.items()])
+            return
+        except redis.exceptions.RedisError:
+            # No queue - send them ourselves
+            pass
+    apply_changes(changes)
+
+
+# Apply changes to the index now
+# Search is secondary to the database write that made the changes so backends
+# log failures rather than raising them - reindexing can fix up the index
+# Returns the number of changes that failed
+# Cached results for the indexes changed are invalidated afterwards
+def apply_changes(changes):
+    if not current_app.search_backend:
+        return 0
+    failed = current_app.search_backend.apply(changes)
+    ResultCache.invalidate({index for index, id in changes})
+    return failed
+
+
+# In-process queue for the 'thread' mode
+# A daemon thread sends whatever has queued up every SEARCH_FLUSH_INTERVAL
+# seconds, or as soon as SEARCH_FLUSH_SIZE changes are waiting
+# The thread is started on first use so each worker process (e.g. after a
+# gunicorn fork) gets its own
+class SearchIndexer(object):
+    def __init__(self, app):
+        self.app = app
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        # Don't lose queued changes when the process exits cleanly
+        atexit.register(self.flush)
+
+    def submit(self, changes):
+        with self.lock:
+            self.pending.update(changes)
+            full = len(self.pending) >= self.app.config['SEARCH_FLUSH_SIZE']
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        if full:
+            self.wakeup.set()
+
+    # Send everything queued - returns number of changes sent
+    # If any fail (e.g., the server is down or the circuit breaker is open)
+    # the batch is queued again for the next flush - indexing and deleting
+    # can be repeated safely - unless the queue has grown past
+    # SEARCH_REQUEUE_LIMIT, when they're dropped and the index needs
+    # rebuilding (flask search reindex)
+    def flush(self):
+        with self.lock:
+            changes, self.pending = self.pending, {}
+        if changes:
+            with self.app.app_context():
+                failed = apply_changes(changes)
+            if failed:
+                self._requeue(changes)
+        return len(changes)
+
+    def _requeue(self, changes):
+        with self.lock:
+            # Changes queued since are newer
+            requeued = dict(changes)
+            requeued.update(self.pending)
+            if len(requeued) > self.app.config['SEARCH_REQUEUE_LIMIT']:
+                indexes = sorted({index for index, id in changes})
+                self.app.logger.error(
+                    f'Dropped {len(changes)} search index changes - '
+                    f'reindex {", ".join(indexes)} once search is back')
+                return
+            self.pending = requeued
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.app.config['SEARCH_FLUSH_INTERVAL'])
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Keep the thread alive whatever happens
+                self.app.logger.exception('Search indexer flush failed')
+
+
+# Rebuild an index from rows - (id, document) pairs in ascending id order -
+# without taking search offline; returns the name of the new index
+# checkpoint(version, last_id, count) is called as rows are stored, and
+# passing version back in with the rows after last_id resumes a rebuild
+def reindex_documents(index, rows, **kwargs):
+    version = current_app.search_backend.reindex(index, rows, **kwargs)
+    ResultCache.invalidate([index])
+    return version
+
+
+# Split an iterable into lists of up to size items
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
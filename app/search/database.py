@@ -0,0 +1,217 @@
+# Search using the full text search built into the app's database, so small
+# sites don't need a separate search server
+# Each index is a table named search_<index> holding the id, the searchable
+# fields joined together as text, and the whole document as JSON (source):
+#   SQLite   - an FTS5 virtual table (rowid is the id), ranked with bm25
+#   Postgres - a tsvector column with a GIN index, ranked with ts_rank
+# Tables are created on first use; "flask search reindex" fills them from
+# existing rows.
+# Like Elasticsearch's multi_match a document matches if it contains any of
+# the words searched for, with the best matches first.
+from app import db
+from app.search import WORDS, chunks, document_text
+from flask import current_app
+import json
+import re
+import sqlite3
+from sqlalchemy.engine.url import make_url
+import time
+
+
+class DatabaseBackend(object):
+    # Changes are written to the database, shared by every process
+    in_process = False
+
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.created = set()
+
+    # Dialect name if the database at uri supports full text search
+    @staticmethod
+    def supported(uri):
+        dialect = make_url(uri).get_backend_name()
+        if dialect == 'postgresql':
+            return dialect
+        if dialect == 'sqlite':
+            # FTS5 is an optional SQLite module
+            try:
+                sqlite3.connect(':memory:').execute(
+                    'CREATE VIRTUAL TABLE search USING fts5(text)')
+                return dialect
+            except sqlite3.OperationalError:
+                pass
+        return None
+
+    # Returns the number of changes that failed
+    def apply(self, changes):
+        try:
+            with db.engine.begin() as connection:
+                for index in {index for index, id in changes}:
+                    table = self._table(connection, index)
+                    self._write(connection, table, [
+                        (id, payload)
+                        for (name, id), payload in changes.items()
+                        if name == index])
+        except Exception:
+            current_app.logger.exception('Unable to update search index')
+            return len(changes)
+        return 0
+
+    def query(self, index, query, page, per_page, fields=None,
+              sources=False, total=None):
+        words = WORDS.findall(query)
+        if not words:
+            return [], 0
+        source = 'source' if sources else 'NULL'
+        with db.engine.connect() as connection:
+            table = self._table(connection, index)
+            if self.dialect == 'sqlite':
+                # Quote each word so nothing typed is taken as FTS5 syntax
+                match = ' OR '.join(f'"{word}"' for word in words)
+                rows = connection.execute(db.text(
+                    f'SELECT rowid, {source} FROM {table} WHERE {table} '
+                    f'MATCH :match ORDER BY rank, rowid DESC '
+                    f'LIMIT :limit OFFSET :offset'),
+                    match=match, limit=per_page,
+                    offset=(page - 1) * per_page).fetchall()
+                if total is None:
+                    total = connection.execute(db.text(
+                        f'SELECT count(*) FROM {table} WHERE {table} '
+                        f'MATCH :match'), match=match).scalar()
+            else:
+                match = ' | '.join(f"'{word}'" for word in words)
+                rows = connection.execute(db.text(
+                    f"SELECT id, {source} FROM {table}, "
+                    f"to_tsquery('simple', :match) AS query "
+                    f"WHERE document @@ query ORDER BY "
+                    f"ts_rank(document, query) DESC, id DESC "
+                    f"LIMIT :limit OFFSET :offset"),
+                    match=match, limit=per_page,
+                    offset=(page - 1) * per_page).fetchall()
+                if total is None:
+                    total = connection.execute(db.text(
+                        f"SELECT count(*) FROM {table} WHERE document @@ "
+                        f"to_tsquery('simple', :match)"),
+                        match=match).scalar()
+        return [(id, json.loads(source) if source else None)
+                for id, source in rows], total
+
+    # Up to size hits after the sort key after, best first - or in reverse,
+    # the ones before it, worst first
+    # Keys are (score, id); matches are counted no further than limit
+    def query_after(self, index, query, after, size, fields=None,
+                    sources=False, reverse=False, limit=10000, total=None):
+        words = WORDS.findall(query)
+        if not words:
+            return [], 0
+        source = 'source' if sources else 'NULL'
+        # bm25 is lower for better matches, ts_rank higher
+        if self.dialect == 'sqlite':
+            further, best_first = '>', 'ASC'
+        else:
+            further, best_first = '<', 'DESC'
+        # Onwards from the cursor is worse matches and lower ids - or walking
+        # back, better matches and higher ids
+        score_order, id_further, id_order = best_first, '<', 'DESC'
+        if reverse:
+            further = '<' if further == '>' else '>'
+            score_order = 'DESC' if best_first == 'ASC' else 'ASC'
+            id_further, id_order = '>', 'ASC'
+        with db.engine.connect() as connection:
+            table = self._table(connection, index)
+            if self.dialect == 'sqlite':
+                match = ' OR '.join(f'"{word}"' for word in words)
+                matches = (f'SELECT rowid AS id, {source} AS source, '
+                           f'bm25({table}) AS score FROM {table} '
+                           f'WHERE {table} MATCH :match')
+                counted = (f'SELECT 1 FROM {table} WHERE {table} '
+                           f'MATCH :match LIMIT :limit')
+            else:
+                match = ' | '.join(f"'{word}'" for word in words)
+                # ts_rank is a real (float4) - as a double precision the
+                # score survives the round trip through the cursor exactly,
+                # so comparing against it finds the cursor row again
+                matches = (f"SELECT id, {source} AS source, "
+                           f"CAST(ts_rank(document, query) AS double "
+                           f"precision) AS score "
+                           f"FROM {table}, to_tsquery('simple', :match) "
+                           f"AS query WHERE document @@ query")
+                counted = (f"SELECT 1 FROM {table} WHERE document @@ "
+                           f"to_tsquery('simple', :match) LIMIT :limit")
+            condition = ''
+            parameters = {'match': match, 'size': size}
+            if after:
+                condition = (f'WHERE score {further} :score OR '
+                             f'(score = :score AND id {id_further} :id)')
+                parameters.update(score=after[0], id=after[1])
+            rows = connection.execute(db.text(
+                f'SELECT id, source, score FROM ({matches}) AS matches '
+                f'{condition} ORDER BY score {score_order}, id {id_order} '
+                f'LIMIT :size'), **parameters).fetchall()
+            if total is None:
+                total = connection.execute(db.text(
+                    f'SELECT count(*) FROM ({counted}) AS counted'),
+                    match=match, limit=limit).scalar()
+        return [(id, json.loads(source) if source else None, [score, id])
+                for id, source, score in rows], total
+
+    # Fill a new table (search_<index>_v<timestamp>) then swap it in place of
+    # the current one in a single transaction
+    def reindex(self, index, rows, chunk_size=500, workers=None,
+                version=None, checkpoint=None):
+        version = version or f'{index}_v{int(time.time())}'
+        with db.engine.begin() as connection:
+            new_table = self._table(connection, version)
+        for chunk in chunks(rows, chunk_size):
+            with db.engine.begin() as connection:
+                self._write(connection, new_table, chunk)
+            if checkpoint:
+                checkpoint(version, chunk[-1][0], len(chunk))
+        table = 'search_' + index
+        with db.engine.begin() as connection:
+            connection.execute(f'DROP TABLE IF EXISTS {table}')
+            connection.execute(f'ALTER TABLE {new_table} RENAME TO {table}')
+        self.created.discard(new_table)
+        self.created.add(table)
+        return version
+
+    # Name of the table for an index, creating it if need be
+    def _table(self, connection, index):
+        if not re.fullmatch(r'\w+', index):
+            raise ValueError(f'Bad index name {index!r}')
+        table = 'search_' + index
+        if table in self.created:
+            return table
+        if self.dialect == 'sqlite':
+            connection.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {table} '
+                               f'USING fts5(text, source UNINDEXED)')
+        else:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                               f'(id integer PRIMARY KEY, '
+                               f'document tsvector NOT NULL, source text)')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS '
+                               f'ix_{table}_document ON {table} '
+                               f'USING gin (document)')
+        self.created.add(table)
+        return table
+
+    # Replace the documents for the given ids - a document of None just
+    # removes it
+    def _write(self, connection, table, documents):
+        key = 'rowid' if self.dialect == 'sqlite' else 'id'
+        connection.execute(
+            db.text(f'DELETE FROM {table} WHERE {key} = :id'),
+            [{'id': id} for id, payload in documents])
+        rows = [{'id': id, 'text': document_text(payload),
+                 'source': json.dumps(payload)}
+                for id, payload in documents if payload is not None]
+        if not rows:
+            return
+        if self.dialect == 'sqlite':
+            statement = (f'INSERT INTO {table} (rowid, text, source) '
+                         f'VALUES (:id, :text, :source)')
+        else:
+            statement = (f"INSERT INTO {table} (id, document, source) VALUES "
+                         f"(:id, to_tsvector('simple', :text), :source)")
+        connection.execute(db.text(statement), rows)
+
@@ -0,0 +1,386 @@
+# Search backed by an Elasticsearch server
+from app.search import SearchUnavailable, chunks
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import Elasticsearch, Transport, helpers
+from elasticsearch.exceptions import (ConnectionError, ConnectionTimeout,
+                                      NotFoundError, TransportError)
+from flask import current_app
+import logging
+import random
+import threading
+import time
+
+
+class ElasticsearchBackend(object):
+    # Changes are sent to the server, not kept in this process
+    in_process = False
+
+    def __init__(self, client):
+        self.es = client
+        # Major version of the server, asked for when first needed
+        self.major_version = None
+
+    # Send changes with the bulk API, SEARCH_FLUSH_SIZE at a time
+    # Doesn't return until the changes are searchable (refresh='wait_for'),
+    # so searches cached after apply_changes invalidates the results cache
+    # can't hold what was there before
+    # Returns the number of changes that failed
+    def apply(self, changes):
+        actions = []
+        for (index, id), payload in changes.items():
+            action = {'_index': index, '_type': index, '_id': id}
+            if payload is None:
+                action['_op_type'] = 'delete'
+            else:
+                action['_op_type'] = 'index'
+                action['_source'] = _document(id, payload)
+            actions.append(action)
+        errors = 0
+        try:
+            for ok, item in helpers.streaming_bulk(
+                    self.es, actions,
+                    chunk_size=current_app.config['SEARCH_FLUSH_SIZE'],
+                    raise_on_error=False, raise_on_exception=False,
+                    refresh='wait_for'):
+                # Deleting something that was never indexed isn't an error
+                if not ok and item.get('delete', {}).get('status') != 404:
+                    errors += 1
+        except Exception:
+            current_app.logger.exception('Unable to update search index')
+            return len(actions)
+        if errors:
+            current_app.logger.error(f'{errors} of {len(actions)} search '
+                                     f'index updates failed')
+        return errors
+
+    # Elasticsearch counts matches as part of the search so total isn't used
+    def query(self, index, query, page, per_page, fields=None,
+              sources=False, total=None):
+        search = self._search(
+            index,
+            # multi match query supports searching across multiple fields
+            # fields="*" says look in all fields
+            body={'query': {'multi_match': {'query': query,
+                                            'fields': fields or ['*']}},
+                  '_source': sources,
+                  'from': (page - 1) * per_page, 'size': per_page})
+        if search is None:
+            return [], 0
+        hits = [(int(hit['_id']), hit.get('_source'))
+                for hit in search['hits']['hits']]
+        return hits, _total(search)
+
+    # Up to size hits after the sort key after, best first - or in reverse,
+    # the ones before it, worst first
+    # Hits are sorted on (score, id) so every hit has a distinct sort key -
+    # on the id field stored in each document, as sorting on _id is
+    # deprecated in 7.0 and not allowed by default from 8.0
+    # Matches are only counted up to limit (track_total_hits) - servers before
+    # 7.0 reject track_total_hits and always count every match
+    def query_after(self, index, query, after, size, fields=None,
+                    sources=False, reverse=False, limit=10000, total=None):
+        order = 'asc' if reverse else 'desc'
+        body = {'query': {'multi_match': {'query': query,
+                                          'fields': fields or ['*']}},
+                '_source': sources, 'size': size,
+                'sort': [{'_score': order},
+                         {'id': {'order': order, 'unmapped_type': 'long'}}]}
+        if self._server_version() >= 7:
+            body['track_total_hits'] = limit
+        if after:
+            body['search_after'] = after
+        search = self._search(index, body)
+        if search is None:
+            return [], 0
+        rows = [(int(hit['_id']), hit.get('_source'), hit['sort'])
+                for hit in search['hits']['hits']]
+        return rows, min(_total(search), limit)
+
+    # Major version of the server - 6 (what requirements.txt installs the
+    # client for) if it can't be asked, and asked again next time
+    def _server_version(self):
+        if self.major_version is None:
+            try:
+                number = self.es.info()['version']['number']
+                self.major_version = int(number.split('.')[0])
+            except (TransportError, KeyError, TypeError, ValueError):
+                return 6
+        return self.major_version
+
+    # Search response, or None if the index doesn't exist yet (nothing has
+    # been indexed)
+    # Failures searching - the server is down, struggling or the circuit
+    # breaker is open - raise SearchUnavailable so the page can say so
+    def _search(self, index, body):
+        try:
+            return self.es.search(index=index, doc_type=index, body=body)
+        except NotFoundError:
+            return None
+        except TransportError as e:
+            current_app.logger.warning(f'Search failed: {e}')
+            raise SearchUnavailable() from e
+
+    # Documents go into a new versioned index (e.g., post-v1545400000) in bulk
+    # requests of chunk_size sent by a pool of worker threads, then the index
+    # name is switched over to the new index as an alias in one atomic step
+    # and the old index is deleted.
+    # Chunks complete out of order so checkpoint is only called once every
+    # earlier chunk is stored too, which makes last_id a safe place to resume
+    # from.
+    # Changes committed while a rebuild is running go to the old index; edits
+    # to rows which have already been copied need the rebuild re-run to be
+    # picked up.
+    def reindex(self, index, rows, chunk_size=500, workers=4, version=None,
+                checkpoint=None):
+        if version is None:
+            version = f'{index}-v{int(time.time())}'
+            # No refreshes while loading - much faster bulk indexing
+            # Stored fields are only for display so needn't be indexed, and
+            # the id is only for sorting
+            self.es.indices.create(index=version, body={
+                'settings': {'index': {'refresh_interval': '-1'}},
+                'mappings': {index: {'properties': {
+                    'id': {'type': 'long', 'index': False},
+                    'stored': {'type': 'object', 'enabled': False}}}}})
+        in_flight = deque()
+
+        def complete():
+            future, last_id, count = in_flight.popleft()
+            # Raises if the chunk failed, before checkpointing past it
+            future.result()
+            if checkpoint:
+                checkpoint(version, last_id, count)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for chunk in chunks(rows, chunk_size):
+                actions = [{'_index': version, '_type': index, '_id': id,
+                            '_source': _document(id, payload)}
+                           for id, payload in chunk]
+                in_flight.append((pool.submit(helpers.bulk, self.es, actions,
+                                              chunk_size=len(actions)),
+                                  chunk[-1][0], len(chunk)))
+                # Limit the number of chunks held in memory
+                if len(in_flight) > workers * 2:
+                    complete()
+                while in_flight and in_flight[0][0].done():
+                    complete()
+            while in_flight:
+                complete()
+        self.es.indices.put_settings(
+            index=version, body={'index': {'refresh_interval': '1s'}})
+        self.es.indices.refresh(index=version)
+        self._switch_alias(index, version)
+        return version
+
+    # Point alias at index, removing whatever it referred to before
+    def _switch_alias(self, alias, index):
+        actions = []
+        old = []
+        if self.es.indices.exists_alias(name=alias):
+            old = [name for name in self.es.indices.get_alias(name=alias)
+                   if name != index]
+            actions += [{'remove': {'index': name, 'alias': alias}}
+                        for name in old]
+        elif self.es.indices.exists(index=alias):
+            # Index created before aliases were used - it has to be removed
+            # in the same step as the alias is added, as they share a name
+            actions.append({'remove_index': {'index': alias}})
+        actions.append({'add': {'index': index, 'alias': alias}})
+        self.es.indices.update_aliases(body={'actions': actions})
+        for name in old:
+            self.es.indices.delete(index=name)
+
+
+# Document sent to the server for a row - its id is stored as a field too, to
+# sort on
+def _document(id, payload):
+    return dict(payload, id=id)
+
+
+# Number of matches in a search response - from 7.0 servers give it as
+# {'value': n, 'relation': 'eq' or 'gte'}
+def _total(search):
+    total = search['hits']['total']
+    if isinstance(total, dict):
+        return total['value']
+    return total
+
+
+# Client for an app's ELASTICSEARCH_URL which copes with a struggling cluster
+# rather than tying up workers:
+# - each request gets a timeout for its kind of operation (searches should
+#   give up long before bulk indexing does)
+# - failed requests are retried a bounded number of times, after a random
+#   (jittered) backoff so workers don't all retry in step
+# - a circuit breaker stops sending requests for a while after repeated
+#   failures, so they fail straight away instead of waiting out timeouts
+# - connections are pooled, up to ELASTICSEARCH_POOL_SIZE per host
+# The breaker and counters are per process - see ResilientTransport.metrics()
+def create_client(app):
+    config = app.config
+    return Elasticsearch(
+        [config['ELASTICSEARCH_URL']], transport_class=ResilientTransport,
+        maxsize=config['ELASTICSEARCH_POOL_SIZE'],
+        timeouts={'search': config['ELASTICSEARCH_SEARCH_TIMEOUT'],
+                  'bulk': config['ELASTICSEARCH_BULK_TIMEOUT'],
+                  'default': config['ELASTICSEARCH_TIMEOUT']},
+        retries=config['ELASTICSEARCH_RETRIES'],
+        backoff=config['ELASTICSEARCH_RETRY_BACKOFF'],
+        breaker=CircuitBreaker(config['ELASTICSEARCH_BREAKER_THRESHOLD'],
+                               config['ELASTICSEARCH_BREAKER_RESET'],
+                               app.logger))
+
+
+# Raised instead of sending a request while the circuit breaker is open
+# It's a ConnectionError so code already handling an unreachable server
+# handles it too
+class CircuitOpenError(ConnectionError):
+    def __init__(self):
+        super().__init__('N/A', 'Circuit breaker open - not sending request',
+                         None)
+
+
+# Counts consecutive failed requests (each retry counts) - after threshold of
+# them the breaker opens and requests are refused for reset_after seconds, then
+# one trial request is let through (half open); if it succeeds the breaker
+# closes again, otherwise it goes back to open
+class CircuitBreaker(object):
+    def __init__(self, threshold, reset_after, logger=None):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.times_opened = 0
+
+    # Whether a request may be sent now
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and \
+                    time.time() - self.opened_at >= self.reset_after:
+                self.state = 'half-open'
+            if self.state == 'half-open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def succeeded(self):
+        with self.lock:
+            if self.state != 'closed':
+                self.logger.info('Elasticsearch circuit breaker closed')
+            self.state = 'closed'
+            self.failures = 0
+            self.trial_running = False
+
+    # A request let through ended without saying how the server is doing
+    # (something unexpected was raised) - let another trial through
+    def finished(self):
+        with self.lock:
+            self.trial_running = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == 'half-open' or (
+                    self.state == 'closed' and
+                    self.failures >= self.threshold):
+                if self.state == 'closed':
+                    self.times_opened += 1
+                    self.logger.warning(
+                        f'Elasticsearch circuit breaker opened after '
+                        f'{self.failures} failures')
+                self.state = 'open'
+                self.opened_at = time.time()
+
+
+# Statuses worth retrying - the server is overloaded or restarting
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class ResilientTransport(Transport):
+    def __init__(self, hosts, timeouts=None, retries=2, backoff=0.1,
+                 breaker=None, **kwargs):
+        # Retries are done here, with backoff, rather than straight away by
+        # the base class
+        kwargs['max_retries'] = 0
+        super().__init__(hosts, **kwargs)
+        self.pool_size = kwargs.get('maxsize')
+        self.timeouts = timeouts or {}
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker(5, 30)
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def perform_request(self, method, url, headers=None, params=None,
+                        body=None):
+        params = dict(params or {})
+        params.setdefault('request_timeout', self._timeout(url))
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                self._count('short_circuited')
+                raise CircuitOpenError()
+            if attempt:
+                self._count('retries')
+            self._count('requests')
+            error = None
+            try:
+                # The base class pops request_timeout, so each try gets a
+                # copy
+                result = super().perform_request(method, url, headers,
+                                                 dict(params), body)
+            except ConnectionTimeout as e:
+                self._count('timeouts')
+                error = e
+            except ConnectionError as e:
+                self._count('connection_errors')
+                error = e
+            except TransportError as e:
+                if e.status_code not in RETRY_STATUSES:
+                    # The server answered (e.g., 404) - it's working
+                    self.breaker.succeeded()
+                    raise
+                self._count('server_errors')
+                error = e
+            else:
+                self.breaker.succeeded()
+                return result
+            finally:
+                if error is not None:
+                    self.breaker.failed()
+                else:
+                    self.breaker.finished()
+            if attempt < self.retries:
+                # Full jitter exponential backoff
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+        self._count('failures')
+        raise error
+
+    # Snapshot of the breaker state and request counters for this process
+    def metrics(self):
+        with self.lock:
+            metrics = dict(self.counts)
+        metrics.update(state=self.breaker.state,
+                       consecutive_failures=self.breaker.failures,
+                       times_opened=self.breaker.times_opened,
+                       pool_size=self.pool_size)
+        return metrics
+
+    def _timeout(self, url):
+        path = url.split('?')[0]
+        if path.endswith('/_search'):
+            return self.timeouts.get('search', self.timeouts.get('default'))
+        if path.endswith('/_bulk'):
+            return self.timeouts.get('bulk', self.timeouts.get('default'))
+        return self.timeouts.get('default')
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
@@ -0,0 +1,173 @@
+# Search with a pure Python inverted index, for when there's no search server
+# and the database can't do full text search
+# The index is held by each process and built from the database the first
+# time it's searched.  Changes are applied as they're committed, but only to
+# the process that committed them - fine for development and single process
+# deployments, other processes only see them once they restart.
+from app.search import WORDS, document_text, documents
+from array import array
+from bisect import bisect_left
+from collections import Counter
+import heapq
+import math
+import threading
+
+
+class MemoryBackend(object):
+    # Nothing outside this process can update it
+    in_process = True
+
+    def __init__(self):
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def apply(self, changes):
+        with self.lock:
+            for (index, id), payload in changes.items():
+                # Not built yet - it'll pick the change up from the database
+                if index not in self.indexes:
+                    continue
+                if payload is None:
+                    self.indexes[index].remove(id)
+                else:
+                    self.indexes[index].add(id, payload)
+        return 0
+
+    def query(self, index, query, page, per_page, fields=None,
+              sources=False, total=None):
+        with self.lock:
+            inverted = self._index(index)
+            ids, total = inverted.search(query, page, per_page)
+            return [(id, inverted.sources.get(id) if sources else None)
+                    for id in ids], total
+
+    def query_after(self, index, query, after, size, fields=None,
+                    sources=False, reverse=False, limit=10000, total=None):
+        with self.lock:
+            inverted = self._index(index)
+            ranked, total = inverted.search_after(query, after, size,
+                                                  reverse)
+            return [(id, inverted.sources.get(id) if sources else None,
+                     [score, id]) for id, score in ranked], min(total, limit)
+
+    def reindex(self, index, rows, chunk_size=500, workers=None, version=None,
+                checkpoint=None):
+        def counted():
+            count = 0
+            for id, payload in rows:
+                yield id, payload
+                count += 1
+                if checkpoint and count == chunk_size:
+                    checkpoint(index, id, count)
+                    count = 0
+            if checkpoint and count:
+                checkpoint(index, id, count)
+
+        built = self._build(counted())
+        with self.lock:
+            self.indexes[index] = built
+        return index
+
+    # Index built from the database the first time it's needed
+    def _index(self, index):
+        if index not in self.indexes:
+            self.indexes[index] = self._build(documents(index))
+        return self.indexes[index]
+
+    @staticmethod
+    def _build(rows):
+        inverted = InvertedIndex()
+        for id, payload in rows:
+            inverted.add(id, payload)
+        return inverted
+
+
+# Postings are kept compact: for each term an array of the ids containing it,
+# in id order, with a parallel array of how often it occurs in each
+# Matches are ranked with BM25
+class InvertedIndex(object):
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.ids = {}
+        self.frequencies = {}
+        # Per document: number of terms, and the distinct terms (needed to
+        # remove it again)
+        self.lengths = {}
+        self.terms = {}
+        self.total_length = 0
+        # Documents as indexed, to return with results
+        self.sources = {}
+
+    def add(self, id, payload):
+        self.remove(id)
+        self.sources[id] = payload
+        words = WORDS.findall(document_text(payload).lower())
+        counts = Counter(words)
+        for term, count in counts.items():
+            ids = self.ids.setdefault(term, array('I'))
+            frequencies = self.frequencies.setdefault(term, array('H'))
+            i = bisect_left(ids, id)
+            ids.insert(i, id)
+            frequencies.insert(i, min(count, 0xffff))
+        self.lengths[id] = len(words)
+        self.terms[id] = tuple(counts)
+        self.total_length += len(words)
+
+    def remove(self, id):
+        self.sources.pop(id, None)
+        for term in self.terms.pop(id, ()):
+            ids = self.ids[term]
+            i = bisect_left(ids, id)
+            del ids[i]
+            del self.frequencies[term][i]
+            if not ids:
+                del self.ids[term]
+                del self.frequencies[term]
+        self.total_length -= self.lengths.pop(id, 0)
+
+    # Score for each document containing any of the words in query
+    def scores(self, query):
+        scores = {}
+        if not self.lengths:
+            return scores
+        documents = len(self.lengths)
+        average_length = self.total_length / documents
+        for term in set(WORDS.findall(query.lower())):
+            ids = self.ids.get(term)
+            if ids is None:
+                continue
+            idf = math.log(1 + (documents - len(ids) + 0.5) /
+                           (len(ids) + 0.5))
+            for id, frequency in zip(ids, self.frequencies[term]):
+                norm = self.K1 * (1 - self.B + self.B * self.lengths[id] /
+                                  average_length)
+                scores[id] = scores.get(id, 0) + idf * frequency * \
+                    (self.K1 + 1) / (frequency + norm)
+        return scores
+
+    # A page of ids containing any of the words in query, best match first,
+    # and the total number of matches
+    def search(self, query, page, per_page):
+        scores = self.scores(query)
+        # Only the best page * per_page need sorting
+        ranked = heapq.nsmallest(page * per_page, scores,
+                                 key=lambda id: (-scores[id], -id))
+        return ranked[(page - 1) * per_page:], len(scores)
+
+    # Up to size (id, score) pairs ranked after the (score, id) key after, and
+    # the total number of matches - or in reverse, those before it nearest
+    # first
+    def search_after(self, query, after, size, reverse=False):
+        scores = self.scores(query)
+        sign = -1 if reverse else 1
+
+        def key(id):
+            return sign * -scores[id], sign * -id
+        ids = scores
+        if after:
+            start = (sign * -after[0], sign * -after[1])
+            ids = [id for id in scores if key(id) > start]
+        ranked = heapq.nsmallest(size, ids, key=key)
+        return [(id, scores[id]) for id in ranked], len(scores)
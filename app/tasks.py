@@ -3,7 +3,7 @@ import sys
 import time
 from flask import render_template
 from rq import get_current_job
-from app import create_app, db
+from app import create_app, db, search
 from app.models import User, Post, Task
 from app.email import send_email
 
@@ -24,6 +24,8 @@ def _set_task_progress(progress):
         job.meta['progress'] = progress
         job.save_meta()
         task = Task.query.get(job.get_id())
+        # Also keep the user's progress hash (read by the tasks banner) in sync
+        task.set_progress(progress)
         # Provide a way to keep use apprised of task progress asynchronously
         task.user.add_notification('task_progress', {'task_id': job.get_id(),
                                                      'progress': progress})
@@ -65,3 +67,14 @@ def export_posts(user_id):
         _set_task_progress(100)
         app.logger.error('Unhandled exception', exc_info=sys.exc_info())
 
+
+
+# Apply a batch of search index changes queued by search.index_changes
+# Fails the job if any of them fail, so rq keeps it (in its failed job
+# registry) to be requeued once search is back
+def index_documents(changes):
+    failed = search.apply_changes({(index, id): document
+                                   for index, id, document in changes})
+    if failed:
+        raise RuntimeError(f'{failed} of {len(changes)} search index changes '
+                           f'failed')
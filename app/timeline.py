@@ -0,0 +1,353 @@
+# Materialized home timelines (fan-out-on-write)
+# Each user's home timeline is kept in a Redis sorted set of post ids scored by
+# post timestamp.  When a post is created its id is pushed into the timeline of
+# every follower, so rendering the home page is a cheap range lookup instead
+# of the followers join/union in User.followed_posts().
+# Authors with huge followings aren't fanned out on write (one post would touch
+# millions of keys) - instead their posts are pulled in and merged when a
+# timeline is read.
+# The explore page is the same for everyone, so there's one more timeline, a
+# Redis list of the newest post ids from all users.
+# Redis is treated as a cache - if it's unavailable or a timeline hasn't been
+# built yet we fall back to (or rebuild from) the database.
+from app import db
+from app.models import Post, followers
+from datetime import datetime
+from flask import current_app
+from flask_sqlalchemy import Pagination
+import redis
+from secrets import token_hex
+
+
+# Set of author ids whose posts are pulled in when timelines are read
+PULL_AUTHORS_KEY = 'timeline:pull-authors'
+# List of the newest post ids, newest first
+EXPLORE_KEY = 'timeline:explore'
+# Every built timeline holds this member so that an empty timeline can be
+# told apart from one which hasn't been built yet, and this one once older
+# posts have been left out (trimmed) so that reading past the end falls back
+# to the database.  Both have a score of +inf - above every post, so trimming
+# (which drops the lowest scores) never removes them, and reads skip them.
+SENTINEL = 0
+TRIMMED = 'trimmed'
+MARKERS = 2
+EPOCH = datetime(1970, 1, 1)
+# Every change to a timeline (or the explore list) - even one which isn't
+# built, so there's nothing to change - bumps a version counter kept next to
+# it.  A rebuild only puts what it read from the database in place if the
+# version is the same as before it started reading, otherwise a post pushed
+# in the meantime would be lost.  Seconds the counters are kept for:
+VERSION_TTL = 3600
+
+# Only add to a timeline which already exists (otherwise a partially populated
+# timeline would look complete), then trim it to the configured length
+# (plus the markers), marking it as trimmed if anything was dropped
+# KEYS[1] = timeline key, KEYS[2] = its version key, ARGV = post id, score,
+# max length
+_PUSH_SCRIPT = '''
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], %d)
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('zadd', KEYS[1], ARGV[2], ARGV[1])
+    if redis.call('zremrangebyrank', KEYS[1], 0,
+                  -(tonumber(ARGV[3]) + %d + 1)) > 0 then
+        redis.call('zadd', KEYS[1], '+inf', '%s')
+    end
+end
+''' % (VERSION_TTL, MARKERS, TRIMMED)
+
+# Same for the explore list
+# KEYS[1] = explore key, KEYS[2] = its version key, ARGV = post id, max length
+_EXPLORE_PUSH_SCRIPT = '''
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], %d)
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('lpush', KEYS[1], ARGV[1])
+    redis.call('ltrim', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+end
+''' % VERSION_TTL
+
+# Move a rebuilt timeline (or explore list) into place, unless it was changed
+# while being rebuilt - then the rebuild is thrown away
+# KEYS[1] = rebuilt key, KEYS[2] = key, KEYS[3] = version key, ARGV = version
+# before rebuilding ('' for none)
+# Returns 1 if it was moved into place
+_SWAP_SCRIPT = '''
+if (redis.call('get', KEYS[3]) or '') ~= ARGV[1] then
+    redis.call('del', KEYS[1])
+    return 0
+end
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('rename', KEYS[1], KEYS[2])
+else
+    redis.call('del', KEYS[2])
+end
+return 1
+'''
+
+
+def _key(user_id):
+    return f'timeline:{user_id}'
+
+
+def _version_key(key):
+    return f'{key}:version'
+
+
+# Note a change to key (made, or to be made, in the same pipeline)
+def _changed(pipe, key):
+    pipe.incr(_version_key(key))
+    pipe.expire(_version_key(key), VERSION_TTL)
+
+
+# Version of key - read before reading its contents from the database
+def _version(key):
+    version = current_app.redis.get(_version_key(key))
+    return version.decode() if version is not None else ''
+
+
+# Build key's new contents under a temporary key with build(pipe, temporary)
+# and swap them in if key hasn't changed since version was read
+# Returns whether the rebuild was used
+def _swap(key, version, build):
+    temporary = f'{key}:rebuild:{token_hex(8)}'
+    pipe = current_app.redis.pipeline()
+    build(pipe, temporary)
+    current_app.redis.register_script(_SWAP_SCRIPT)(
+        keys=[temporary, key, _version_key(key)], args=[version], client=pipe)
+    return bool(pipe.execute()[-1])
+
+
+# Timestamps are stored as naive UTC datetimes
+def _score(timestamp):
+    return (timestamp - EPOCH).total_seconds()
+
+
+def _length():
+    return current_app.config['TIMELINE_LENGTH']
+
+
+def _is_pull_author(user):
+    return user.follower_count > current_app.config['TIMELINE_FANOUT_LIMIT']
+
+
+# Called after a new post has been committed
+def push_post(post):
+    author = post.author
+    score = _score(post.timestamp)
+    try:
+        push = current_app.redis.register_script(_PUSH_SCRIPT)
+        pipe = current_app.redis.pipeline(transaction=False)
+        # Authors always see their own posts
+        push(keys=[_key(author.id), _version_key(_key(author.id))],
+             args=[post.id, score, _length()], client=pipe)
+        explore_push = current_app.redis.register_script(_EXPLORE_PUSH_SCRIPT)
+        explore_push(keys=[EXPLORE_KEY, _version_key(EXPLORE_KEY)],
+                     args=[post.id, current_app.config['EXPLORE_LENGTH']],
+                     client=pipe)
+        if _is_pull_author(author):
+            pipe.sadd(PULL_AUTHORS_KEY, author.id)
+        else:
+            follower_ids = db.session.query(followers.c.follower_id).filter(
+                followers.c.followed_id == author.id)
+            for (follower_id,) in follower_ids:
+                push(keys=[_key(follower_id),
+                           _version_key(_key(follower_id))],
+                     args=[post.id, score, _length()], client=pipe)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        # Nothing else to do - timelines are rebuilt from the database
+        current_app.logger.warning('Unable to fan out post %s', post.id)
+
+
+# Called after follower starts following followed - backfill followed user's
+# recent posts
+def add_follow(follower, followed):
+    try:
+        key = _key(follower.id)
+        pipe = current_app.redis.pipeline()
+        _changed(pipe, key)
+        pipe.execute()
+        if not current_app.redis.exists(key) or \
+                current_app.redis.sismember(PULL_AUTHORS_KEY, followed.id):
+            return
+        posts = db.session.query(Post.id, Post.timestamp).filter(
+            Post.user_id == followed.id).order_by(
+                Post.timestamp.desc()).limit(_length())
+        mapping = {id: _score(timestamp) for id, timestamp in posts}
+        if not mapping:
+            return
+        pipe = current_app.redis.pipeline()
+        pipe.zadd(key, mapping)
+        pipe.zremrangebyrank(key, 0, -(_length() + MARKERS + 1))
+        _, trimmed = pipe.execute()
+        # Older posts of the followed user may have been left out too
+        if trimmed or len(mapping) >= _length():
+            current_app.redis.zadd(key, {TRIMMED: float('inf')})
+    except redis.exceptions.RedisError:
+        _discard(follower.id)
+
+
+# Called after follower stops following followed - remove followed user's
+# posts.  A timeline only holds the newest posts so followed user's newest
+# posts are the only ones which can be in it.
+def remove_follow(follower, followed):
+    try:
+        key = _key(follower.id)
+        pipe = current_app.redis.pipeline()
+        _changed(pipe, key)
+        pipe.execute()
+        if not current_app.redis.exists(key):
+            return
+        ids = [id for (id,) in db.session.query(Post.id).filter(
+            Post.user_id == followed.id).order_by(
+                Post.timestamp.desc()).limit(_length())]
+        if ids:
+            current_app.redis.zrem(key, *ids)
+    except redis.exceptions.RedisError:
+        _discard(follower.id)
+
+
+# Drop the timelines of user_ids after changes made behind their back (e.g.,
+# follows added by a bulk import) so that they get rebuilt
+def discard(user_ids):
+    keys = [_key(user_id) for user_id in user_ids]
+    if not keys:
+        return
+    try:
+        pipe = current_app.redis.pipeline()
+        for key in keys:
+            _changed(pipe, key)
+        pipe.delete(*keys)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Unable to discard %d timelines', len(keys))
+
+
+# Drop a timeline which may have missed an update so that it gets rebuilt
+def _discard(user_id):
+    try:
+        pipe = current_app.redis.pipeline()
+        _changed(pipe, _key(user_id))
+        pipe.delete(_key(user_id))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Unable to discard timeline %s', user_id)
+
+
+# Build a user's timeline from the database
+# Returns False if it changed while being built - then it's left unbuilt
+def rebuild(user):
+    key = _key(user.id)
+    version = _version(key)
+    followed_ids = db.session.query(followers.c.followed_id).filter(
+        followers.c.follower_id == user.id)
+    posts = db.session.query(Post.id, Post.timestamp).filter(db.or_(
+        Post.user_id == user.id, Post.user_id.in_(followed_ids))).order_by(
+            Post.timestamp.desc()).limit(_length())
+    mapping = {id: _score(timestamp) for id, timestamp in posts}
+    # A full timeline may well have left older posts out
+    if len(mapping) >= _length():
+        mapping[TRIMMED] = float('inf')
+    mapping[SENTINEL] = float('inf')
+    return _swap(key, version,
+                 lambda pipe, temporary: pipe.zadd(temporary, mapping))
+
+
+# Posts from followed "pull" authors, as (id, score) pairs
+def _pull(user, limit):
+    pull_ids = [int(id) for id in
+                current_app.redis.smembers(PULL_AUTHORS_KEY)]
+    if not pull_ids:
+        return []
+    followed_ids = db.session.query(followers.c.followed_id).filter(
+        followers.c.follower_id == user.id,
+        followers.c.followed_id.in_(pull_ids))
+    posts = db.session.query(Post.id, Post.timestamp).filter(
+        Post.user_id.in_(followed_ids)).order_by(
+            Post.timestamp.desc()).limit(limit)
+    return [(id, _score(timestamp)) for id, timestamp in posts]
+
+
+# Return a page of user's home timeline as a Flask-SQLAlchemy Pagination
+# object, so it's a drop in replacement for followed_posts().paginate()
+def get_timeline(user, page, per_page):
+    end = page * per_page
+    try:
+        key = _key(user.id)
+        if not current_app.redis.exists(key) and not rebuild(user):
+            return user.followed_posts().paginate(page, per_page, False)
+        pipe = current_app.redis.pipeline()
+        pipe.zrevrangebyscore(key, '(+inf', '-inf', start=0, num=end + 1,
+                              withscores=True)
+        pipe.zcount(key, '-inf', '(+inf')
+        pipe.zscore(key, TRIMMED)
+        entries, total, trimmed = pipe.execute()
+        # Timeline has been trimmed and we've gone past its end - it may be
+        # well short of TIMELINE_LENGTH if posts were removed since
+        if end > total and trimmed is not None:
+            return user.followed_posts().paginate(page, per_page, False)
+        scores = {int(id): score for id, score in entries}
+        for id, score in _pull(user, end + 1):
+            if id not in scores:
+                scores[id] = score
+                total += 1
+    except redis.exceptions.RedisError:
+        return user.followed_posts().paginate(page, per_page, False)
+    ids = sorted(scores, key=lambda id: (scores[id], id), reverse=True)
+    ids = ids[(page - 1) * per_page:end]
+    posts = {post.id: post for post in Post.query.filter(
+        Post.id.in_(ids)).options(db.joinedload(Post.author))} if ids else {}
+    # Posts may have been deleted since being pushed
+    items = [posts[id] for id in ids if id in posts]
+    return Pagination(None, page, per_page, total, items)
+
+
+# Build the explore list from the database
+# Returns False if it changed while being built - then it's left unbuilt
+def rebuild_explore():
+    version = _version(EXPLORE_KEY)
+    ids = [id for (id,) in db.session.query(Post.id).order_by(
+        Post.timestamp.desc(), Post.id.desc()).limit(
+            current_app.config['EXPLORE_LENGTH'])]
+
+    def build(pipe, temporary):
+        if ids:
+            pipe.rpush(temporary, *ids)
+    return _swap(EXPLORE_KEY, version, build)
+
+
+# Return a page of the explore timeline (every user's posts, newest first) as
+# a Pagination object like Post.query...paginate()
+# Pages within the explore list cost one Redis request and one query for the
+# posts by primary key.  Only whether there's a next page is known, not the
+# number of posts, so total is just big enough to say so.
+def get_explore(page, per_page):
+    start = (page - 1) * per_page
+    end = page * per_page
+    length = current_app.config['EXPLORE_LENGTH']
+    query = Post.query.order_by(Post.timestamp.desc()).options(
+        db.joinedload(Post.author))
+    if end > length:
+        return query.paginate(page, per_page, False)
+    try:
+        if not current_app.redis.exists(EXPLORE_KEY) and \
+                not rebuild_explore():
+            return query.paginate(page, per_page, False)
+        pipe = current_app.redis.pipeline()
+        # One more than a page, to see if there's a next page
+        pipe.lrange(EXPLORE_KEY, start, end)
+        pipe.llen(EXPLORE_KEY)
+        ids, listed = pipe.execute()
+    except redis.exceptions.RedisError:
+        return query.paginate(page, per_page, False)
+    ids = [int(id) for id in ids]
+    # A full list means there are (probably) older posts in the database
+    has_next = len(ids) > per_page or listed >= length
+    ids = ids[:per_page]
+    posts = {post.id: post for post in Post.query.filter(
+        Post.id.in_(ids)).options(db.joinedload(Post.author))} if ids else {}
+    # Posts may have been deleted since being pushed
+    items = [posts[id] for id in ids if id in posts]
+    total = end + 1 if has_next else start + len(ids)
+    return Pagination(None, page, per_page, total, items)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Latency of the API's user collections at per_page=100 - whole requests, and
+# serializing a page with to_dict for each user compared with the bulk
+# User.to_collection_items
+#
+# Users follow a random selection of the others so the followers/followed
+# collections have full pages.
+#
+# Usage:  python benchmarks/api_collections.py [--users N] [--requests N]
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from app.models import User, followers
+from config import Config
+from flask import jsonify
+
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='API collection latency')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--follows', type=int, default=150,
+                        help='Users each user follows')
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        class BenchConfig(Config):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp,
+                                                                  'bench.db')
+            ELASTICSEARCH_URL = None
+            SEARCH_BACKEND = 'none'
+
+        app = create_app(BenchConfig)
+        with app.app_context():
+            db.create_all()
+            rng = random.Random(1)
+            users = [User(username=f'user{i}', email=f'user{i}@example.com',
+                          about_me='Just another user')
+                     for i in range(args.users)]
+            users[0].set_password('cat')
+            db.session.add_all(users)
+            db.session.commit()
+            ids = [user.id for user in users]
+            rows = [{'follower_id': id, 'followed_id': followed}
+                    for id in ids
+                    for followed in rng.sample(ids, args.follows)
+                    if followed != id]
+            db.session.execute(followers.insert(), rows)
+            db.session.commit()
+            token = users[0].get_token()
+            db.session.commit()
+            id = ids[0]
+
+            client = app.test_client()
+            headers = {'Authorization': 'Bearer ' + token}
+            print(f'{args.users} users, per_page=100, median of '
+                  f'{args.requests} requests\n')
+            for url in ('/api/users', '/api/users?cursor=',
+                        f'/api/users/{id}/followers',
+                        f'/api/users/{id}/followed'):
+                url += ('&' if '?' in url else '?') + 'per_page=100'
+
+                def request():
+                    assert client.get(url, headers=headers).status_code == 200
+                print(f'{url:>36}: {timed(request, args.requests):7.2f}ms')
+
+            page = User.query.order_by(User.id).limit(100).all()
+            with app.test_request_context():
+                def each():
+                    return jsonify([user.to_dict() for user in page])
+
+                def bulk():
+                    return jsonify(User.to_collection_items(page))
+                assert each().get_data() == bulk().get_data()
+                print(f'\nSerializing 100 users: to_dict each '
+                      f'{timed(each, args.requests):6.2f}ms, bulk '
+                      f'{timed(bulk, args.requests):6.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
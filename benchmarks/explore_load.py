@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# Explore page throughput with many users browsing at once, reading pages from
+# the database (EXPLORE_LENGTH = 0) and from the shared explore timeline in
+# Redis
+#
+# Each simulated user is a logged in test client running in its own thread,
+# requesting the first few explore pages as fast as it can.  The report shows
+# requests per second, latency and SQL statements per request for each
+# approach.
+# Needs a Redis server (REDIS_URL) for the explore timeline.
+#
+# Usage:  python benchmarks/explore_load.py [--users N] [--duration S]
+import argparse
+from datetime import datetime, timedelta
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db, timeline
+from app.models import Post, User
+from config import Config
+
+
+def browse(app, username, args, latencies, lock, stop):
+    client = app.test_client()
+    client.post('/auth/login', data={'username': username, 'password': 'cat'})
+    rng = random.Random(username)
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = client.get(f'/explore?page={rng.randint(1, args.pages)}')
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f'explore failed: {response.status_code}')
+        with lock:
+            latencies.append(elapsed)
+
+
+def run(mode, args, path):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        ELASTICSEARCH_URL = None
+        SEARCH_BACKEND = 'none'
+        WTF_CSRF_ENABLED = False
+        EXPLORE_LENGTH = 0 if mode == 'database' else 200
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        users = []
+        for i in range(args.users):
+            user = User(username=f'user{i}', email=f'user{i}@example.com')
+            user.set_password('cat')
+            users.append(user)
+        db.session.add_all(users)
+        now = datetime.utcnow()
+        db.session.add_all([Post(body=f'post {i}', author=users[i % len(users)],
+                                 timestamp=now - timedelta(seconds=i))
+                            for i in range(args.posts)])
+        db.session.commit()
+        usernames = [user.username for user in users]
+        if mode == 'redis':
+            try:
+                timeline.rebuild_explore()
+            except Exception:
+                raise RuntimeError('explore timeline unavailable - is Redis '
+                                   'running?')
+
+        statements = [0]
+        lock = threading.Lock()
+
+        def count(conn, cursor, statement, parameters, context,
+                  executemany):
+            with lock:
+                statements[0] += 1
+        latencies = []
+        stop = threading.Event()
+        threads = [threading.Thread(target=browse,
+                                    args=(app, username, args, latencies,
+                                          lock, stop))
+                   for username in usernames]
+        for thread in threads:
+            thread.start()
+        # Let logins settle before counting
+        time.sleep(1)
+        with lock:
+            del latencies[:]
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        start = time.time()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        db.event.remove(db.engine, 'before_cursor_execute', count)
+    latencies.sort()
+    print(f'{mode:>8}: {len(latencies) / elapsed:7.1f} requests/s, median '
+          f'{statistics.median(latencies) * 1000:6.1f}ms, p95 '
+          f'{latencies[int(len(latencies) * 0.95)] * 1000:6.1f}ms, '
+          f'{statements[0] / len(latencies):4.1f} SQL statements/request')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Explore page throughput')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--posts', type=int, default=50000)
+    parser.add_argument('--pages', type=int, default=10,
+                        help='Explore pages users pick from')
+    parser.add_argument('--duration', type=int, default=20,
+                        help='Seconds to run each mode for')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('database', 'redis'):
+            run(mode, args, os.path.join(tmp, mode + '.db'))
+
+
+if __name__ == '__main__':
+    main()
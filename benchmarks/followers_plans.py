@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Compare query plans and timings for the followers table lookups with the
+# original schema (no primary key, no indexes) and the current one (composite
+# primary key plus reverse index - migration 87f7ea737054)
+#
+# Builds two throwaway SQLite databases with the same random follow graph and
+# runs the queries the app issues (is_following, followed_posts, followers,
+# followed) against each.
+#
+# Usage:  python benchmarks/followers_plans.py [--users N] [--edges N]
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from app.models import User, followers
+from config import Config
+
+# followers as created by migration d7da7d3067a1
+OLD_FOLLOWERS = ('CREATE TABLE followers (follower_id INTEGER REFERENCES user '
+                 '(id), followed_id INTEGER REFERENCES user (id))')
+
+QUERIES = [
+    ('is_following (count)', lambda u, v: u.followed.filter(
+        followers.c.followed_id == v.id).count() > 0),
+    ('is_following (exists)', lambda u, v: u.is_following(v)),
+    ('followed_posts page', lambda u, v: u.followed_posts().limit(5).all()),
+    ('followers page', lambda u, v: v.followers.limit(10).all()),
+    ('followed page', lambda u, v: u.followed.limit(10).all()),
+]
+
+
+def populate(path, users, edges, posts_per_user, old_schema):
+    conn = sqlite3.connect(path)
+    if old_schema:
+        conn.execute('DROP TABLE followers')
+        conn.execute(OLD_FOLLOWERS)
+    conn.executemany(
+        'INSERT INTO user (id, username, email) VALUES (?, ?, ?)',
+        ((i, f'user{i}', f'user{i}@example.com')
+         for i in range(1, users + 1)))
+    conn.executemany(
+        'INSERT INTO post (body, user_id, timestamp) VALUES (?, ?, ?)',
+        ((f'post {i}', i % users + 1, f'2018-12-{i % 28 + 1:02} 12:00:00')
+         for i in range(users * posts_per_user)))
+    # Same seed for both databases so they hold the same graph
+    rng = random.Random(1)
+    pairs = set()
+    while len(pairs) < edges:
+        follower, followed = rng.randint(1, users), rng.randint(1, users)
+        if follower != followed:
+            pairs.add((follower, followed))
+    conn.executemany('INSERT INTO followers VALUES (?, ?)', sorted(pairs))
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+def run(label, path, args):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        ELASTICSEARCH_URL = None
+        TESTING = True
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        start = time.time()
+        populate(path, args.users, args.edges, args.posts_per_user,
+                 old_schema=label == 'before')
+        print(f'== {label}: {args.edges} edges loaded in '
+              f'{time.time() - start:.1f}s')
+
+        # Capture the SQL each query issues so we can EXPLAIN it
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context,
+                    executemany):
+            statements.append((statement, parameters))
+        db.event.listen(db.engine, 'before_cursor_execute', capture)
+
+        rng = random.Random(2)
+        ids = [(rng.randint(1, args.users), rng.randint(1, args.users))
+               for _ in range(args.runs)]
+        pairs = [(User.query.get(a), User.query.get(b)) for a, b in ids]
+        raw = sqlite3.connect(path)
+        for name, query in QUERIES:
+            timings = []
+            for u, v in pairs:
+                del statements[:]
+                start = time.perf_counter()
+                query(u, v)
+                timings.append(time.perf_counter() - start)
+            statement, parameters = statements[-1]
+            plan = raw.execute('EXPLAIN QUERY PLAN ' + statement,
+                               parameters).fetchall()
+            print(f'\n{name}: median {statistics.median(timings) * 1000:.2f}ms'
+                  f' over {args.runs} runs')
+            for row in plan:
+                print(f'    {row[-1]}')
+        raw.close()
+        db.event.remove(db.engine, 'before_cursor_execute', capture)
+        db.session.remove()
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Followers table query plans before and after indexing')
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--edges', type=int, default=1000000)
+    parser.add_argument('--posts-per-user', type=int, default=2)
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        for label in ('before', 'after'):
+            run(label, os.path.join(tmp, label + '.db'), args)
+
+
+if __name__ == '__main__':
+    main()
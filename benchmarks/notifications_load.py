@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Compare the load from browser tabs polling /notifications with the load from
+# the same tabs holding a /notifications/stream (Server-Sent Events) open
+#
+# Each simulated tab is a logged in test client running in its own thread.
+# Over the same period a notification is sent to every user now and then;
+# the report shows HTTP requests and SQL statements made by the tabs, and the
+# notifications delivered, for each approach.
+# Needs a Redis server (REDIS_URL) for the stream.
+#
+# Usage:  python benchmarks/notifications_load.py [--tabs N] [--duration S]
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from app.models import User
+from config import Config
+
+
+class Counter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = self.statements = self.delivered = 0
+
+    def add(self, name, n=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+
+def poll_tab(app, username, args, counter, stop):
+    client = login(app, username)
+    since = 0
+    while not stop.is_set():
+        counter.add('requests')
+        notifications = client.get(f'/notifications?since={since}').get_json()
+        counter.add('delivered', len(notifications))
+        if notifications:
+            since = notifications[-1]['timestamp']
+        stop.wait(args.interval)
+
+
+def stream_tab(app, username, args, counter, stop):
+    client = login(app, username)
+    while not stop.is_set():
+        counter.add('requests')
+        response = client.get('/notifications/stream', buffered=False)
+        if response.status_code != 200:
+            raise RuntimeError('notification stream unavailable - is Redis '
+                               'running?')
+        for chunk in response.response:
+            if chunk.startswith(b'id:'):
+                counter.add('delivered')
+            if stop.is_set():
+                break
+        response.close()
+
+
+def login(app, username):
+    client = app.test_client()
+    client.post('/auth/login', data={'username': username, 'password': 'cat'})
+    return client
+
+
+def run(mode, args, path):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        ELASTICSEARCH_URL = None
+        WTF_CSRF_ENABLED = False
+        # Long enough that streams don't reconnect during the run
+        NOTIFICATIONS_STREAM_TIMEOUT = args.duration + 5
+        NOTIFICATIONS_HEARTBEAT = 1
+        NOTIFICATIONS_PUSH = True
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        users = []
+        for i in range(args.tabs):
+            user = User(username=f'user{i}', email=f'user{i}@example.com')
+            user.set_password('cat')
+            users.append(user)
+        db.session.add_all(users)
+        db.session.commit()
+        usernames = [user.username for user in users]
+
+        counter = Counter()
+
+        # Only count statements run for the tabs, not for sending
+        # notifications
+        sender = threading.current_thread()
+
+        def count(conn, cursor, statement, parameters, context,
+                  executemany):
+            if threading.current_thread() is not sender:
+                counter.add('statements')
+        stop = threading.Event()
+        target = poll_tab if mode == 'polling' else stream_tab
+        threads = [threading.Thread(target=target,
+                                    args=(app, username, args, counter, stop))
+                   for username in usernames]
+        for thread in threads:
+            thread.start()
+        # Let logins settle before counting
+        time.sleep(1)
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        counter.requests = counter.delivered = 0
+        sent = 0
+        deadline = time.time() + args.duration
+        while time.time() < deadline:
+            time.sleep(args.duration / (args.notifications + 1))
+            for user in User.query.all():
+                user.add_notification('unread_message_count', sent)
+            db.session.commit()
+            sent += 1
+        stop.set()
+        for thread in threads:
+            thread.join()
+        db.event.remove(db.engine, 'before_cursor_execute', count)
+    print(f'{mode:>8}: {counter.requests:5} requests, '
+          f'{counter.statements:6} SQL statements, '
+          f'{counter.delivered:4} of {sent * args.tabs} notifications '
+          f'delivered')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Notification polling vs. streaming load')
+    parser.add_argument('--tabs', type=int, default=20)
+    parser.add_argument('--duration', type=int, default=20,
+                        help='Seconds to run each mode for')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='Seconds between polls (10 in the real client)')
+    parser.add_argument('--notifications', type=int, default=4,
+                        help='Notifications sent to each user per run')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('polling', 'stream'):
+            run(mode, args, os.path.join(tmp, mode + '.db'))
+
+
+if __name__ == '__main__':
+    main()
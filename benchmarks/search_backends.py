@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Compare query latency of the search backends (app/search) on a corpus of
+# generated posts
+#
+# Posts are up to 140 characters of words drawn with a Zipf-like distribution
+# from a fixed vocabulary, so some words match a large share of the corpus and
+# most match very little - like real posts.  Each backend's index is built
+# with Post.reindex() then sent the same one and two word queries.
+# Elasticsearch is included when ELASTICSEARCH_URL is set.
+#
+# Usage:  python benchmarks/search_backends.py [--posts N] [--queries N]
+import argparse
+from itertools import accumulate
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from app.models import Post
+from app.search import query_index
+from app.search.database import DatabaseBackend
+from app.search.es import ElasticsearchBackend
+from app.search.memory import MemoryBackend
+from config import Config
+
+
+def vocabulary(rng, size):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters)
+                          for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+
+def populate(path, args, words, cum_weights):
+    rng = random.Random(1)
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO user (id, username, email) VALUES "
+                 "(1, 'bench', 'bench@example.com')")
+
+    def body():
+        # More words than fit, then cut at the last one that does
+        text = ' '.join(rng.choices(words, cum_weights=cum_weights, k=40))
+        return text[:text.rfind(' ', 0, 141)]
+    conn.executemany(
+        'INSERT INTO post (body, user_id, timestamp) VALUES '
+        "(?, 1, '2018-12-01 12:00:00')",
+        ((body(),) for _ in range(args.posts)))
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search backend latency')
+    parser.add_argument('--posts', type=int, default=200000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--per-page', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(2)
+    words = vocabulary(rng, args.vocabulary)
+    cum_weights = list(accumulate(1 / (rank + 1)
+                                  for rank in range(len(words))))
+    queries = [' '.join(rng.choices(words, cum_weights=cum_weights,
+                                    k=rng.randint(1, 2)))
+               for _ in range(args.queries)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+
+        class BenchConfig(Config):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+            SEARCH_INDEX_MODE = 'sync'
+            TESTING = True
+
+        app = create_app(BenchConfig)
+        with app.app_context():
+            db.create_all()
+            start = time.time()
+            populate(path, args, words, cum_weights)
+            print(f'{args.posts} posts generated in '
+                  f'{time.time() - start:.1f}s\n')
+
+            backends = [('memory', MemoryBackend())]
+            if DatabaseBackend.supported(BenchConfig.SQLALCHEMY_DATABASE_URI):
+                backends.append(('sqlite fts5', DatabaseBackend('sqlite')))
+            if app.elasticsearch:
+                backends.append(('elasticsearch',
+                                 ElasticsearchBackend(app.elasticsearch)))
+            for name, backend in backends:
+                app.search_backend = backend
+                start = time.time()
+                Post.reindex(chunk_size=2000)
+                built = time.time() - start
+                # Warm up caches before timing
+                for query in queries[:10]:
+                    query_index('post', query, 1, args.per_page)
+                timings = []
+                for query in queries:
+                    start = time.perf_counter()
+                    query_index('post', query, 1, args.per_page)
+                    timings.append(time.perf_counter() - start)
+                timings.sort()
+                print(f'{name:>14}: built in {built:6.1f}s, query median '
+                      f'{statistics.median(timings) * 1000:7.2f}ms, p95 '
+                      f'{timings[int(len(timings) * 0.95)] * 1000:7.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -38,10 +38,126 @@ class Config(object):
     # API Key for Azure Translation Service
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # Seconds to wait for Elasticsearch - searches are abandoned quickly so a
+    # struggling cluster doesn't tie up workers, bulk indexing runs in the
+    # background so can wait longer:
+    ELASTICSEARCH_TIMEOUT = float(os.environ.get('ELASTICSEARCH_TIMEOUT') or 5)
+    ELASTICSEARCH_SEARCH_TIMEOUT = float(
+        os.environ.get('ELASTICSEARCH_SEARCH_TIMEOUT') or 2)
+    ELASTICSEARCH_BULK_TIMEOUT = float(
+        os.environ.get('ELASTICSEARCH_BULK_TIMEOUT') or 30)
+    # Times a failed request is retried, and the base of the exponential
+    # backoff (seconds) between tries:
+    ELASTICSEARCH_RETRIES = int(os.environ.get('ELASTICSEARCH_RETRIES') or 2)
+    ELASTICSEARCH_RETRY_BACKOFF = 0.1
+    # Connections kept open to each Elasticsearch node:
+    ELASTICSEARCH_POOL_SIZE = int(os.environ.get('ELASTICSEARCH_POOL_SIZE')
+                                  or 10)
+    # Circuit breaker - requests stop for ELASTICSEARCH_BREAKER_RESET seconds
+    # after this many failures in a row:
+    ELASTICSEARCH_BREAKER_THRESHOLD = 5
+    ELASTICSEARCH_BREAKER_RESET = 30
+    # Search engine - 'elasticsearch', 'database' (SQLite FTS5 or Postgres
+    # full text search), 'memory' (per process index) or 'none'; unset picks
+    # elasticsearch if ELASTICSEARCH_URL is set, otherwise database:
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    # Render search results from the fields stored in the search documents
+    # rather than loading the posts and their authors from the database:
+    SEARCH_HYDRATE = os.environ.get('SEARCH_HYDRATE', '1') != '0'
+    # Search result cache (in Redis) - seconds results are kept for, and the
+    # most pages cached for an index between changes to it (0 disables):
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 300)
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 10000)
+    # Search results pages stop counting matches at this many:
+    SEARCH_TRACK_TOTAL_HITS = int(os.environ.get('SEARCH_TRACK_TOTAL_HITS')
+                                  or 10000)
+    # How committed changes reach the search index - 'thread' (batched by a
+    # background thread in each process), 'rq' (batched jobs for the rq
+    # worker) or 'sync' (applied before the commit returns):
+    SEARCH_INDEX_MODE = os.environ.get('SEARCH_INDEX_MODE') or 'thread'
+    # Most changes sent in one bulk request - a full queue is sent right away:
+    SEARCH_FLUSH_SIZE = int(os.environ.get('SEARCH_FLUSH_SIZE') or 500)
+    # Seconds queued changes wait before being sent:
+    SEARCH_FLUSH_INTERVAL = float(os.environ.get('SEARCH_FLUSH_INTERVAL') or 1)
+    # Most changes kept queued for another try after failing to be sent (e.g.,
+    # while Elasticsearch is down) - beyond this they're dropped and the index
+    # has to be rebuilt:
+    SEARCH_REQUEUE_LIMIT = int(os.environ.get('SEARCH_REQUEUE_LIMIT')
+                               or 100000)
     #
     # Where to find Redis Server
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
     #
     # How many posts to display per page:
     POSTS_PER_PAGE = 5
-
+    #
+    # Cache of rendered posts (_post.html) - most kept by each process, and
+    # seconds they're kept in Redis:
+    POST_FRAGMENT_CACHE_SIZE = int(os.environ.get('POST_FRAGMENT_CACHE_SIZE')
+                                   or 5000)
+    POST_FRAGMENT_TTL = int(os.environ.get('POST_FRAGMENT_TTL') or 86400)
+    # Change to discard every cached post, e.g., after updating translations
+    # (changes to _post.html itself are noticed automatically):
+    POST_FRAGMENT_VERSION = os.environ.get('POST_FRAGMENT_VERSION') or '1'
+    # Seconds rendered user popups are kept in Redis:
+    POPUP_CACHE_TTL = int(os.environ.get('POPUP_CACHE_TTL') or 300)
+    # Logged in users cached for loading on each request - seconds they're
+    # kept in Redis, and seconds and most kept by each process (changes made
+    # by other processes can take this long to be seen):
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL') or 300)
+    IDENTITY_CACHE_LOCAL_TTL = float(
+        os.environ.get('IDENTITY_CACHE_LOCAL_TTL') or 5)
+    IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE') or 10000)
+    #
+    # API tokens issued by POST /api/tokens - 'opaque' (random, looked up in
+    # the database on every request) or 'signed' (JWTs checked without the
+    # database), and seconds they last.  Both kinds are always accepted.
+    API_TOKEN_FORMAT = os.environ.get('API_TOKEN_FORMAT') or 'opaque'
+    API_TOKEN_EXPIRES = int(os.environ.get('API_TOKEN_EXPIRES') or 3600)
+    # Seconds users' token generations (which revoke signed tokens) are cached
+    # in Redis - no longer than tokens last, so tokens whose revocation Redis
+    # missed have expired by the time it's forgotten:
+    API_TOKEN_GENERATION_TTL = API_TOKEN_EXPIRES
+    # Most users GET /api/users?ids=... (or usernames=...) looks up at once:
+    API_BATCH_LIMIT = int(os.environ.get('API_BATCH_LIMIT') or 100)
+    # Most users and follows POST /api/users/bulk imports at once - passwords
+    # are hashed one after another inside the request (tens of milliseconds
+    # each) so far fewer users, larger imports should use flask import:
+    API_BULK_LIMIT = int(os.environ.get('API_BULK_LIMIT') or 1000)
+    API_BULK_USER_LIMIT = int(os.environ.get('API_BULK_USER_LIMIT') or 100)
+    #
+    # Home timeline (fan-out-on-write) settings
+    # Maximum number of posts kept in each user's materialized timeline - older
+    # pages are served straight from the database:
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)
+    # Authors with more followers than this aren't fanned out when they post,
+    # their posts are pulled into followers' timelines when read instead:
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 10000)
+    # Newest posts kept in the explore feed shared by every user - deeper
+    # explore pages are served straight from the database (0 disables):
+    EXPLORE_LENGTH = int(os.environ.get('EXPLORE_LENGTH') or 200)
+    #
+    # last_seen write-behind buffer
+    # Where pending last_seen values are buffered - 'redis' (shared by all
+    # workers) or 'memory' (per process):
+    LAST_SEEN_BACKEND = os.environ.get('LAST_SEEN_BACKEND') or 'redis'
+    # Seconds between batched writes of buffered last_seen values:
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL')
+                                   or 60)
+    # last_seen isn't recorded again until it's at least this many seconds old:
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    #
+    # Notification delivery
+    # Push notifications to pages over a Server-Sent Events stream (falling
+    # back to long polling) instead of polling every 10 seconds.  Each open
+    # page holds a request open, so only turn this on when running async
+    # workers (e.g., gunicorn -k gevent) - with sync workers a few open tabs
+    # use up every worker:
+    NOTIFICATIONS_PUSH = os.environ.get('NOTIFICATIONS_PUSH', '0') != '0'
+    # Seconds a notification stream stays open before the browser reconnects:
+    NOTIFICATIONS_STREAM_TIMEOUT = int(
+        os.environ.get('NOTIFICATIONS_STREAM_TIMEOUT') or 55)
+    # Seconds between keep-alive comments on an idle stream:
+    NOTIFICATIONS_HEARTBEAT = 15
+    # Longest a long-polling /notifications request waits for news:
+    NOTIFICATIONS_LONG_POLL_TIMEOUT = 25
@@ -0,0 +1,53 @@
+"""followers primary key
+
+Revision ID: 87f7ea737054
+Revises: 31704c47b988
+Create Date: 2026-10-17 10:03:27.540119
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '87f7ea737054'
+down_revision = '31704c47b988'
+branch_labels = None
+depends_on = None
+
+
+# Adding a primary key in place isn't possible on SQLite and would fail on any
+# database if duplicate follows have crept in, so copy the distinct rows into
+# a new table and swap it in
+# Dropping duplicates changes follow counts - run "flask counters check
+# --repair" afterwards
+def upgrade():
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id',
+                            name='followers_pkey')
+    )
+    op.execute('INSERT INTO followers_new (follower_id, followed_id) '
+               'SELECT DISTINCT follower_id, followed_id FROM followers '
+               'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    op.create_index('ix_followers_followed_id', 'followers',
+                    ['followed_id', 'follower_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_followers_followed_id', table_name='followers')
+    op.create_table('followers_old',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute('INSERT INTO followers_old (follower_id, followed_id) '
+               'SELECT follower_id, followed_id FROM followers')
+    op.drop_table('followers')
+    op.rename_table('followers_old', 'followers')
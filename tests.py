@@ -1,10 +1,38 @@
 #!/usr/bin/env python
 
+import base64
 from datetime import datetime, timedelta
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionTimeout
+from elasticsearch.serializer import JSONSerializer
+from flask import jsonify, template_rendered
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import jwt
+import os
+import redis
+import tempfile
+import threading
+import time
 # Use stdlib unit test module
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from unittest import mock
+# Runs the Redis code paths without a Redis server (see requirements-dev.txt)
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+from app import (cli, create_app, db, identity, importer, last_seen, popups,
+                 timeline)
+from app.models import User, Post, Message, Task, load_user
+from app.pagination import keyset_paginate
+from app.search import (ResultCache, SearchUnavailable, add_to_index,
+                        apply_changes, remove_from_index)
+from app.search.database import DatabaseBackend
+from app.search.es import (CircuitBreaker, CircuitOpenError,
+                           ElasticsearchBackend, ResilientTransport)
+from app.search.memory import MemoryBackend
 from config import Config
 
 
@@ -14,6 +42,32 @@ class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     # Don't have to have Elasticsearch server when running tests
     ELASTICSEARCH_URL = None
+    # Allow test client to post forms
+    WTF_CSRF_ENABLED = False
+    # Send search index changes before commit returns
+    SEARCH_INDEX_MODE = 'sync'
+    # Never use a Redis server that happens to be running - tests of the Redis
+    # code paths swap in fakeredis (see setUp)
+    REDIS_URL = 'redis://localhost:1'
+
+
+# Stands in for Elasticsearch - answers every request with an empty search
+# result after the server's delay, or fails with the server's status
+class StubElasticsearch(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.hits += 1
+        time.sleep(self.server.delay)
+        body = json.dumps({'hits': {'total': 0, 'hits': []}}).encode()
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
 
 
 class UserModelCase(unittest.TestCase):
@@ -35,6 +89,10 @@ class UserModelCase(unittest.TestCase):
         # instance
         # Create all tables
         db.create_all()
+        # Empty fake Redis server for tests to swap in for app.redis
+        if fakeredis is not None:
+            self.redis = fakeredis.FakeRedis()
+            self.redis.flushall()
 
     def tearDown(self):
         # Purge database session (in case test leaves something there)
@@ -56,6 +114,70 @@ class UserModelCase(unittest.TestCase):
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
 
+    def test_last_seen_buffer(self):
+        self.app.config['LAST_SEEN_BACKEND'] = 'memory'
+        u = User(username='john', email='john@example.com',
+                 last_seen=datetime(2018, 1, 1))
+        db.session.add(u)
+        db.session.commit()
+
+        last_seen.record(u)
+        # Shown straight away but not written until the buffer is flushed
+        self.assertGreater(u.last_seen, datetime(2018, 1, 1))
+        self.assertNotIn(u, db.session.dirty)
+        seen = u.last_seen
+        self.assertEqual(db.session.query(User.last_seen).scalar(),
+                         datetime(2018, 1, 1))
+        # Users loaded in the meantime see the buffered value
+        db.session.expunge_all()
+        self.assertEqual(User.query.get(u.id).last_seen, seen)
+
+        self.assertEqual(last_seen.flush(), 1)
+        self.assertEqual(db.session.query(User.last_seen).scalar(), seen)
+        self.assertEqual(last_seen.flush(), 0)
+
+    @unittest.skipIf(fakeredis is None, 'needs fakeredis')
+    def test_last_seen_redis_buffer(self):
+        self.app.redis = self.redis
+        self.addCleanup(last_seen._recorded.clear)
+        self.addCleanup(last_seen._buffered.clear)
+        u1 = User(username='john', email='john@example.com',
+                  last_seen=datetime(2018, 1, 1))
+        u2 = User(username='susan', email='susan@example.com',
+                  last_seen=datetime(2018, 1, 1))
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        def stored(user):
+            return db.session.query(User.last_seen).filter_by(
+                id=user.id).scalar()
+        # The first worker to see someone takes the flush lock and writes
+        # out the shared buffer
+        last_seen.record(u1)
+        self.assertGreater(stored(u1), datetime(2018, 1, 1))
+        self.assertTrue(self.app.redis.exists(last_seen.FLUSH_LOCK_KEY))
+        # Until the lock expires values wait in the buffer
+        last_seen.record(u2)
+        self.assertEqual(stored(u2), datetime(2018, 1, 1))
+        self.assertEqual(self.app.redis.hkeys(last_seen.BUFFER_KEY),
+                         [str(u2.id).encode()])
+        # Seen again too soon to be worth recording
+        last_seen.record(u2)
+        self.assertEqual(self.app.redis.hlen(last_seen.BUFFER_KEY), 1)
+        # Users loaded in the meantime see the buffered value
+        seen, id = u2.last_seen, u2.id
+        db.session.expunge_all()
+        self.assertEqual(User.query.get(id).last_seen, seen)
+
+        self.assertEqual(last_seen.flush(), 1)
+        self.assertAlmostEqual(stored(u2), seen,
+                               delta=timedelta(milliseconds=1))
+        self.assertFalse(self.app.redis.exists(last_seen.BUFFER_KEY))
+        self.assertEqual(last_seen.flush(), 0)
+        # Nothing is kept once it's been written
+        self.assertEqual(len(last_seen._buffered), 0)
+        self.assertEqual(last_seen._recorded, {})
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -79,6 +201,136 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual((u1.post_count, u1.follower_count,
+                          u1.followed_count), (0, 0, 0))
+
+        u1.follow(u2)
+        # Following twice mustn't count twice
+        u1.follow(u2)
+        db.session.add_all([Post(body='one', author=u1),
+                            Post(body='two', author=u1)])
+        db.session.commit()
+        self.assertEqual((u1.post_count, u1.followed_count), (2, 1))
+        self.assertEqual(u2.follower_count, 1)
+        with self.app.test_request_context():
+            data = u1.to_dict()
+        self.assertEqual((data['post_count'], data['follower_count'],
+                          data['followed_count']), (2, 0, 1))
+
+        db.session.delete(u1.posts.first())
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual((u1.post_count, u1.followed_count), (1, 0))
+        self.assertEqual(u2.follower_count, 0)
+        self.assertEqual(User.count_relationships([u1.id, u2.id]),
+                         {u1.id: (1, 0, 0), u2.id: (0, 0, 0)})
+
+    @unittest.skipIf(fakeredis is None, 'needs fakeredis')
+    def test_counters_repair(self):
+        self.app.redis = self.redis
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2, Post(body='one', author=u1)])
+        db.session.commit()
+        id1, id2 = u1.id, u2.id
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id == id1).values(
+            post_count=5))
+        db.session.commit()
+        # Cached with the wrong count
+        identity.store(id1, u1.identity())
+        popup = popups._key('john', 'self', 'en')
+        self.redis.set(popup, '{}')
+
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=[
+            'counters', 'check', '--repair'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('user 1: ', result.output)
+        db.session.expunge_all()
+        self.assertEqual(User.query.get(id1).post_count, 1)
+        # Repaired users are dropped from the caches
+        self.assertEqual(self.redis.get(identity._key(id1)),
+                         identity.TOMBSTONE)
+        self.assertIsNone(self.app.identity_cache.get(id1))
+        self.assertFalse(self.redis.exists(popup))
+        self.assertIsNone(self.redis.get(identity._key(id2)))
+
+    def test_unread_message_count(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 0)
+
+        for body in ('hi', 'there'):
+            db.session.add(Message(author=u1, recipient=u2, body=body))
+            u2.message_received()
+            db.session.flush()
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 2)
+        self.assertEqual(u2.count_new_messages(), 2)
+        self.assertEqual(User.count_unread_messages([u1.id, u2.id]),
+                         {u1.id: 0, u2.id: 2})
+
+        u2.messages_read()
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 0)
+        self.assertEqual(User.count_unread_messages([u2.id]), {u2.id: 0})
+
+    def test_tasks_progress(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(u.get_tasks_progress(), [])
+
+        # Without Redis there's no job so the task shows as finished
+        task = Task(id='abc', name='export_posts', description='Exporting',
+                    user=u)
+        db.session.add(task)
+        db.session.commit()
+        self.assertEqual(u.get_tasks_progress(), [(task, 100)])
+
+    @unittest.skipIf(fakeredis is None, 'needs fakeredis')
+    def test_tasks_progress_redis(self):
+        self.app.redis = self.redis
+        u = User(username='john', email='john@example.com')
+        task = Task(id='abc', name='export_posts', description='Exporting',
+                    user=u)
+        db.session.add_all([u, task])
+        db.session.commit()
+
+        # Launched before progress was kept in Redis - the empty hash isn't
+        # trusted until it's been checked against the database
+        with mock.patch.object(Task, 'get_progress', return_value=40):
+            self.assertEqual(u.get_tasks_progress(), [(task, 40)])
+        # ...after which progress comes from the hash
+        self.assertEqual(u.get_tasks_progress(), [(task, 40)])
+        task.set_progress(70)
+        self.assertEqual(u.get_tasks_progress(), [(task, 70)])
+
+        task.set_progress(100)
+        task.complete = True
+        db.session.commit()
+        key = Task.progress_key(u.id)
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        self.addCleanup(db.event.remove, db.engine, 'before_cursor_execute',
+                        count)
+        # Nothing running - no database query
+        self.assertEqual(u.get_tasks_progress(), [])
+        self.assertEqual(statements, [])
+        # The hash is checked against the database again once it expires
+        self.assertTrue(0 < self.app.redis.ttl(key) <= Task.PROGRESS_TTL)
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -117,6 +369,1057 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline_fallback(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        p1 = Post(body="post from john", author=u1,
+                  timestamp=now + timedelta(seconds=1))
+        p2 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        u1.follow(u2)
+        db.session.commit()
+
+        # No Redis server while testing - timeline comes from the database
+        posts = timeline.get_timeline(u1, 1, 1)
+        self.assertEqual(posts.items, [p2])
+        self.assertTrue(posts.has_next)
+        self.assertEqual(timeline.get_timeline(u1, 2, 1).items, [p1])
+        # ...and so does explore
+        posts = timeline.get_explore(1, 1)
+        self.assertEqual(posts.items, [p2])
+        self.assertTrue(posts.has_next)
+        self.assertEqual(timeline.get_explore(2, 1).items, [p1])
+
+    @unittest.skipIf(fakeredis is None, 'needs fakeredis')
+    def test_timeline_redis(self):
+        self.app.redis = self.redis
+        self.app.config['TIMELINE_LENGTH'] = 3
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        mary = User(username='mary', email='mary@example.com')
+        db.session.add_all([john, susan, mary])
+        now = datetime.utcnow()
+        posts = [Post(body=f'post {i}', author=author,
+                      timestamp=now + timedelta(seconds=i))
+                 for i, author in enumerate([john, susan, mary, susan, mary])]
+        db.session.add_all(posts)
+        john.follow(susan)
+        john.follow(mary)
+        db.session.commit()
+        key = timeline._key(john.id)
+
+        # Built with the newest three posts, so older pages come from the
+        # database
+        self.assertEqual(timeline.get_timeline(john, 1, 2).items,
+                         [posts[4], posts[3]])
+        self.assertEqual(self.app.redis.zcount(key, '(0', '(+inf'), 3)
+        self.assertEqual(timeline.get_timeline(john, 3, 2).items, [posts[0]])
+
+        # Unfollowing leaves the timeline well short of its length, but it's
+        # still known to be missing older posts
+        john.unfollow(mary)
+        db.session.commit()
+        timeline.remove_follow(john, mary)
+        self.assertEqual(self.app.redis.zcount(key, '(0', '(+inf'), 1)
+        page = timeline.get_timeline(john, 1, 2)
+        self.assertEqual(page.items, [posts[3], posts[1]])
+        self.assertTrue(page.has_next)
+
+        # Pushing trims the oldest posts, never the markers
+        self.app.config['TIMELINE_LENGTH'] = 1
+        post = Post(body='new', author=susan,
+                    timestamp=now + timedelta(seconds=10))
+        db.session.add(post)
+        db.session.commit()
+        timeline.push_post(post)
+        self.assertEqual(self.app.redis.zrange(key, 0, -1),
+                         [str(post.id).encode(), b'0', b'trimmed'])
+        self.assertEqual(timeline.get_timeline(john, 1, 1).items, [post])
+        self.assertEqual(timeline.get_timeline(john, 2, 1).items, [posts[3]])
+
+        # An empty timeline is built once, not on every read
+        self.assertEqual(timeline.get_timeline(mary, 1, 5).items[0].author,
+                         mary)
+        new = User(username='david', email='david@example.com')
+        db.session.add(new)
+        db.session.commit()
+        self.assertEqual(timeline.get_timeline(new, 1, 5).items, [])
+        self.assertEqual(self.app.redis.zrange(timeline._key(new.id), 0, -1),
+                         [b'0'])
+
+    @unittest.skipIf(fakeredis is None, 'needs fakeredis')
+    def test_explore_redis(self):
+        self.app.redis = self.redis
+        self.app.config['EXPLORE_LENGTH'] = 3
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body=f'post {i}', author=u,
+                      timestamp=datetime(2018, 1, 1 + i)) for i in range(4)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+
+        page = timeline.get_explore(1, 2)
+        self.assertEqual(page.items, [posts[3], posts[2]])
+        self.assertTrue(page.has_next)
+        # New posts go on the front of the list, which stays at its length
+        post = Post(body='new', author=u, timestamp=datetime(2018, 2, 1))
+        db.session.add(post)
+        db.session.commit()
+        timeline.push_post(post)
+        self.assertEqual(self.app.redis.llen(timeline.EXPLORE_KEY), 3)
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        self.addCleanup(db.event.remove, db.engine, 'before_cursor_execute',
+                        count)
+        # Served from the list - one query, for the posts by id
+        self.assertEqual(timeline.get_explore(1, 2).items, [post, posts[3]])
+        self.assertEqual(len(statements), 1)
+        self.assertIn(' IN (', statements[0])
+        # Past the end of the list pages come from the database
+        self.assertEqual(timeline.get_explore(2, 2).items,
+                         [posts[2], posts[1]])
+
+    @unittest.skipIf(fakeredis is None, 'needs fakeredis')
+    def test_timeline_rebuild_race(self):
+        self.app.redis = self.redis
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='first', author=u, timestamp=datetime(2018, 1, 1))
+        p2 = Post(body='second', author=u, timestamp=datetime(2018, 1, 2))
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        query = db.session.query
+
+        # A post is pushed while a rebuild is reading the database - what the
+        # rebuild read may not have it, so it's thrown away
+        def pushed_while_reading(*args, **kwargs):
+            if not pushed:
+                pushed.append(p2)
+                timeline.push_post(p2)
+            return query(*args, **kwargs)
+        for rebuild, key in ((lambda: timeline.rebuild(u), timeline._key(u.id)),
+                             (timeline.rebuild_explore, timeline.EXPLORE_KEY)):
+            pushed = []
+            with mock.patch.object(db.session, 'query', pushed_while_reading):
+                self.assertFalse(rebuild())
+            self.assertFalse(self.app.redis.exists(key))
+            self.assertEqual(self.app.redis.keys(key + ':rebuild:*'), [])
+        # ...and pages come from the database until a rebuild gets through
+        self.assertEqual(timeline.get_timeline(u, 1, 5).items, [p2, p1])
+        self.assertEqual(timeline.get_explore(1, 5).items, [p2, p1])
+        self.assertEqual(self.app.redis.lrange(timeline.EXPLORE_KEY, 0, -1),
+                         [str(p2.id).encode(), str(p1.id).encode()])
+        self.assertEqual(self.app.redis.zcount(timeline._key(u.id), '(0',
+                                               '(+inf'), 2)
+
+    def test_identity_cache(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        id = u.id
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        self.addCleanup(db.event.remove, db.engine, 'before_cursor_execute',
+                        count)
+
+        def load():
+            db.session.expunge_all()
+            del statements[:]
+            return load_user(str(id))
+        self.assertEqual(load().username, 'john')
+        self.assertEqual(len(statements), 1)
+        # Cached - no queries, and a user like any other
+        u = load()
+        self.assertEqual(len(statements), 0)
+        self.assertEqual((u.username, u.unread_message_count), ('john', 0))
+        self.assertIn(u, db.session)
+        self.assertTrue(u.check_password('cat'))
+
+        # Committed changes are picked up straight away
+        u.set_password('dog')
+        u.about_me = 'hi'
+        db.session.commit()
+        u = load()
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(u.check_password('dog'))
+        self.assertEqual(u.about_me, 'hi')
+
+    @unittest.skipIf(fakeredis is None, 'needs fakeredis')
+    def test_identity_cache_redis(self):
+        self.app.redis = self.redis
+        u = User(username='john', email='john@example.com',
+                 last_seen=datetime(2018, 1, 1, 12, 30, 15, 500))
+        db.session.add(u)
+        db.session.commit()
+        id = u.id
+        key = identity._key(id)
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        self.addCleanup(db.event.remove, db.engine, 'before_cursor_execute',
+                        count)
+
+        # Another worker - nothing in this process's cache
+        def load():
+            db.session.expunge_all()
+            self.app.identity_cache.clear()
+            del statements[:]
+            return load_user(str(id))
+        load()
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(self.app.redis.get(key))
+        u = load()
+        self.assertEqual(len(statements), 0)
+        self.assertEqual(u.last_seen, datetime(2018, 1, 1, 12, 30, 15, 500))
+
+        # Recording last_seen updates the entry in place
+        identity.seen(id, datetime(2018, 1, 2))
+        u = load()
+        self.assertEqual(u.last_seen, datetime(2018, 1, 2))
+        self.assertEqual(len(statements), 0)
+
+        # A committed change leaves a tombstone which a worker still holding
+        # the old columns can't overwrite
+        old = u.identity()
+        u.about_me = 'hi'
+        db.session.commit()
+        self.assertEqual(self.app.redis.get(key), identity.TOMBSTONE)
+        identity.store(id, old)
+        identity.seen(id, datetime(2018, 1, 3))
+        self.assertEqual(self.app.redis.get(key), identity.TOMBSTONE)
+        u = load()
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(u.about_me, 'hi')
+
+    def test_keyset_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        # Two posts share a timestamp so the id has to break the tie
+        posts = [Post(body=f'post {i}', author=[u1, u2][i % 2],
+                      timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        u1.follow(u2)
+        db.session.commit()
+        expected = sorted(posts, key=lambda p: (p.timestamp, p.id),
+                          reverse=True)
+
+        # Walk forwards then back again through the union query
+        columns = [Post.timestamp, Post.id]
+        page1 = keyset_paginate(u1.followed_posts(), columns, '', 2)
+        self.assertEqual(page1.items, expected[:2])
+        self.assertFalse(page1.has_prev)
+        self.assertIsNone(page1.total)
+        page2 = keyset_paginate(u1.followed_posts(), columns,
+                                page1.next_cursor, 2)
+        self.assertEqual(page2.items, expected[2:4])
+        page3 = keyset_paginate(u1.followed_posts(), columns,
+                                page2.next_cursor, 2)
+        self.assertEqual(page3.items, expected[4:])
+        self.assertFalse(page3.has_next)
+        back = keyset_paginate(u1.followed_posts(), columns,
+                               page3.prev_cursor, 2, include_total=True)
+        self.assertEqual(back.items, expected[2:4])
+        self.assertEqual(back.total, 5)
+        self.assertTrue(back.has_next and back.has_prev)
+
+        # Garbage cursors restart at the first page
+        self.assertEqual(keyset_paginate(Post.query, columns, 'garbage',
+                                         2).items, expected[:2])
+
+    def test_search_index_changes(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='first', author=u)
+        p2 = Post(body='second', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.flush()
+        p1.body = 'first edited'
+        db.session.delete(p2)
+        db.session.flush()
+        # One change per post, holding its final state
+        self.assertEqual(db.session.info['search_changes'][('post', p1.id)][
+            'body'], 'first edited')
+        self.assertIsNone(db.session.info['search_changes'][('post', p2.id)])
+
+        # Elasticsearch being unreachable doesn't fail the commit
+        self.app.search_backend = ElasticsearchBackend(Elasticsearch(
+            ['localhost:1'], max_retries=0, timeout=1))
+        db.session.commit()
+        self.assertNotIn('search_changes', db.session.info)
+        self.assertEqual(Post.query.count(), 1)
+
+        # Queued changes are sent together - while Elasticsearch is down
+        # they're kept for another try, behind anything queued since
+        indexer = self.app.search_indexer
+        indexer.pending.update({('post', p1.id): {'body': 'a'},
+                                ('post', 99): None})
+        with mock.patch.object(self.app.search_backend, 'apply',
+                               side_effect=lambda changes: indexer.submit(
+                                   {('post', 99): {'body': 'b'}}) or 2):
+            self.assertEqual(indexer.flush(), 2)
+        self.assertEqual(indexer.pending, {('post', p1.id): {'body': 'a'},
+                                           ('post', 99): {'body': 'b'}})
+        self.app.search_backend = MemoryBackend()
+        self.assertEqual(indexer.flush(), 2)
+        self.assertEqual(indexer.pending, {})
+        # ...unless too many have piled up
+        self.app.search_backend = ElasticsearchBackend(Elasticsearch(
+            ['localhost:1'], max_retries=0, timeout=1))
+        self.app.config['SEARCH_REQUEUE_LIMIT'] = 1
+        indexer.pending.update({('post', p1.id): {'body': 'a'},
+                                ('post', 99): None})
+        self.assertEqual(indexer.flush(), 2)
+        self.assertEqual(indexer.pending, {})
+
+    @unittest.skipIf(fakeredis is None, 'needs fakeredis')
+    def test_search_index_generation(self):
+        self.app.redis = self.redis
+        self.app.search_backend = MemoryBackend()
+        u = User(username='john', email='john@example.com')
+        p = Post(body='hello', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        key = ResultCache.generation_key('post')
+        generation = int(self.app.redis.get(key))
+        # Every write moves the index on to a new generation
+        add_to_index('post', p)
+        self.assertEqual(int(self.app.redis.get(key)), generation + 1)
+        self.assertEqual(Post.search('hello', 1, 5)[1], 1)
+        remove_from_index('post', p)
+        self.assertEqual(int(self.app.redis.get(key)), generation + 2)
+        self.assertEqual(Post.search('hello', 1, 5)[1], 0)
+
+    def test_search_backends(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        for backend in (DatabaseBackend('sqlite'), MemoryBackend()):
+            self.app.search_backend = backend
+            p1 = Post(body='apples and pears', author=u)
+            p2 = Post(body='apples apples apples', author=u)
+            p3 = Post(body='just pears', author=u)
+            db.session.add_all([p1, p2, p3])
+            db.session.commit()
+
+            # Any word matches, best matches first
+            posts, total = Post.search('apples', 1, 5)
+            self.assertEqual(posts.all(), [p2, p1])
+            self.assertEqual(total, 2)
+            posts, total = Post.search('APPLES pears', 1, 2)
+            self.assertEqual(posts.all(), [p1, p2])
+            self.assertEqual(total, 3)
+            posts, total = Post.search('apples pears', 2, 2)
+            self.assertEqual(posts.all(), [p3])
+            self.assertEqual(Post.search('"bananas* OR', 1, 5)[1], 0)
+
+            # Edits and deletes are picked up
+            p1.body = 'bananas'
+            db.session.delete(p2)
+            db.session.commit()
+            posts, total = Post.search('apples bananas', 1, 5)
+            self.assertEqual(posts.all(), [p1])
+
+            # Rebuilding gives the same results
+            Post.reindex(chunk_size=2)
+            posts, total = Post.search('pears', 1, 5)
+            self.assertEqual(posts.all(), [p3])
+
+            # Results can be built from the documents without any queries
+            statements = []
+
+            def record(conn, cursor, statement, *args):
+                statements.append(statement)
+            db.event.listen(db.engine, 'before_cursor_execute', record)
+            posts, total = Post.search('pears', 1, 5, hydrate=True)
+            if isinstance(backend, MemoryBackend):
+                self.assertEqual(statements, [])
+            else:
+                # Just the search itself
+                self.assertEqual(len(statements), 2)
+            db.event.remove(db.engine, 'before_cursor_execute', record)
+            self.assertEqual([(post.id, post.body, post.timestamp,
+                               post.author.username, post.author.avatar(36))
+                              for post in posts],
+                             [(p3.id, p3.body, p3.timestamp, u.username,
+                               u.avatar(36))])
+
+            # Renaming the author updates the stored username
+            u.username = 'jon'
+            db.session.commit()
+            posts, total = Post.search('pears', 1, 5, hydrate=True)
+            self.assertEqual(posts[0].author.username, 'jon')
+            u.username = 'john'
+            db.session.commit()
+
+            # Documents without stored fields fall back to the database
+            apply_changes({('post', p3.id): {'body': p3.body}})
+            posts, total = Post.search('pears', 1, 5, hydrate=True)
+            self.assertEqual(posts.all(), [p3])
+            for post in Post.query:
+                db.session.delete(post)
+            db.session.commit()
+
+    def test_search_cursors(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.app.config['SEARCH_TRACK_TOTAL_HITS'] = 6
+        for backend in (DatabaseBackend('sqlite'), MemoryBackend()):
+            self.app.search_backend = backend
+            # Scores tie in threes so ids have to break the ties
+            posts = [Post(body='cat ' * (i % 3 + 1) + 'dog', author=u)
+                     for i in range(8)]
+            db.session.add_all(posts)
+            db.session.commit()
+            expected = Post.search('cat', 1, 8)[0].all()
+
+            # Forwards through the results and back again
+            page1 = Post.search_page('cat', '', 3)
+            self.assertEqual(page1.items, expected[:3])
+            self.assertIsNone(page1.prev_cursor)
+            self.assertEqual((page1.total, page1.total_exact), (6, False))
+            page2 = Post.search_page('cat', page1.next_cursor, 3)
+            self.assertEqual(page2.items, expected[3:6])
+            page3 = Post.search_page('cat', page2.next_cursor, 3,
+                                     hydrate=True)
+            self.assertEqual([post.id for post in page3.items],
+                             [post.id for post in expected[6:]])
+            self.assertIsNone(page3.next_cursor)
+            back = Post.search_page('cat', page3.prev_cursor, 3)
+            self.assertEqual(back.items, expected[3:6])
+            back = Post.search_page('cat', back.prev_cursor, 3)
+            self.assertEqual(back.items, expected[:3])
+            self.assertIsNone(back.prev_cursor)
+            for post in posts:
+                db.session.delete(post)
+            db.session.commit()
+
+    def test_search_cache_keys(self):
+        def cache(query, page=1, per_page=5):
+            return ResultCache('post', query, page, per_page, ['body'], False)
+        # Case and spacing don't matter, pages of a query share their total
+        self.assertEqual(cache('Hello  World').page_key,
+                         cache('hello world').page_key)
+        self.assertNotEqual(cache('hello').page_key,
+                            cache('hello', page=2).page_key)
+        self.assertEqual(cache('hello').query_key,
+                         cache('hello', page=2).query_key)
+        # No Redis here - searching still works, uncached
+        self.assertEqual(cache('hello').lookup(), (None, None))
+
+    def test_search_reindex(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add_all([Post(body=f'post {i}', author=u) for i in range(7)])
+        db.session.commit()
+        ids = [id for (id,) in db.session.query(Post.id).order_by(Post.id)]
+        es = mock.Mock()
+        es.indices.exists_alias.return_value = False
+        es.indices.exists.return_value = False
+        self.app.search_backend = ElasticsearchBackend(es)
+        cli.register(self.app)
+        checkpoint_file = os.path.join(tempfile.mkdtemp(), 'reindex.json')
+        self.addCleanup(os.rmdir, os.path.dirname(checkpoint_file))
+        sent = []
+
+        # Stands in for the bulk requests - the first chunk is the slowest
+        # so chunks complete out of order, and chunks holding any of the ids
+        # in fail raise
+        def bulk(client, actions, chunk_size, fail=()):
+            if actions[0]['_id'] == ids[0]:
+                time.sleep(0.2)
+            if any(action['_id'] in fail for action in actions):
+                raise ConnectionTimeout('TIMEOUT', 'timed out', None)
+            sent.append([(action['_index'], action['_id'])
+                         for action in actions])
+
+        def reindex(*args, fail=()):
+            with mock.patch('app.search.es.helpers.bulk',
+                            lambda *a, **k: bulk(*a, fail=fail, **k)):
+                return self.app.test_cli_runner().invoke(args=[
+                    'search', 'reindex', '--chunk-size', '2', '--workers',
+                    '3', '--checkpoint-file', checkpoint_file, *args])
+
+        # A chunk fails - the checkpoint only covers chunks before it, even
+        # though a later chunk was stored
+        result = reindex(fail=(ids[2],))
+        self.assertIsInstance(result.exception, ConnectionTimeout)
+        with open(checkpoint_file) as f:
+            state = json.load(f)
+        self.assertEqual((state['last_id'], state['done']), (ids[1], 2))
+        version = state['version']
+        self.assertTrue(version.startswith('post-v'))
+        self.assertIn([(version, ids[4]), (version, ids[5])], sent)
+        es.indices.update_aliases.assert_not_called()
+
+        # Resuming carries on into the same index after the checkpoint, in
+        # chunks, with checkpoints in id order
+        del sent[:]
+        es.indices.create.reset_mock()
+        result = reindex('--resume')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn(f'Resuming {version} after id {ids[1]}', result.output)
+        es.indices.create.assert_not_called()
+        self.assertEqual(sorted(len(chunk) for chunk in sent), [1, 2, 2])
+        self.assertEqual(sorted(id for chunk in sent for _, id in chunk),
+                         ids[2:])
+        checkpoints = [int(line.split('(id ')[1].split(')')[0])
+                       for line in result.output.splitlines()
+                       if 'documents indexed' in line]
+        self.assertEqual(checkpoints, [ids[3], ids[5], ids[6]])
+        self.assertIn(f'post now points at {version}: 5 documents',
+                      result.output)
+        es.indices.update_aliases.assert_called_once_with(body={'actions': [
+            {'add': {'index': version, 'alias': 'post'}}]})
+        # Finished, so the checkpoint is gone
+        self.assertFalse(os.path.exists(checkpoint_file))
+        self.assertIn('no checkpoint', reindex('--resume').output)
+
+    def test_search_total_hits_versions(self):
+        bodies = []
+
+        def backend(number, total):
+            es = mock.Mock()
+            es.info.return_value = {'version': {'number': number}}
+            es.search.side_effect = lambda index, doc_type, body: \
+                bodies.append(body) or {'hits': {'total': total, 'hits': []}}
+            return ElasticsearchBackend(es)
+        # 6.x servers reject track_total_hits and count every match anyway
+        self.assertEqual(backend('6.3.1', 3).query_after(
+            'post', 'hi', None, 5), ([], 3))
+        self.assertNotIn('track_total_hits', bodies[-1])
+        self.assertEqual(backend('6.3.1', 3).query('post', 'hi', 1, 5),
+                         ([], 3))
+        # 7.x servers give the total as a dict
+        total = {'value': 2, 'relation': 'gte'}
+        self.assertEqual(backend('7.10.2', total).query_after(
+            'post', 'hi', None, 5, limit=2), ([], 2))
+        self.assertEqual(bodies[-1]['track_total_hits'], 2)
+        # Ties are broken on the stored id, not _id
+        self.assertEqual(list(bodies[-1]['sort'][1]), ['id'])
+        self.assertEqual(backend('7.10.2', total).query('post', 'hi', 1, 5),
+                         ([], 2))
+
+    def test_search_bulk_refresh(self):
+        es = mock.Mock()
+        es.transport.serializer = JSONSerializer()
+        es.bulk.return_value = {'errors': False, 'items': [
+            {'index': {'_id': '1', 'status': 201}}]}
+        self.assertEqual(ElasticsearchBackend(es).apply(
+            {('post', 1): {'body': 'hi'}}), 0)
+        # Searchable before the results cache is invalidated
+        self.assertEqual(es.bulk.call_args[1]['refresh'], 'wait_for')
+
+    def test_search_client_resilience(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubElasticsearch)
+        server.hits, server.delay, server.status = 0, 0, 200
+        # Quiet about the client hanging up on slow responses
+        server.handle_error = lambda request, address: None
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        es = Elasticsearch(
+            [f'127.0.0.1:{server.server_address[1]}'],
+            transport_class=ResilientTransport, timeouts={'search': 0.2},
+            retries=1, backoff=0.01, breaker=CircuitBreaker(4, 0.3))
+        backend = ElasticsearchBackend(es)
+        self.assertEqual(backend.query('post', 'hello', 1, 5), ([], 0))
+
+        # Slow searches time out and are retried
+        server.delay = 0.5
+        with self.assertRaises(ConnectionTimeout):
+            es.search(index='post', body={})
+        server.delay = 0
+        self.assertEqual(es.transport.metrics()['timeouts'], 2)
+
+        # Errors open the breaker - then requests fail without being sent
+        server.status = 503
+        with self.assertRaises(SearchUnavailable):
+            backend.query('post', 'hello', 1, 5)
+        self.assertEqual(es.transport.metrics()['state'], 'open')
+        hits = server.hits
+        with self.assertRaises(CircuitOpenError):
+            es.search(index='post', body={})
+        self.assertEqual(server.hits, hits)
+
+        # After the reset time one trial request closes it again
+        server.status = 200
+        time.sleep(0.3)
+        self.assertEqual(backend.query('post', 'hello', 1, 5), ([], 0))
+        metrics = es.transport.metrics()
+        self.assertEqual((metrics['state'], metrics['times_opened'],
+                          metrics['short_circuited']), ('closed', 1, 1))
+
+    def test_search_breaker_trial_errors(self):
+        transport = ResilientTransport([{}], retries=0,
+                                       breaker=CircuitBreaker(1, 0))
+        send = mock.patch('elasticsearch.Transport.perform_request')
+        with send as request:
+            request.side_effect = ConnectionTimeout('TIMEOUT', 'slow', None)
+            with self.assertRaises(ConnectionTimeout):
+                transport.perform_request('GET', '/')
+            self.assertEqual(transport.breaker.state, 'open')
+            # Something unexpected during the trial request doesn't leave the
+            # breaker refusing requests for good
+            request.side_effect = ValueError
+            with self.assertRaises(ValueError):
+                transport.perform_request('GET', '/')
+            request.side_effect = None
+            request.return_value = {}
+            self.assertEqual(transport.perform_request('GET', '/'), {})
+        self.assertEqual(transport.breaker.state, 'closed')
+
+    def test_bulk_import(self):
+        existing = User(username='john', email='john@example.com')
+        db.session.add(existing)
+        db.session.commit()
+        users = '\n'.join(json.dumps(record) for record in [
+            {'username': 'susan', 'email': 'susan@example.com',
+             'password': 'cat', 'about_me': 'Hi'},
+            {'username': 'john', 'email': 'other@example.com',
+             'password': 'dog'},
+            {'username': 'mary', 'email': 'mary@example.com', 'password': 'x'},
+            {'username': 'david', 'email': 'susan@example.com',
+             'password': 'x'},
+            {'username': 'alice', 'email': 'alice@example.com'},
+            {'username': 'bob', 'email': 'bob@example.com', 'password': 'y'}])
+        users += '\nnot json\n'
+        # Small chunks so duplicates are caught across chunks too, and the
+        # passwords are hashed in a process pool
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=[
+            'import', 'users', '-', '--chunk-size', '2', '--workers', '2'],
+            input=users)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('row 2: username is already taken', result.output)
+        self.assertIn('row 4: email is already taken', result.output)
+        self.assertIn('row 5: must include password', result.output)
+        self.assertIn('row 7: not a valid record', result.output)
+        self.assertIn('3 users imported, 4 rows skipped', result.output)
+        self.assertIn('rows/s', result.output)
+        susan = User.query.filter_by(username='susan').one()
+        self.assertTrue(susan.check_password('cat'))
+        self.assertEqual(susan.about_me, 'Hi')
+        self.assertEqual((susan.post_count, susan.follower_count), (0, 0))
+
+        follows = ('follower,followed\njohn,susan\nmary,susan\n'
+                   'susan,john\njohn,susan\njohn,nobody\nbob,bob\n')
+        result = importer.import_follows(
+            importer.read_records(io.StringIO(follows), 'csv'), chunk_size=3)
+        self.assertEqual(result['created'], 3)
+        self.assertEqual(result['errors'], [
+            {'row': 5, 'message': 'no user nobody'},
+            {'row': 6, 'message': 'users cannot follow themselves'}])
+        # Following again is skipped rather than an error
+        result = importer.import_follows([(1, {'follower': 'mary',
+                                               'followed': 'susan'})])
+        self.assertEqual((result['created'], result['errors']), (0, []))
+        db.session.expire_all()
+        self.assertEqual(susan.followers.count(), 2)
+        ids = [user.id for user in User.query]
+        counts = User.count_relationships(ids)
+        for user in User.query:
+            self.assertEqual((user.post_count, user.follower_count,
+                              user.followed_count), counts[user.id])
+
+# Tests which go through the view functions with the test client
+class RoutesCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        if fakeredis is not None:
+            self.redis = fakeredis.FakeRedis()
+            self.redis.flushall()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, username, password='cat'):
+        return self.client.post('/auth/login', data={'username': username,
+                                                     'password': password})
+
+    def add_user(self, username):
+        u = User(username=username, email=f'{username}@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        return u
+
+    @unittest.skipIf(fakeredis is None, 'needs fakeredis')
+    def test_signed_api_tokens(self):
+        u = self.add_user('john')
+        self.app.config['API_TOKEN_FORMAT'] = 'signed'
+
+        def get_token():
+            credentials = base64.b64encode(b'john:cat').decode('utf-8')
+            response = self.client.post(
+                '/api/tokens',
+                headers={'Authorization': 'Basic ' + credentials})
+            return response.get_json()['token']
+
+        def get_user(token):
+            return self.client.get(f'/api/users/{u.id}', headers={
+                'Authorization': 'Bearer ' + token}).status_code
+        token = get_token()
+        self.assertEqual(token.count('.'), 2)
+        self.assertEqual(get_user(token), 200)
+        # Tampered with, or not signed with our key
+        self.assertEqual(get_user(token[:-2] + 'xx'), 401)
+        self.assertEqual(get_user(jwt.encode(
+            {'api': u.id, 'gen': 0}, 'guess', algorithm='HS256').decode(
+                'utf-8')), 401)
+
+        # Without Redis the cached generation can't be replaced, so nothing
+        # is revoked
+        def revoke(token):
+            return self.client.delete('/api/tokens', headers={
+                'Authorization': 'Bearer ' + token}).status_code
+        self.assertEqual(revoke(token), 503)
+        self.assertEqual(get_user(token), 200)
+
+        # Revoking ends every signed token issued so far
+        self.app.redis = self.redis
+        self.assertEqual(get_user(token), 200)
+        self.assertEqual(revoke(token), 204)
+        self.assertEqual(get_user(token), 401)
+        token = get_token()
+        self.assertEqual(get_user(token), 200)
+
+        # Even if the new generation can't be published once committed
+        with mock.patch.object(self.redis, 'pipeline',
+                               side_effect=redis.exceptions.ConnectionError):
+            self.assertEqual(revoke(token), 204)
+        self.assertEqual(self.redis.get(User.token_generation_key(u.id)),
+                         User.TOKEN_TOMBSTONE)
+        self.assertEqual(get_user(token), 401)
+        self.assertEqual(get_user(get_token()), 200)
+
+        # Random tokens still work
+        self.app.config['API_TOKEN_FORMAT'] = 'opaque'
+        token = get_token()
+        self.assertNotIn('.', token)
+        self.assertEqual(get_user(token), 200)
+
+    def test_api_user_collections(self):
+        users = [self.add_user(name) for name in ('john', 'susan', 'mary',
+                                                  'david')]
+        for user in users[1:]:
+            users[0].follow(user)
+            user.follow(users[0])
+        users[1].about_me = 'caf\u00e9 {1}'
+        db.session.add(Post(body='hi', author=users[1]))
+        db.session.commit()
+        token = users[0].get_token()
+        db.session.commit()
+        id = users[0].id
+        for url in ('/api/users?per_page=3', '/api/users?per_page=3&page=2',
+                    '/api/users?cursor=&per_page=2',
+                    f'/api/users/{id}/followers', f'/api/users/{id}/followed'):
+            response = self.client.get(url, headers={
+                'Authorization': 'Bearer ' + token})
+            data = response.get_json()
+            # Exactly what serializing each user on its own gives
+            with self.app.test_request_context():
+                data['items'] = [User.query.get(item['id']).to_dict()
+                                 for item in data['items']]
+                self.assertEqual(response.get_data(),
+                                 jsonify(data).get_data(), url)
+        self.assertEqual(len(data['items']), 3)
+
+    def test_api_conditional_get(self):
+        john = self.add_user('john')
+        self.add_user('susan')
+        token = john.get_token()
+        db.session.commit()
+
+        def get(url, etag=None):
+            headers = {'Authorization': 'Bearer ' + token}
+            if etag:
+                headers['If-None-Match'] = etag
+            return self.client.get(url, headers=headers)
+        etags = {}
+        for url, cache_control in ((f'/api/users/{john.id}',
+                                    'private, no-cache'),
+                                   ('/api/users', 'private, max-age=10'),
+                                   ('/api/users?cursor=&per_page=1',
+                                    'private, max-age=10')):
+            response = get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Cache-Control'], cache_control)
+            etag = etags[url] = response.headers['ETag']
+            # Answered without representing the users again
+            with mock.patch.object(User, 'to_dict',
+                                   side_effect=AssertionError), \
+                    mock.patch.object(User, 'to_collection_items',
+                                      side_effect=AssertionError):
+                response = get(url, etag)
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(response.data, b'')
+        # A change to what's shown is a new version
+        john.about_me = 'hello'
+        db.session.commit()
+        for url in (f'/api/users/{john.id}', '/api/users'):
+            self.assertEqual(get(url, etags[url]).status_code, 200)
+        response = get('/api/users')
+        self.assertNotEqual(response.headers['ETag'],
+                            get('/api/users?per_page=1').headers['ETag'])
+
+    def test_api_users_batch(self):
+        john = self.add_user('john')
+        susan = self.add_user('susan')
+        token = john.get_token()
+        db.session.commit()
+        john_id, susan_id = john.id, susan.id
+
+        def get(query):
+            return self.client.get('/api/users?' + query, headers={
+                'Authorization': 'Bearer ' + token})
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        response = get(f'ids={susan_id},999,{john_id},{susan_id}')
+        db.event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        # Every user asked for once, missing users are null
+        self.assertEqual(set(data['items']),
+                         {str(susan_id), '999', str(john_id)})
+        self.assertIsNone(data['items']['999'])
+        with self.app.test_request_context():
+            self.assertEqual(data['items'][str(susan_id)], susan.to_dict())
+        self.assertEqual(data['_meta'], {'requested': 3, 'found': 2})
+        # Token check, then the users
+        self.assertEqual(len(statements), 2)
+
+        data = get('usernames=susan,nobody').get_json()
+        self.assertEqual(data['items']['susan']['id'], susan_id)
+        self.assertIsNone(data['items']['nobody'])
+        for query in ('ids=1,x', 'ids=', 'ids=1&usernames=john',
+                      'ids=' + ','.join(str(i) for i in range(101))):
+            self.assertEqual(get(query).status_code, 400, query)
+
+    def test_api_bulk_import(self):
+        token = self.add_user('john').get_token()
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + token}
+        response = self.client.post('/api/users/bulk', headers=headers, json={
+            'users': [{'username': 'susan', 'email': 'susan@example.com',
+                       'password': 'cat'},
+                      {'username': 'john', 'email': 'x@example.com',
+                       'password': 'cat'}],
+            'follows': [{'follower': 'susan', 'followed': 'john'},
+                        {'follower': 'john'}]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+        data = response.get_json()
+        self.assertEqual(data['users'], {'created': 1, 'errors': [
+            {'row': 2, 'message': 'username is already taken'}]})
+        self.assertEqual(data['follows'], {'created': 1, 'errors': [
+            {'row': 2, 'message': 'must include follower and followed'}]})
+        self.assertIn('rate', data['_meta'])
+        john = User.query.filter_by(username='john').one()
+        self.assertEqual(john.follower_count, 1)
+
+        self.app.config['API_BULK_LIMIT'] = 1
+        response = self.client.post('/api/users/bulk', headers=headers, json={
+            'follows': [{}, {}]})
+        self.assertEqual(response.status_code, 400)
+        # Users are limited separately, as hashing their passwords is slow
+        self.app.config['API_BULK_LIMIT'] = 1000
+        self.app.config['API_BULK_USER_LIMIT'] = 1
+        response = self.client.post('/api/users/bulk', headers=headers, json={
+            'users': [{}, {}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post('/api/users/bulk', json={
+            'users': []}).status_code, 401)
+
+    def test_notifications(self):
+        self.add_user('john')
+        u2 = self.add_user('susan')
+        self.login('john')
+        response = self.client.post('/send_message/susan',
+                                    data={'message': 'hello'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(u2.new_messages(), 1)
+        # Published (or dropped, with no Redis) once committed
+        self.assertNotIn('notifications', db.session.info)
+
+        self.client.get('/auth/logout')
+        self.login('susan')
+        # Pushing is off by default - pages poll and the stream is refused
+        page = self.client.get('/index').get_data(as_text=True)
+        self.assertNotIn('EventSource(', page)
+        self.assertNotIn('wait=', page)
+        self.assertEqual(
+            self.client.get('/notifications/stream').status_code, 503)
+
+        self.app.config['NOTIFICATIONS_PUSH'] = True
+        self.assertIn('EventSource(',
+                      self.client.get('/index').get_data(as_text=True))
+        # No Redis to wait on so a long poll returns straight away
+        response = self.client.get('/notifications?wait=5')
+        self.assertEqual([(n['name'], n['data']) for n in response.get_json()],
+                         [('unread_message_count', 1)])
+        # ...and the browser is told to fall back to polling
+        self.assertEqual(
+            self.client.get('/notifications/stream').status_code, 503)
+
+    def test_post_pages_queries(self):
+        users = [self.add_user(name) for name in ('john', 'susan', 'mary')]
+        for user in users[1:]:
+            users[0].follow(user)
+        # Enough posts that every page below is full with either page size -
+        # a short first page doesn't need the COUNT(*) for the total
+        now = datetime.utcnow()
+        db.session.add_all([Post(body=f'post {i} from {user.username}',
+                                 author=user,
+                                 timestamp=now + timedelta(seconds=i))
+                            for i in range(13) for user in users])
+        db.session.commit()
+        self.login('john')
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        self.addCleanup(db.event.remove, db.engine, 'before_cursor_execute',
+                        count)
+
+        # Queries made for a page, with posts_per_page posts on a page
+        def queries(url, posts_per_page):
+            self.app.config['POSTS_PER_PAGE'] = posts_per_page
+            # Requests share the test's session - start with nothing loaded
+            # (or cached)
+            db.session.expunge_all()
+            self.app.identity_cache.clear()
+            del statements[:]
+            self.assertEqual(self.client.get(url).status_code, 200)
+            return len(statements)
+        for url in ('/index', '/index?cursor=', '/explore', '/explore?cursor=',
+                    '/user/susan', '/search?q=post'):
+            # The same whether the page shows one author's posts or several
+            self.assertEqual(queries(url, 2), queries(url, 12), url)
+
+    def test_post_fragments(self):
+        u = self.add_user('john')
+        db.session.add(Post(body='hello there', author=u))
+        db.session.commit()
+        self.login('john')
+        rendered = []
+
+        def record(sender, template, context, **extra):
+            rendered.append(template.name)
+        template_rendered.connect(record, self.app)
+        self.addCleanup(template_rendered.disconnect, record, self.app)
+
+        # Rendered once, then served from the cache (no Redis here - the
+        # process's own cache)
+        for url in ('/explore', '/explore', '/user/john', '/index'):
+            response = self.client.get(url)
+            self.assertIn(b'hello there', response.data)
+        self.assertEqual(rendered.count('_post.html'), 1)
+        self.assertEqual(len(self.app.post_fragments), 1)
+
+        # A new username is a new key, so the post is rendered again
+        u.username = 'johnny'
+        db.session.commit()
+        response = self.client.get('/explore')
+        self.assertIn(b'johnny', response.data)
+        self.assertEqual(rendered.count('_post.html'), 2)
+
+    def test_user_popup(self):
+        john = self.add_user('john')
+        susan = self.add_user('susan')
+        self.login('john')
+        response = self.client.get('/user/susan/popup')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Follow', response.data)
+        self.assertTrue(response.cache_control.private)
+        etag = response.headers['ETag']
+        self.assertIsNotNone(response.last_modified)
+        # Unchanged - the browser's copy is still good
+        response = self.client.get('/user/susan/popup',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(self.client.get('/user/nobody/popup').status_code,
+                         404)
+
+        # Following changes both users' popups
+        john.follow(susan)
+        db.session.flush()
+        self.assertEqual(db.session.info['stale_popups'], {'john', 'susan'})
+        db.session.commit()
+        self.assertNotIn('stale_popups', db.session.info)
+        response = self.client.get('/user/susan/popup',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Unfollow', response.data)
+        self.assertIn(b'1 followers', response.data)
+
+        # So does a new username - under the old one as well
+        susan.username = 'sue'
+        db.session.flush()
+        self.assertEqual(db.session.info['stale_popups'], {'sue', 'susan'})
+        db.session.rollback()
+        self.assertNotIn('stale_popups', db.session.info)
+
+    @unittest.skipIf(fakeredis is None, 'needs fakeredis')
+    def test_user_popup_redis(self):
+        self.app.redis = self.redis
+        john = self.add_user('john')
+        susan = self.add_user('susan')
+        self.login('john')
+        rendered = []
+
+        def record(sender, template, context, **extra):
+            rendered.append(template.name)
+        template_rendered.connect(record, self.app)
+        self.addCleanup(template_rendered.disconnect, record, self.app)
+
+        response = self.client.get('/user/susan/popup')
+        etag = response.headers['ETag']
+        self.assertEqual(rendered, ['user_popup.html'])
+        self.assertEqual(len(self.app.redis.keys('user-popup:*')), 1)
+        # Served from Redis after that, with the same ETag
+        response = self.client.get('/user/susan/popup')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertIn(b'Follow', response.data)
+        self.assertEqual(self.client.get('/user/susan/popup', headers={
+            'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(rendered, ['user_popup.html'])
+
+        # Committing a follow deletes the cached popups
+        john.follow(susan)
+        db.session.commit()
+        self.assertEqual(self.app.redis.keys('user-popup:*'), [])
+        response = self.client.get('/user/susan/popup', headers={
+            'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Unfollow', response.data)
+        self.assertEqual(rendered, ['user_popup.html'] * 2)
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)